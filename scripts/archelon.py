@@ -15,6 +15,8 @@ import requests
 import edtf
 import yaml
 
+from compressed import find_file, open_file
+
 # Convert Fedora exported and filtered objects to Archelon input format.
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -693,7 +695,7 @@ def load_index(index_path: Path) -> Optional[dict]:
         return None
     else:
         index = {}
-        with index_path.open(mode='r') as index_file:
+        with open_file(index_path) as index_file:
             logging.info(f'Reading index from {index_path}')
             for line in index_file:
                 index.update(json.loads(line))
@@ -703,7 +705,7 @@ def load_index(index_path: Path) -> Optional[dict]:
 def load_filter(filter_data_path: Path) -> Optional[dict]:
     """ Load in filter.json """
     filter_data = {}
-    with filter_data_path.open(mode='r') as filter_data_file:
+    with open_file(filter_data_path) as filter_data_file:
         logging.info(f'Reading filter data from {filter_data_path}')
         for line in filter_data_file:
             record = json.loads(line)
@@ -733,22 +735,22 @@ def main(args: Namespace) -> None:
     target = Path(args.target_dir)
 
     # Load index information
-    index_path = Path(args.index_path) if args.index_path else target / 'index.json'
+    index_path = Path(args.index_path) if args.index_path else find_file(target / 'index.json')
     index = load_index(index_path)
 
     # Load filter.json data
     if not args.fast_mode:
-        filter_data = load_filter(target / 'filter.json')
+        filter_data = load_filter(find_file(target / 'filter.json'))
 
     # Load mapping document (assumes cwd is the migration-utils directory)
     mapping = load_mapping()
 
     # Read in objects
-    export_path = target / 'export.csv'
+    export_path = find_file(target / 'export.csv')
     logging.info(f"Reading input objects from {export_path}")
     missing_files = []
 
-    with export_path.open(mode='r') as export_file:
+    with open_file(export_path, newline='') as export_file:
         export_csv = DictReader(export_file)
 
         for record in export_csv:
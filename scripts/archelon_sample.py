@@ -2,22 +2,39 @@
 
 import json
 import csv
+from pathlib import Path
+
+from compressed import compression, find_file, open_file
+from jsonl_index import JsonlIndex
 
 # Sample filter.json records for testing with archelon.py
 #
 # Input files: export/{info.json, filter.json, export.csv}
 # Output files: sample/{info.json, filter.json, export.csv}
+#
+# Input files may be compressed (.gz, .zst); each output file is compressed
+# the same way as its input file.
 
 N = 500
 
+
+def sample_path(export_path):
+    """ Output path in the sample directory corresponding to an input path. """
+    return Path('sample', export_path.name)
+
+
+export_filter_path = find_file(Path('export', 'filter.json'))
+export_export_path = find_file(Path('export', 'export.csv'))
+export_info_path = find_file(Path('export', 'info.json'))
+
 count = {}
 pids = set()
 
 # Read all input records
-with open("export/filter.json", mode='r') as export_filter_file:
+with open_file(export_filter_path) as export_filter_file:
 
     # Write selected sample records
-    with open("sample/filter.json", mode='w') as sample_filter_file:
+    with open_file(sample_path(export_filter_path), mode='w') as sample_filter_file:
         for line in export_filter_file:
 
             record = json.loads(line)
@@ -61,10 +78,10 @@ with open("export/filter.json", mode='r') as export_filter_file:
                 sample_filter_file.write(line)
 
 # Create export.csv with all matching pids
-with open("export/export.csv", mode='r') as export_export_file:
+with open_file(export_export_path, newline='') as export_export_file:
     export_csv = csv.DictReader(export_export_file)
 
-    with open("sample/export.csv", 'w') as sample_export_file:
+    with open_file(sample_path(export_export_path), mode='w', newline='') as sample_export_file:
         sample_csv = csv.DictWriter(sample_export_file, export_csv.fieldnames)
         sample_csv.writeheader()
 
@@ -73,12 +90,19 @@ with open("export/export.csv", mode='r') as export_export_file:
                 sample_csv.writerow(record)
 
 # Create info.json with all matching pids
-with open("export/info.json", mode='r') as export_info_file:
+if compression(export_info_path) is None:
+    # Copy the records using the pid index of info.json, built on first use
+    with JsonlIndex(export_info_path) as info_index:
+        with open(sample_path(export_info_path), mode='wb') as sample_info_file:
+            info_index.extract(pids, sample_info_file)
 
-    with open("sample/info.json", mode='w') as sample_info_file:
+else:
+    with open_file(export_info_path) as export_info_file:
 
-        for line in export_info_file:
-            record = json.loads(line)
+        with open_file(sample_path(export_info_path), mode='w') as sample_info_file:
+
+            for line in export_info_file:
+                record = json.loads(line)
 
-            if record['pid'] in pids:
-                sample_info_file.write(line)
+                if record['pid'] in pids:
+                    sample_info_file.write(line)
@@ -17,6 +17,8 @@ from xml.dom.minidom import parse, Element, Node, Text
 #          UMDM object
 from xml.etree import ElementTree
 
+from compressed import find_file, open_file
+
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 languageMap = {
@@ -581,7 +583,7 @@ def load_index(index_path: Path) -> Optional[dict]:
         return None
     else:
         index = {}
-        with index_path.open(mode='r') as index_file:
+        with open_file(index_path) as index_file:
             logging.info(f'Reading index from {index_path}')
             for line in index_file:
                 index.update(json.loads(line))
@@ -596,15 +598,15 @@ def main(args: Namespace) -> None:
 
     target = Path(args.target_dir)
 
-    index_path = Path(args.index_path) if args.index_path else target / 'index.json'
+    index_path = Path(args.index_path) if args.index_path else find_file(target / 'index.json')
     index = load_index(index_path)
 
     # Read in objects
-    export_path = target / 'export.csv'
+    export_path = find_file(target / 'export.csv')
     logging.info(f"Reading input objects from {export_path}")
     missing_files = []
 
-    with export_path.open(mode='r') as export_file:
+    with open_file(export_path, newline='') as export_file:
         export_csv = DictReader(export_file)
 
         for record in export_csv:
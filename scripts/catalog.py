@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import sqlite3
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+from compressed import FileType
+
+# Build a queryable sqlite catalog from an info.json file, so that filter.py,
+# stats.py and duplicates.py can use indexed queries instead of a full scan
+# of info.json.
+#
+# Input - json info file with flat list of all objects
+#
+# Output - sqlite catalog with tables:
+#
+#   objects - one row per info.json record, in input order (id), with the
+#             object properties, the doInfo/amInfo type and status, the UMDM
+#             title and the complete JSON record
+#   datastreams - one row per datastream, with its size
+#   relationships - one row per rels-mets relationship, such as
+#                   isMemberOfCollection and hasPart
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Number of records inserted per batch
+BATCH_SIZE = 10000
+
+SCHEMA = """
+    CREATE TABLE objects (
+        id INTEGER PRIMARY KEY,
+        pid TEXT NOT NULL,
+        foxml TEXT,
+        state TEXT,
+        content_model TEXT,
+        label TEXT,
+        created_date TEXT,
+        last_modified_date TEXT,
+        has_ds INTEGER NOT NULL,
+        has_doinfo INTEGER NOT NULL,
+        has_aminfo INTEGER NOT NULL,
+        do_type TEXT,
+        do_status TEXT,
+        am_type TEXT,
+        am_status TEXT,
+        has_umdm INTEGER NOT NULL,
+        umdm_title TEXT,
+        record TEXT NOT NULL
+    );
+
+    CREATE TABLE datastreams (
+        object_id INTEGER NOT NULL REFERENCES objects (id),
+        dsid TEXT NOT NULL,
+        state TEXT,
+        control_group TEXT,
+        mime_type TEXT,
+        size INTEGER,
+        created TEXT,
+        location TEXT
+    );
+
+    CREATE TABLE relationships (
+        object_id INTEGER NOT NULL REFERENCES objects (id),
+        seq INTEGER NOT NULL,
+        relationship TEXT NOT NULL,
+        target_pid TEXT NOT NULL
+    );
+"""
+
+INDEXES = """
+    CREATE INDEX objects_pid ON objects (pid);
+    CREATE INDEX objects_doinfo ON objects (has_doinfo, do_status, do_type);
+    CREATE INDEX objects_aminfo ON objects (has_aminfo, pid);
+    CREATE INDEX datastreams_object ON datastreams (object_id);
+    CREATE INDEX datastreams_mime_type ON datastreams (mime_type);
+    CREATE INDEX relationships_object ON relationships (object_id, seq);
+    CREATE INDEX relationships_target ON relationships (relationship, target_pid);
+"""
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(
+        description='Build a sqlite catalog of the Fedora 2 objects in an info.json file.'
+    )
+
+    parser.add_argument("-i", "--infile", required=True,
+                        type=FileType(mode='r', encoding='UTF-8'),
+                        help="JSON input file")
+
+    parser.add_argument("-c", "--catalog", required=True,
+                        type=str,
+                        help="sqlite catalog file to create; an existing catalog is replaced")
+
+    # Process command line arguments
+    return parser.parse_args()
+
+
+def connect(catalog_path) -> sqlite3.Connection:
+    """ Open an existing catalog. """
+    if not Path(catalog_path).is_file():
+        raise FileNotFoundError(f'No catalog found at {catalog_path}')
+    return sqlite3.connect(str(catalog_path))
+
+
+def object_row(object_id: int, record: dict, line: str) -> tuple:
+    """ Build the objects table row for an info.json record. """
+    ds = record.get('ds')
+    ds_dict = ds if isinstance(ds, dict) else {}
+    do_info = ds_dict.get('doInfo', {})
+    am_info = ds_dict.get('amInfo', {})
+    umdm = ds_dict.get('umdm', {})
+
+    return (
+        object_id,
+        record['pid'],
+        record.get('foxml'),
+        record.get('state'),
+        record.get('contentModel'),
+        record.get('label'),
+        record.get('createdDate'),
+        record.get('lastModifiedDate'),
+        int(ds is not None),
+        int('doInfo' in ds_dict),
+        int('amInfo' in ds_dict),
+        do_info.get('type'),
+        do_info.get('status'),
+        am_info.get('type'),
+        am_info.get('status'),
+        int('umdm' in ds_dict),
+        umdm.get('umdm_title'),
+        line.rstrip('\n'),
+    )
+
+
+def datastream_rows(object_id: int, record: dict) -> list:
+    """ Build the datastreams table rows for an info.json record. """
+    return [
+        (
+            object_id,
+            dsid,
+            ds.get('state'),
+            ds.get('controlGroup'),
+            ds.get('mimeType'),
+            ds.get('size'),
+            ds.get('created'),
+            ds.get('location'),
+        )
+        for dsid, ds in record.get('ds', {}).items()
+    ]
+
+
+def relationship_rows(object_id: int, record: dict) -> list:
+    """ Build the relationships table rows for an info.json record, in record order. """
+    rels = record.get('ds', {}).get('rels-mets', {}).get('rels', {})
+    rows = []
+    for relationship, values in rels.items():
+        for target_pid in values:
+            rows.append((object_id, len(rows), relationship, target_pid))
+    return rows
+
+
+def build(infile, conn: sqlite3.Connection) -> int:
+    """
+    Load the info.json records into a new catalog.
+
+    :param infile: info.json file
+    :param conn: connection to the (empty) catalog
+    :return: number of objects loaded
+    """
+    conn.executescript(SCHEMA)
+
+    objects = []
+    datastreams = []
+    relationships = []
+
+    def insert():
+        conn.executemany(f'INSERT INTO objects VALUES ({", ".join("?" * 18)})', objects)
+        conn.executemany('INSERT INTO datastreams VALUES (?, ?, ?, ?, ?, ?, ?, ?)', datastreams)
+        conn.executemany('INSERT INTO relationships VALUES (?, ?, ?, ?)', relationships)
+        objects.clear()
+        datastreams.clear()
+        relationships.clear()
+
+    count = 0
+    for line in infile:
+        try:
+            record = json.loads(line)
+            object_rows = [object_row(count, record, line)]
+            ds_rows = datastream_rows(count, record)
+            rels_rows = relationship_rows(count, record)
+        except Exception as e:
+            logging.warning(f'Skipping record: {type(e)}: {e}')
+            continue
+
+        # only add the rows once all of them have been built, so that a
+        # skipped record does not leave rows behind under its object id
+        objects.extend(object_rows)
+        datastreams.extend(ds_rows)
+        relationships.extend(rels_rows)
+        count += 1
+
+        if len(objects) >= BATCH_SIZE:
+            insert()
+            logging.info(f'  loaded {count} objects')
+
+    insert()
+
+    logging.info('Creating indexes')
+    conn.executescript(INDEXES)
+    conn.execute('ANALYZE')
+    conn.commit()
+
+    return count
+
+
+def main(args: Namespace) -> None:
+    """ Build the catalog. """
+    catalog_path = Path(args.catalog)
+    if catalog_path.exists():
+        logging.info(f'Replacing existing catalog {catalog_path}')
+        catalog_path.unlink()
+
+    logging.info(f'Building catalog {catalog_path} from {args.infile.name}')
+    conn = sqlite3.connect(str(catalog_path))
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    try:
+        with args.infile:
+            count = build(args.infile, conn)
+    finally:
+        conn.close()
+
+    logging.info(f'Loaded {count} objects')
+
+
+if __name__ == '__main__':
+    main(process_args())
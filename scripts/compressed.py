@@ -0,0 +1,202 @@
+import atexit
+import gzip
+import io
+import queue
+import sys
+import threading
+import weakref
+from argparse import ArgumentTypeError
+from pathlib import Path
+
+# Transparent access to plain, gzip (.gz) and zstd (.zst, .zstd) compressed
+# files, selected by the file extension. Compressed files are decompressed in
+# a background thread, so decompression overlaps with parsing.
+#
+# zstd support requires the optional zstandard package.
+
+GZIP_SUFFIXES = ('.gz',)
+ZSTD_SUFFIXES = ('.zst', '.zstd')
+
+# Size of the decompressed chunks handed from the background thread
+CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of decompressed chunks waiting to be read
+QUEUE_SIZE = 8
+
+# Open ThreadedReader streams, stopped at exit while their threads can still run
+readers = weakref.WeakSet()
+
+
+def compression(path):
+    """ Return 'gzip', 'zstd' or None for a file path, based on its extension. """
+    suffix = Path(str(path)).suffix.lower()
+    if suffix in GZIP_SUFFIXES:
+        return 'gzip'
+    if suffix in ZSTD_SUFFIXES:
+        return 'zstd'
+    return None
+
+
+def open_file(path, mode='r', encoding='UTF-8', newline=None):
+    """
+    Open a plain or compressed file in text mode. Use '-' for stdin/stdout.
+
+    :param path: file path
+    :param mode: 'r', 'w' or 'a'
+    :param encoding: text encoding
+    :param newline: newline handling, as for open(); use '' for CSV files
+    :return: text file object
+    """
+    mode = mode.replace('t', '')
+    if mode not in ('r', 'w', 'a'):
+        raise ValueError(f'Unsupported mode "{mode}"')
+
+    if str(path) == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+
+    kind = compression(path)
+    if kind is None:
+        return open(path, mode=mode, encoding=encoding, newline=newline)
+
+    if mode == 'r':
+        if kind == 'gzip':
+            stream = gzip.open(path, 'rb')
+        else:
+            stream = zstandard().ZstdDecompressor().stream_reader(
+                open(path, 'rb'), read_across_frames=True, closefd=True
+            )
+        binary = io.BufferedReader(ThreadedReader(stream), buffer_size=CHUNK_SIZE)
+    else:
+        # appending adds a new gzip member or zstd frame, which are read back
+        # as one stream
+        if kind == 'gzip':
+            binary = gzip.open(path, mode + 'b')
+        else:
+            binary = zstandard().ZstdCompressor().stream_writer(open(path, mode + 'b'), closefd=True)
+
+    return CompressedTextFile(binary, path, encoding=encoding, newline=newline)
+
+
+def find_file(path):
+    """
+    Find a file which may have been stored compressed: returns path if it
+    exists, otherwise the first existing compressed variant (path.gz,
+    path.zst, path.zstd), otherwise path.
+
+    :param path: Path of the uncompressed file
+    :return: Path
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    for suffix in GZIP_SUFFIXES + ZSTD_SUFFIXES:
+        candidate = path.with_name(path.name + suffix)
+        if candidate.exists():
+            return candidate
+    return path
+
+
+def zstandard():
+    """ Import the optional zstandard package. """
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compressed files require the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+class CompressedTextFile(io.TextIOWrapper):
+    """ Text wrapper for a compressed stream, which reports the file path as its name. """
+
+    def __init__(self, binary, path, **kwargs):
+        super().__init__(binary, **kwargs)
+        self.path = str(path)
+
+    @property
+    def name(self):
+        return self.path
+
+
+class ThreadedReader(io.RawIOBase):
+    """ Raw binary stream which reads from another stream in a background thread. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = queue.Queue(QUEUE_SIZE)
+        self.chunk = memoryview(b'')
+        self.eof = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        readers.add(self)
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.stream.read(CHUNK_SIZE)
+                if not self.put(chunk) or not chunk:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        """ Queue an item for the reader; returns False if the stream was closed. """
+        while not self.stopping.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.chunk and not self.eof:
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+            self.chunk = memoryview(item)
+
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+@atexit.register
+def close_readers():
+    """ Stop the background threads of any readers which were not closed. """
+    for reader in list(readers):
+        reader.close()
+
+
+class FileType:
+    """
+    argparse type for plain or compressed files, in the manner of
+    argparse.FileType.::
+
+        parser.add_argument("-i", "--infile", type=FileType('r'))
+    """
+
+    def __init__(self, mode='r', encoding='UTF-8', newline=None):
+        self.mode = mode
+        self.encoding = encoding
+        self.newline = newline
+
+    def __call__(self, path):
+        try:
+            return open_file(path, self.mode, encoding=self.encoding, newline=self.newline)
+        except (OSError, RuntimeError) as e:
+            raise ArgumentTypeError(f"can't open '{path}': {e}")
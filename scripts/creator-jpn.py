@@ -6,35 +6,11 @@ from csv import DictReader, writer
 
 import pykakasi
 
+from edit_distance import levenshtein_many
+
 # Gather information about Japanese and Romaji forms of Creator names
 # in Japanese language records.
 
-def levenshtein(s, t):
-    ''' From Wikipedia article; Iterative with two matrix rows.
-
-    Christopher P. Matthews
-    christophermatthews1985@gmail.com
-    Sacramento, CA, USA
-    https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Levenshtein_distance#Python
-    '''
-    if s == t: return 0
-    elif len(s) == 0: return len(t)
-    elif len(t) == 0: return len(s)
-    v0 = [None] * (len(t) + 1)
-    v1 = [None] * (len(t) + 1)
-    for i in range(len(v0)):
-        v0[i] = i
-    for i in range(len(s)):
-        v1[0] = i + 1
-        for j in range(len(t)):
-            cost = 0 if s[i] == t[j] else 1
-            v1[j + 1] = min(v1[j] + 1, v0[j + 1] + 1, v0[j] + cost)
-        for j in range(len(v0)):
-            v0[j] = v1[j]
-
-    return v1[len(t)]
-
-
 def normalize(s):
     ''' Normalize to a comparable form. '''
     return re.sub(r'\s+', '', s.lower())
@@ -75,9 +51,10 @@ for record in csvinput:
 
             k = kks.convert(jpn)
 
-            for romanization in ('hepburn', 'kunrei', 'passport'):
-                norm = normalize(''.join([x[romanization] for x in k]))
-                score = levenshtein(romaji_norm, norm)
+            norms = [normalize(''.join([x[romanization] for x in k]))
+                     for romanization in ('hepburn', 'kunrei', 'passport')]
+            scores = levenshtein_many((romaji_norm, norm) for norm in norms)
+            for norm, score in zip(norms, scores):
                 row.append(norm)
                 row.append(score)
 
@@ -7,35 +7,11 @@ from csv import DictReader, writer
 import pykakasi
 import unicodeblock.blocks as blocks
 
+from edit_distance import levenshtein, levenshtein_many
+
 # Determine the language of various metadata in Japanese language
 # materials
 
-def levenshtein(s, t):
-    ''' From Wikipedia article; Iterative with two matrix rows.
-
-    Christopher P. Matthews
-    christophermatthews1985@gmail.com
-    Sacramento, CA, USA
-    https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Levenshtein_distance#Python
-    '''
-    if s == t: return 0
-    elif len(s) == 0: return len(t)
-    elif len(t) == 0: return len(s)
-    v0 = [None] * (len(t) + 1)
-    v1 = [None] * (len(t) + 1)
-    for i in range(len(v0)):
-        v0[i] = i
-    for i in range(len(s)):
-        v1[0] = i + 1
-        for j in range(len(t)):
-            cost = 0 if s[i] == t[j] else 1
-            v1[j + 1] = min(v1[j] + 1, v0[j + 1] + 1, v0[j] + cost)
-        for j in range(len(v0)):
-            v0[j] = v1[j]
-
-    return v1[len(t)]
-
-
 def normalize(s):
     ''' Normalize to a comparable form. '''
     s = s.lower()
@@ -59,12 +35,11 @@ def get_score(v1, v2):
 
     k = kks.convert(normalize(v1))
 
-    min_score = 100
-
-    for romanization in ('hepburn', 'kunrei', 'passport'):
-        v1_norm_romanization = normalize(''.join([x[romanization] for x in k]))
-        romanization_score = levenshtein(v1_norm_romanization, v2_norm)
-        min_score = min(min_score, romanization_score)
+    # v2 is the pattern of every comparison, so its bit masks are built once
+    min_score = min(levenshtein_many(
+        (v2_norm, normalize(''.join([x[romanization] for x in k])))
+        for romanization in ('hepburn', 'kunrei', 'passport')
+    ))
 
     katakana_score = levenshtein(
         v1_norm,
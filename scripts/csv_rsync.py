@@ -8,14 +8,85 @@
 #   Comma-separated rows where the first entry is the relative location of the
 #   source file, and the second entry is the relative location of the
 #   destination file.
+#
+# Rows which copy files between the same source and destination directories,
+# keeping the file name, are grouped into batches of up to --batch-size files,
+# and each batch is transferred by a single rsync (--files-from). Other rows,
+# and rows whose source is a directory, are transferred individually, as
+# "rsync -a SOURCE DEST". When a batch fails, such as with a partial transfer,
+# its rows are retried individually, so that the rows which can be transferred
+# are completed. Up to --workers transfers run concurrently; a failed transfer
+# does not stop the others, but the exit status is 1. Missing destination
+# directories are created, on a remote (host:/path) destination by the remote
+# rsync's shell.
+#
+# With --backend=native, local files are copied in-process instead of by
+# rsync: files whose size and modification time already match are skipped,
+# files on the same filesystem are reflinked (or hard linked, with
+# --hardlink), and other files are copied by the kernel with copy_file_range
+# or sendfile. Directory rows are copied the same way, file by file; other
+# special files, and remote (host:path) locations, always use rsync.
+#
+# With --journal, each completed row is recorded with the size and
+# modification time of its file (unless both locations are remote), and a
+# rerun skips the journaled rows without checking them on the filesystem. Throughput and the estimated time
+# remaining are printed as the run progresses.
+#
+# With --order=locality, the rows are transferred in order of the location of
+# their source files on disk instead of CSV order: by source directory, and
+# within a directory by the physical offset of the file's first extent
+# (FIEMAP), or by inode where that is not available. The directories are
+# ordered by the first of their files. This keeps reads from spinning disks
+# mostly sequential; the files copied are the same. The batches are then
+# transferred one at a time, as concurrent batches would interleave reads
+# across directories. The order within a batch is only kept by
+# --backend=native, as rsync sorts its --files-from list by name.
 
 import csv
+import errno
+import fcntl
 import os
+import shlex
+import shutil
+import stat
+import struct
 import subprocess
-
+import sys
+import threading
+import time
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import PurePath
 
+from journal import Journal
+
+# Default maximum number of files transferred by one rsync
+BATCH_SIZE = 1000
+
+# Default number of concurrent transfers
+WORKERS = 4
+
+BACKENDS = ['rsync', 'native']
+
+# Minimum number of seconds between progress reports
+PROGRESS_INTERVAL = 5
+
+ORDERS = ['csv', 'locality']
+
+# Linux ioctl which maps the extents of a file to physical locations
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap header, requesting one struct fiemap_extent (56 bytes)
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT_SIZE = 56
+
+# Linux ioctl which shares the extents of one file with another (a reflink)
+FICLONE = 0x40049409
+
+# Errors from copy_file_range and sendfile which mean the call is not
+# supported for the files, rather than that the copy failed
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
 
 def process_args() -> Namespace:
     """ Process command line arguments. """
@@ -35,36 +106,505 @@ def process_args() -> Namespace:
                         type=str,
                         help="The CSV file containing the relative source and destionation paths")
 
+    parser.add_argument("-b", "--batch-size",
+                        type=int,
+                        default=BATCH_SIZE,
+                        help=f"Maximum number of files transferred by one rsync (default: {BATCH_SIZE})")
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=WORKERS,
+                        help=f"Number of concurrent transfers (default: {WORKERS})")
+
+    parser.add_argument("-k", "--backend",
+                        choices=BACKENDS,
+                        default='rsync',
+                        help="Transfer files with rsync, or copy local files in-process (default: rsync)")
+
+    parser.add_argument("-l", "--hardlink",
+                        default=False, action='store_true',
+                        help="With --backend=native, hard link files on the same filesystem instead of copying")
+
+    parser.add_argument("-o", "--order",
+                        choices=ORDERS,
+                        default='csv',
+                        help=(
+                            "Transfer the rows in CSV order, or in order of their location on disk, "
+                            "one batch at a time (default: csv)"
+                        ))
+
+    parser.add_argument("-j", "--journal",
+                        type=str,
+                        help="Journal of the completed rows; rows in an existing journal are skipped")
+
     # Process command line arguments
     args = parser.parse_args()
 
     return args
 
 
+class Batch:
+    """ Files transferred from one source directory to one destination directory together. """
+
+    def __init__(self, source_dir, dest_dir):
+        self.source_dir = source_dir
+        self.dest_dir = dest_dir
+        # list of (source file name, destination file name)
+        self.files = []
+
+    def __len__(self):
+        return len(self.files)
+
+    def __str__(self):
+        if len(self.files) == 1:
+            source_name, dest_name = self.files[0]
+            return f"'{PurePath(self.source_dir, source_name)}' to '{PurePath(self.dest_dir, dest_name)}'"
+        return f"{len(self.files)} files from '{self.source_dir}' to '{self.dest_dir}'"
+
+
+def make_batches(rows, source_dir_prefix, dest_dir_prefix, batch_size) -> list:
+    """
+    Group the CSV rows into batches, in the order the directories first occur.
+
+    :param rows: iterable of (source relative path, destination relative path)
+    :param source_dir_prefix: absolute directory prefix for source files
+    :param dest_dir_prefix: absolute directory prefix for destination files
+    :param batch_size: maximum number of files in a batch
+    :return: list of Batch
+    """
+    batches = []
+    open_batches = {}
+    local = not is_remote(source_dir_prefix)
+
+    for source_relative, dest_relative in rows:
+        source_path = PurePath(source_dir_prefix, source_relative)
+        dest_path = PurePath(dest_dir_prefix, dest_relative)
+
+        if source_path.name != dest_path.name or (local and os.path.isdir(source_path)):
+            # renamed files cannot be listed in --files-from, and directories
+            # are copied as a whole
+            batch = Batch(str(source_path.parent), str(dest_path.parent))
+            batch.files.append((source_path.name, dest_path.name))
+            batches.append(batch)
+            continue
+
+        key = (str(source_path.parent), str(dest_path.parent))
+        batch = open_batches.get(key)
+        if batch is None or len(batch) >= batch_size:
+            batch = Batch(*key)
+            open_batches[key] = batch
+            batches.append(batch)
+        batch.files.append((source_path.name, dest_path.name))
+
+    return batches
+
+
+def physical_offset(path):
+    """ Physical offset of the first extent of a file, from the FIEMAP ioctl, or None. """
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT_SIZE))
+    try:
+        with open(path, mode='rb') as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    # fe_logical, then fe_physical
+    return struct.unpack_from('=Q', request, FIEMAP_HEADER.size + 8)[0]
+
+
+def locality_key(path) -> tuple:
+    """ Sort key for the location of a file within its directory: physical offset, else inode. """
+    offset = physical_offset(path)
+    if offset is not None:
+        return 0, offset
+    try:
+        return 1, os.stat(path).st_ino
+    except OSError:
+        return 2, 0
+
+
+def order_by_locality(rows, source_dir_prefix, workers) -> list:
+    """
+    Reorder the CSV rows by the location of their source files on disk.
+
+    :param rows: list of (source relative path, destination relative path)
+    :param source_dir_prefix: absolute directory prefix for source files
+    :param workers: number of threads looking up the file locations
+    :return: list of rows
+    """
+    paths = [str(PurePath(source_dir_prefix, source_relative)) for source_relative, _ in rows]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        keys = list(executor.map(locality_key, paths))
+
+    directory_keys = {}
+    for path, key in zip(paths, keys):
+        directory = os.path.dirname(path)
+        if directory not in directory_keys or key < directory_keys[directory]:
+            directory_keys[directory] = key
+
+    def sort_key(index):
+        directory = os.path.dirname(paths[index])
+        return directory_keys[directory], directory, keys[index]
+
+    return [rows[index] for index in sorted(range(len(rows)), key=sort_key)]
+
+
+def rsync(batch: Batch) -> subprocess.CompletedProcess:
+    """ Transfer a batch with a single rsync process. """
+    options = ['-a']
+    if is_remote(batch.dest_dir):
+        host, _, dest_dir = batch.dest_dir.partition(':')
+        if not dest_dir.startswith(':'):
+            # create the remote directory before the remote rsync starts; an
+            # rsync daemon (host::module) creates it itself
+            options.append(f'--rsync-path=mkdir -p {shlex.quote(dest_dir)} && rsync')
+    else:
+        os.makedirs(batch.dest_dir, exist_ok=True)
+
+    if len(batch) == 1:
+        source_name, dest_name = batch.files[0]
+        command = ['rsync', *options,
+                   str(PurePath(batch.source_dir, source_name)), str(PurePath(batch.dest_dir, dest_name))]
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    # -a does not imply -r with --files-from
+    command = ['rsync', *options, '-r', '--files-from=-', batch.source_dir + '/', batch.dest_dir + '/']
+    return subprocess.run(command, input='\n'.join(name for name, _ in batch.files) + '\n',
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def is_remote(path) -> bool:
+    """ Check for an rsync remote location, such as host:/path. """
+    head = str(path).split('/', 1)[0]
+    return ':' in head
+
+
+def file_details(path) -> tuple:
+    """ Size and modification time of a local file; (None, None) for a remote or missing file. """
+    if is_remote(path):
+        return None, None
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None, None
+    return file_stat.st_size, file_stat.st_mtime
+
+
+def is_current(source_stat, dest_path) -> bool:
+    """ Check whether the destination already has the size and modification time of the source. """
+    try:
+        dest_stat = os.stat(dest_path)
+    except FileNotFoundError:
+        return False
+    return dest_stat.st_size == source_stat.st_size and int(dest_stat.st_mtime) == int(source_stat.st_mtime)
+
+
+def copy_data(source, dest, size) -> None:
+    """
+    Copy the contents of one open file to another, in the kernel if possible:
+    copy_file_range, then sendfile, then a buffered copy.
+    """
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(source.fileno(), dest.fileno(), size - offset, offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError) as e:
+        if offset or (isinstance(e, OSError) and e.errno not in UNSUPPORTED_ERRNOS):
+            raise
+
+    try:
+        while offset < size:
+            sent = os.sendfile(dest.fileno(), source.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return
+    except OSError as e:
+        if offset or e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+
+    shutil.copyfileobj(source, dest)
+
+
+def copy_file(source_path, dest_path, hardlink=False, source_stat=None) -> str:
+    """
+    Copy a local file, replacing the destination atomically.
+
+    :return: 'skipped', 'linked', 'reflinked' or 'copied'
+    """
+    if source_stat is None:
+        source_stat = os.stat(source_path)
+    if is_current(source_stat, dest_path):
+        return 'skipped'
+
+    dest_dir = os.path.dirname(dest_path)
+    same_filesystem = os.stat(dest_dir).st_dev == source_stat.st_dev
+    tmp_path = os.path.join(dest_dir, f'.{os.path.basename(dest_path)}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    try:
+        if hardlink and same_filesystem:
+            os.link(source_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+            return 'linked'
+
+        with open(source_path, mode='rb') as source, open(tmp_path, mode='xb') as dest:
+            method = 'copied'
+            try:
+                if not same_filesystem:
+                    raise OSError(errno.EXDEV, 'Cross-device reflink')
+                fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+                method = 'reflinked'
+            except OSError:
+                copy_data(source, dest, source_stat.st_size)
+
+        shutil.copystat(source_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return method
+
+    finally:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def copy_tree(source_path, dest_path, hardlink=False) -> None:
+    """
+    Copy a local directory recursively, like rsync -a: files with copy_file(),
+    and symbolic links as links.
+    """
+    os.makedirs(dest_path, exist_ok=True)
+
+    with os.scandir(source_path) as entries:
+        for entry in entries:
+            dest_entry = os.path.join(dest_path, entry.name)
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if os.path.islink(dest_entry) and os.readlink(dest_entry) == target:
+                    continue
+                if os.path.lexists(dest_entry):
+                    os.unlink(dest_entry)
+                os.symlink(target, dest_entry)
+            elif entry.is_dir():
+                copy_tree(entry.path, dest_entry, hardlink)
+            elif entry.is_file():
+                copy_file(entry.path, dest_entry, hardlink, entry.stat())
+            else:
+                raise OSError(f'{entry.path}: not a regular file, directory or symbolic link')
+
+    shutil.copystat(source_path, dest_path)
+
+
+def native(batch: Batch, hardlink=False) -> tuple:
+    """
+    Copy the files of a batch in-process.
+
+    :return: (list of (source name, destination name, size, modification
+             time) of the copied files, list of error messages)
+    """
+    os.makedirs(batch.dest_dir, exist_ok=True)
+
+    completed = []
+    errors = []
+    for source_name, dest_name in batch.files:
+        source_path = os.path.join(batch.source_dir, source_name)
+        dest_path = os.path.join(batch.dest_dir, dest_name)
+        try:
+            source_stat = os.stat(source_path)
+            if stat.S_ISDIR(source_stat.st_mode):
+                copy_tree(source_path, dest_path, hardlink)
+            elif not stat.S_ISREG(source_stat.st_mode):
+                # leave special files to rsync
+                row = Batch(batch.source_dir, batch.dest_dir)
+                row.files.append((source_name, dest_name))
+                result = rsync(row)
+                if result.returncode != 0:
+                    raise OSError(f'rsync exited with status {result.returncode}:\n{result.stdout}')
+            else:
+                copy_file(source_path, dest_path, hardlink, source_stat)
+            completed.append((source_name, dest_name, source_stat.st_size, source_stat.st_mtime))
+        except OSError as e:
+            errors.append(f'{source_path}: {e}')
+    return completed, errors
+
+
+def transfer(batch: Batch, backend='rsync', hardlink=False) -> tuple:
+    """
+    Transfer a batch.
+
+    :return: (batch, list of (source name, destination name, size,
+             modification time) of the transferred files, error message or
+             None); size and modification time are None when the files are
+             only remote
+    """
+    if backend == 'native':
+        completed, errors = native(batch, hardlink)
+        return batch, completed, '\n'.join(errors) if errors else None
+
+    try:
+        result = rsync(batch)
+    except OSError as e:
+        return batch, [], str(e)
+
+    if result.returncode != 0:
+        error = f'rsync exited with status {result.returncode}:\n{result.stdout}'
+        if len(batch) == 1:
+            return batch, [], error
+
+        # retry the rows individually, to complete the ones which can be transferred
+        completed = []
+        errors = []
+        for source_name, dest_name in batch.files:
+            row = Batch(batch.source_dir, batch.dest_dir)
+            row.files.append((source_name, dest_name))
+            _, row_completed, row_error = transfer(row, backend, hardlink)
+            completed.extend(row_completed)
+            if row_error is not None:
+                errors.append(f'{row}: {row_error}')
+        return batch, completed, '\n'.join(errors) if errors else None
+
+    # rsync transferred every row; the destination has the size and
+    # modification time of the source, so whichever is local is used
+    completed = []
+    for source_name, dest_name in batch.files:
+        if is_remote(batch.dest_dir):
+            path = PurePath(batch.source_dir, source_name)
+        else:
+            path = PurePath(batch.dest_dir, dest_name)
+        completed.append((source_name, dest_name, *file_details(path)))
+    return batch, completed, None
+
+
+def row_key(source_path, dest_path) -> str:
+    """ Journal key of a CSV row, from its absolute source and destination paths. """
+    return f'{source_path}\t{dest_path}'
+
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+
+class Progress:
+    """ Counts of the files and bytes transferred, with throughput and ETA. """
+
+    def __init__(self, total_files, interval=PROGRESS_INTERVAL):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.reported = self.start
+
+    def add(self, files, size, failed=0) -> None:
+        """ Count a completed batch, printing the status at most every interval seconds. """
+        self.files += files
+        self.bytes += size
+        self.failed += failed
+
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            print(self.status())
+
+    def rates(self) -> tuple:
+        """ Files per second and megabytes per second so far. """
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return self.files / elapsed, self.bytes / elapsed / 1024 / 1024
+
+    def status(self) -> str:
+        files_rate, mb_rate = self.rates()
+        remaining = self.total_files - self.files - self.failed
+        eta = remaining / files_rate if files_rate else None
+        return (f"{self.files + self.failed}/{self.total_files} files, {files_rate:.1f} files/s, "
+                f"{mb_rate:.1f} MB/s, ETA {format_duration(eta)}")
+
+    def summary(self) -> str:
+        files_rate, mb_rate = self.rates()
+        return (f"Synced {self.files} files ({self.bytes / 1024 / 1024:.1f} MB) in "
+                f"{format_duration(time.monotonic() - self.start)}: {files_rate:.1f} files/s, "
+                f"{mb_rate:.1f} MB/s; {self.failed} files failed")
+
+
 def main(args: Namespace) -> None:
     """Performs the rsync"""
     csv_file = args.input_file
     source_dir_prefix = args.source_dir_prefix
     dest_dir_prefix = args.dest_dir_prefix
 
+    journal = Journal(args.journal, fsync=False) if args.journal else None
+
     with open(csv_file, mode='r', encoding='UTF-8') as infile:
         reader = csv.reader(infile)
         next(reader)  # skip header row
 
+        rows = []
+        journaled = 0
         for row in reader:
-            source_relative = row[0]
-            dest_relative = row[1]
+            if journal is not None and \
+                    row_key(PurePath(source_dir_prefix, row[0]), PurePath(dest_dir_prefix, row[1])) in journal:
+                journaled += 1
+                continue
+            rows.append((row[0], row[1]))
+
+    backend = args.backend
+    if backend == 'native' and (is_remote(source_dir_prefix) or is_remote(dest_dir_prefix)):
+        print("Remote location; using rsync instead of the native backend")
+        backend = 'rsync'
+
+    workers = args.workers
+    if args.order == 'locality' and not is_remote(source_dir_prefix):
+        rows = order_by_locality(rows, source_dir_prefix, args.workers)
+
+        # concurrent transfers would interleave the reads again
+        workers = 1
+        if backend != 'native':
+            print("rsync sorts the files of each batch by name; use --backend=native to copy them in disk order")
+
+    batches = make_batches(rows, source_dir_prefix, dest_dir_prefix, args.batch_size)
+
+    if journaled:
+        print(f"Skipping {journaled} files completed in journal {args.journal}")
+    print(f"Syncing {len(rows)} files in {len(batches)} batches")
+
+    progress = Progress(len(rows))
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(transfer, batch, backend, args.hardlink) for batch in batches]
+            for future in as_completed(futures):
+                batch, completed, error = future.result()
+
+                size = 0
+                for source_name, dest_name, file_size, mtime in completed:
+                    size += file_size or 0
+                    if journal is not None:
+                        journal.record(row_key(PurePath(batch.source_dir, source_name),
+                                               PurePath(batch.dest_dir, dest_name)),
+                                       size=file_size, mtime=mtime)
 
-            absolute_source_path_with_filename = PurePath(source_dir_prefix, source_relative)
-            absolute_dest_path_with_filename = PurePath(dest_dir_prefix, dest_relative)
+                if error is not None:
+                    failed.append(batch)
+                    print(f"Failed to sync {batch}: {error}", file=sys.stderr)
 
-            absolute_dest_path = os.path.dirname(absolute_dest_path_with_filename)
-            if not os.path.isdir(absolute_dest_path):
-                os.makedirs(absolute_dest_path)
+                progress.add(len(completed), size, len(batch) - len(completed))
+    finally:
+        if journal is not None:
+            journal.close()
 
-            print("----")
-            print(f"Syncing '{absolute_source_path_with_filename}' to '{absolute_dest_path_with_filename}'")
-            subprocess.call(["rsync", '-avr', absolute_source_path_with_filename, absolute_dest_path_with_filename])
+    print(progress.summary())
+    if failed:
+        print(f"{len(failed)} of {len(batches)} batches failed")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,74 +1,443 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import math
+import os
+import shutil
 import sys
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
-# Get list of duplicate pids
+from catalog import connect
+from compressed import open_file
+from journal import Journal
 
-dups = {}
+# Usage: duplicates.py PIDS [INFILE]
+#        duplicates.py --find=INFILE
+#        duplicates.py --catalog=CATALOG [PIDS]
+#
+# PIDS is a file listing the duplicate pids; the JSON records are read from
+# INFILE, stdin, or a sqlite catalog built by catalog.py (--catalog). Either
+# file may be compressed. Without a PIDS file, the duplicate pids are found
+# in INFILE (--find) with a Bloom filter pass followed by an exact pass over
+# the candidates, or in the catalog.
+#
+# Prints the mv commands which replace the fcrepo.lib.umd.edu copy of each
+# duplicate UMAM FOXML file with the local.fedora.server copy. With --execute,
+# the moves are applied by a pool of --workers threads, and each move is
+# recorded in an append-only --journal before and after it is made, so that a
+# rerun skips the completed moves after checking that they are still in place,
+# and finishes a move interrupted after the file was moved. --dry-run
+# reports the moves and the I/O volume they would need, without moving files.
 
-with open(sys.argv[1], 'r') as pids:
-    for pid in pids:
-        dups[pid.strip()] = []
 
-print(f'Looking for {len(dups)} duplicate pids', file=sys.stderr)
+# Default number of records expected by --find, used to size the Bloom filter
+EXPECTED_RECORDS = 10000000
 
-# Read JSON records, looking for matching pids
-# Store their FOXML location and image location
-for line in sys.stdin:
+# Default false positive rate of the Bloom filter
+FALSE_POSITIVE_RATE = 0.01
 
+# Default number of concurrent moves for --execute
+WORKERS = 8
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser()
+
+    parser.add_argument("pids", nargs='?',
+                        type=str,
+                        help="File listing the duplicate pids")
+
+    parser.add_argument("infile", nargs='?', default='-',
+                        type=str,
+                        help="JSON input file (default: stdin)")
+
+    parser.add_argument("-g", "--catalog",
+                        type=str,
+                        help="sqlite catalog built by catalog.py, used instead of the JSON input")
+
+    parser.add_argument("-f", "--find",
+                        type=str,
+                        help="JSON input file to find the duplicate pids in, instead of a PIDS file")
+
+    parser.add_argument("-n", "--expected-records",
+                        type=int,
+                        default=EXPECTED_RECORDS,
+                        help=f"Number of records expected by --find (default: {EXPECTED_RECORDS})")
+
+    parser.add_argument("-x", "--execute",
+                        default=False, action='store_true',
+                        help="Apply the moves instead of printing the mv commands")
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=WORKERS,
+                        help=f"Number of concurrent moves for --execute (default: {WORKERS})")
+
+    parser.add_argument("-j", "--journal",
+                        type=str,
+                        help="Journal of completed moves for --execute, used to resume an interrupted run")
+
+    parser.add_argument("-d", "--dry-run",
+                        default=False, action='store_true',
+                        help="With --execute, report the planned moves and I/O volume without moving files")
+
+    # Process command line arguments
+    args = parser.parse_args()
+
+    if not (args.pids or args.find or args.catalog):
+        parser.error('a PIDS file, --find or --catalog is required')
+
+    if args.find and args.pids:
+        parser.error('--find cannot be used with a PIDS file')
+
+    if args.execute and not (args.journal or args.dry_run):
+        parser.error('--execute requires --journal (or --dry-run)')
+
+    return args
+
+
+class BloomFilter:
+    """ Set membership test with no false negatives and bounded memory. """
+
+    def __init__(self, expected, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.size = max(8, int(-expected * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / expected * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """ Add a key; returns True if the key was possibly already present. """
+        present = True
+        for position in self.positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                present = False
+                self.bits[byte] |= 1 << bit
+        return present
+
+
+def find_duplicates(infile_path, expected):
+    """
+    Find the pids which occur in more than one record, in two passes:
+
+    1. Add each pid to a Bloom filter; pids possibly seen before are
+       candidates
+    2. Count the records of each candidate exactly, and collect their
+       locations
+
+    Memory is bounded by the Bloom filter and the candidates.
+
+    :return: dictionary of duplicate pid => locations, as from add_location()
+    """
+    seen = BloomFilter(expected)
+    candidates = {}
+
+    with open_file(infile_path) as infile:
+        for line in infile:
+            try:
+                pid = json.loads(line)['pid']
+            except Exception as e:
+                print(f'{type(e)}: {e}')
+                print(line)
+                continue
+
+            if seen.add(pid):
+                candidates[pid] = 0
+
+    print(f'Verifying {len(candidates)} candidate duplicate pids', file=sys.stderr)
+
+    locations = {pid: [] for pid in candidates}
+
+    with open_file(infile_path) as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+                pid = record['pid']
+            except Exception:
+                # already reported by the first pass
+                continue
+
+            if pid in candidates:
+                candidates[pid] += 1
+
+                try:
+                    add_location(locations, record)
+
+                except Exception as e:
+                    print(f'{type(e)}: {e}')
+                    print(line)
+
+    return {pid: locations[pid] for pid, count in candidates.items() if count > 1}
+
+
+def catalog_duplicates(catalog_path):
+    """ Find the pids which occur in more than one record of the catalog. """
+    conn = connect(catalog_path)
     try:
-        record = json.loads(line)
+        return {
+            pid: [] for pid, in conn.execute(
+                'SELECT pid FROM objects GROUP BY pid HAVING COUNT(*) > 1 ORDER BY MIN(id)'
+            )
+        }
+    finally:
+        conn.close()
 
-        pid = record['pid']
 
-        if pid in dups:
-            foxml = record['foxml']
+def load_pids(pids_path):
+    """ Get list of duplicate pids. """
+    dups = {}
 
-            if 'ds' in record:
-                ds = record['ds']
+    with open_file(pids_path) as pids:
+        for pid in pids:
+            dups[pid.strip()] = []
 
-                if 'image' in ds:
-                    image = ds['image']
-                    dups[pid].append(('umam', foxml, image['location']))
-                elif 'umdm' in ds:
-                    umdm = ds['umdm']
-                    dups[pid].append(('umdm', foxml, umdm['umdm_title']))
+    print(f'Looking for {len(dups)} duplicate pids', file=sys.stderr)
 
-    except Exception as e:
-        print(f'{type(e)}: {e}')
-        print(line)
+    return dups
 
-# Read through the pids
-for pid, foxml_list in dups.items():
-    if len(foxml_list) != 2:
-        print(f"pid {pid} does not have 2 entries: {foxml_list}", file=sys.stderr)
-    else:
-        # if type == 'umdm':
-        #     for type, foxml, text in foxml_list:
-        #         print(type, pid, foxml, text)
-
-        if foxml_list[0][0] == 'umam':
-            local_url = None
-            local_foxml = None
-            fcrepo_url = None
-            fcrepo_foxml = None
-
-            for type, foxml, location in foxml_list:
-                url = urlparse(location)
-                if url.hostname == 'fcrepo.lib.umd.edu':
-                    fcrepo_url = url
-                    fcrepo_foxml = foxml
-                elif url.hostname == 'local.fedora.server':
-                    local_url = url
-                    local_foxml = foxml
+
+def add_location(dups, record):
+    """ Store the FOXML location and image location of a duplicate pid record. """
+    pid = record['pid']
+
+    if pid in dups:
+        foxml = record['foxml']
+
+        if 'ds' in record:
+            ds = record['ds']
+
+            if 'image' in ds:
+                image = ds['image']
+                dups[pid].append(('umam', foxml, image['location']))
+            elif 'umdm' in ds:
+                umdm = ds['umdm']
+                dups[pid].append(('umdm', foxml, umdm['umdm_title']))
+
+
+def scan(infile, dups):
+    """ Read JSON records, looking for matching pids. """
+    for line in infile:
+
+        try:
+            add_location(dups, json.loads(line))
+
+        except Exception as e:
+            print(f'{type(e)}: {e}')
+            print(line)
+
+
+def query_catalog(catalog_path, dups):
+    """ Look up the matching pids in the catalog, in input order. """
+    conn = connect(catalog_path)
+    try:
+        for pid in dups:
+            for record, in conn.execute('SELECT record FROM objects WHERE pid = ? ORDER BY id', (pid,)):
+                try:
+                    add_location(dups, json.loads(record))
+
+                except Exception as e:
+                    print(f'{type(e)}: {e}')
+                    print(record)
+    finally:
+        conn.close()
+
+
+def plan_moves(dups):
+    """
+    Read through the pids, and find the moves for the duplicate UMAM.
+
+    :return: generator of (source, destination) FOXML paths; the source is
+             the fcrepo.lib.umd.edu copy, which replaces the
+             local.fedora.server copy
+    """
+    for pid, foxml_list in dups.items():
+        if len(foxml_list) != 2:
+            print(f"pid {pid} does not have 2 entries: {foxml_list}", file=sys.stderr)
+        else:
+            # if type == 'umdm':
+            #     for type, foxml, text in foxml_list:
+            #         print(type, pid, foxml, text)
+
+            if foxml_list[0][0] == 'umam':
+                local_url = None
+                local_foxml = None
+                fcrepo_url = None
+                fcrepo_foxml = None
+
+                for type, foxml, location in foxml_list:
+                    url = urlparse(location)
+                    if url.hostname == 'fcrepo.lib.umd.edu':
+                        fcrepo_url = url
+                        fcrepo_foxml = foxml
+                    elif url.hostname == 'local.fedora.server':
+                        local_url = url
+                        local_foxml = foxml
+                    else:
+                        raise Exception(f"Unexpected URL {url.hostname=} for {pid=}, {foxml=}")
+
+                if local_url is None:
+                    raise Exception(f"Missing local_url for {pid=}")
+                elif fcrepo_url is None:
+                    raise Exception(f"Missing fcrepo_url for {pid=}")
                 else:
-                    raise Exception(f"Unexpected URL {url.hostname=} for {pid=}, {foxml=}")
-
-            if local_url is None:
-                raise Exception(f"Missing local_url for {pid=}")
-            elif fcrepo_url is None:
-                raise Exception(f"Missing fcrepo_url for {pid=}")
-            else:
-                print(f"mv {fcrepo_foxml} {local_foxml}")
+                    yield fcrepo_foxml, local_foxml
+
+
+def resolve(dups):
+    """ Print the moves for the duplicate UMAM. """
+    for source, destination in plan_moves(dups):
+        print(f"mv {source} {destination}")
+
+
+def verify_move(source, destination, size) -> bool:
+    """ Check that a completed move is in place: the source is gone and the destination has its size. """
+    return not os.path.exists(source) and os.path.isfile(destination) and os.path.getsize(destination) == size
+
+
+def is_completed(journal, source) -> bool:
+    """ Check whether a move is recorded as completed in the journal. """
+    entry = journal.get(source)
+    return entry is not None and entry.get('done', True)
+
+
+def plan_io(moves, journal=None) -> dict:
+    """
+    Tally the I/O needed for a list of moves. A move within a filesystem is a
+    rename; a move across filesystems copies the file.
+
+    :param moves: list of (source, destination)
+    :param journal: Journal of completed moves, which are not counted
+    :return: dictionary of counts and bytes
+    """
+    totals = {'moves': 0, 'completed': 0, 'missing': 0, 'bytes': 0, 'copy_bytes': 0}
+    for source, destination in moves:
+        if journal is not None and is_completed(journal, source):
+            totals['completed'] += 1
+            continue
+
+        try:
+            stat = os.stat(source)
+        except OSError:
+            totals['missing'] += 1
+            continue
+
+        totals['moves'] += 1
+        totals['bytes'] += stat.st_size
+        destination_dir = os.path.dirname(os.path.abspath(destination))
+        if not os.path.isdir(destination_dir) or os.stat(destination_dir).st_dev != stat.st_dev:
+            totals['copy_bytes'] += stat.st_size
+
+    return totals
+
+
+def execute_move(source, destination, journal) -> str:
+    """
+    Apply one move. The move is recorded in the journal before it is made,
+    and recorded as done once it is verified, so that a move interrupted
+    after the file was moved is recognized on the next run.
+
+    :return: 'moved', 'skipped' (already done) or 'failed'
+    """
+    entry = journal.get(source)
+    if entry is not None:
+        if verify_move(source, destination, entry['size']):
+            if not entry.get('done', True):
+                journal.record(source, destination=destination, size=entry['size'], done=True)
+            return 'skipped'
+        if entry.get('done', True):
+            print(f'Journaled move {source} -> {destination} is not in place', file=sys.stderr)
+            return 'failed'
+        # the interrupted move had not been made; make it again
+
+    try:
+        size = os.path.getsize(source)
+        if not os.path.isfile(destination):
+            print(f'Missing destination {destination} for {source}', file=sys.stderr)
+            return 'failed'
+
+        journal.record(source, destination=destination, size=size, done=False)
+        shutil.move(source, destination)
+
+    except OSError as e:
+        print(f'Unable to move {source} -> {destination}: {e}', file=sys.stderr)
+        return 'failed'
+
+    if not verify_move(source, destination, size):
+        print(f'Move {source} -> {destination} did not verify', file=sys.stderr)
+        return 'failed'
+
+    journal.record(source, destination=destination, size=size, done=True)
+    return 'moved'
+
+
+def execute(dups, args: Namespace) -> int:
+    """
+    Apply the moves for the duplicate UMAM with a pool of worker threads.
+
+    :return: number of failed moves
+    """
+    moves = list(plan_moves(dups))
+
+    if args.dry_run:
+        journal = Journal(args.journal) if args.journal else None
+        try:
+            totals = plan_io(moves, journal)
+        finally:
+            if journal is not None:
+                journal.close()
+
+        for source, destination in moves:
+            if journal is None or not is_completed(journal, source):
+                print(f"mv {source} {destination}")
+        print(f"{totals['moves']} moves of {totals['bytes']} bytes planned, "
+              f"{totals['copy_bytes']} bytes copied across filesystems; "
+              f"{totals['completed']} already completed, {totals['missing']} sources missing", file=sys.stderr)
+        return 0
+
+    counts = {'moved': 0, 'skipped': 0, 'failed': 0}
+    with Journal(args.journal) as journal, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for result in executor.map(lambda move: execute_move(*move, journal), moves):
+            counts[result] += 1
+
+    print(f"Moved {counts['moved']}, skipped {counts['skipped']} completed, "
+          f"{counts['failed']} failed", file=sys.stderr)
+    return counts['failed']
+
+
+def main(args: Namespace) -> None:
+    if args.pids:
+        dups = load_pids(args.pids)
+    elif args.catalog:
+        dups = catalog_duplicates(args.catalog)
+        print(f'Found {len(dups)} duplicate pids', file=sys.stderr)
+    else:
+        dups = find_duplicates(args.find, args.expected_records)
+        print(f'Found {len(dups)} duplicate pids', file=sys.stderr)
+
+    if args.catalog:
+        query_catalog(args.catalog, dups)
+    elif not args.find:
+        # the locations are collected while finding the duplicates
+        with open_file(args.infile) as infile:
+            scan(infile, dups)
+
+    if args.execute:
+        if execute(dups, args):
+            sys.exit(1)
+    else:
+        resolve(dups)
+
+
+if __name__ == '__main__':
+    main(process_args())
@@ -0,0 +1,97 @@
+# Levenshtein edit distance, shared by the creator-jpn scripts for comparing
+# romanized and katakana forms of creator names.
+#
+# Distances are computed with the bit-parallel algorithm of Myers (1999), in
+# the formulation of Hyyrö (2001): one column of the dynamic programming
+# matrix is kept as bit vectors of vertical deltas, and is advanced by one
+# character of the text with a handful of integer operations. Python integers
+# are unbounded, so patterns are not limited to the machine word length.
+
+
+def pattern_masks(pattern) -> dict:
+    """ Map each character of the pattern to the bit mask of its positions. """
+    masks = {}
+    for i, c in enumerate(pattern):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def bounded_distance(masks, m, text, max_distance=None) -> int:
+    """
+    Edit distance between a pattern and a text.
+
+    :param masks: pattern_masks() of the pattern
+    :param m: length of the pattern
+    :param text: text to compare against the pattern
+    :param max_distance: stop once the distance is known to exceed this
+    :return: the distance, or max_distance + 1 if it exceeds max_distance
+    """
+    n = len(text)
+    if max_distance is not None and abs(m - n) > max_distance:
+        return max_distance + 1
+    if m == 0:
+        return n
+
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+
+    for j, c in enumerate(text, 1):
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+
+        # each remaining character of the text lowers the score by at most one
+        if max_distance is not None and score - (n - j) > max_distance:
+            return max_distance + 1
+
+    return score
+
+
+def levenshtein(s, t, max_distance=None) -> int:
+    """
+    Levenshtein distance between two strings.
+
+    :param max_distance: stop once the distance is known to exceed this
+    :return: the distance, or max_distance + 1 if it exceeds max_distance
+    """
+    if s == t:
+        return 0
+    return bounded_distance(pattern_masks(s), len(s), t, max_distance)
+
+
+def levenshtein_many(pairs, max_distance=None) -> list:
+    """
+    Levenshtein distances of many (s, t) pairs. The masks of each distinct s
+    are built once, so comparing one string against several candidates only
+    pays for the comparisons.
+
+    :param pairs: iterable of (s, t) string pairs
+    :param max_distance: stop once a distance is known to exceed this
+    :return: list of distances, in the order of the pairs; distances that
+             exceed max_distance are returned as max_distance + 1
+    """
+    masks = {}
+    distances = []
+    for s, t in pairs:
+        if s == t:
+            distances.append(0)
+            continue
+        if s not in masks:
+            masks[s] = pattern_masks(s)
+        distances.append(bounded_distance(masks[s], len(s), t, max_distance))
+    return distances
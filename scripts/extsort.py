@@ -0,0 +1,167 @@
+import heapq
+import json
+from operator import itemgetter
+from tempfile import TemporaryFile
+
+# External (on-disk) merge sort of (key, value) pairs, for sorting and joining
+# data sets which do not fit in memory.
+#
+# Items are buffered in memory until the buffer reaches the memory budget,
+# then sorted and spilled to a temporary run file. Iterating the sorter merges
+# the run files with the remaining buffer. Keys and values must be JSON
+# serializable; tuple keys are stored as lists.
+
+# Default memory budget for buffered items, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Maximum number of run files merged at once
+MAX_MERGE_FILES = 64
+
+
+class ExternalSorter:
+    """
+    Sort (key, value) pairs using bounded memory. The sort is stable: items
+    with equal keys are returned in the order they were added.::
+
+        sorter = ExternalSorter(memory_budget=64 * 1024 * 1024)
+        for record in records:
+            sorter.add(record['pid'], record)
+        for pid, record in sorter:
+            ...
+        sorter.close()
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key, value=None):
+        """ Add a (key, value) pair, spilling to disk if over the memory budget. """
+        if isinstance(key, tuple):
+            key = list(key)
+
+        line = json.dumps([key, value], separators=(',', ':'))
+        self.buffer.append((key, line))
+        self.buffer_size += len(line)
+        self.count += 1
+
+        if self.buffer_size >= self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """ Sort the buffer and write it to a new run file. """
+        if not self.buffer:
+            return
+
+        run = TemporaryFile(mode='w+', encoding='UTF-8')
+        self.buffer.sort(key=itemgetter(0))
+        for _, line in self.buffer:
+            run.write(line)
+            run.write('\n')
+
+        self.runs.append(run)
+        self.buffer = []
+        self.buffer_size = 0
+
+        if len(self.runs) >= MAX_MERGE_FILES:
+            self.compact()
+
+    def compact(self):
+        """ Merge all of the run files into a single run file. """
+        merged = TemporaryFile(mode='w+', encoding='UTF-8')
+        for item in heapq.merge(*(read_run(run) for run in self.runs), key=itemgetter(0)):
+            merged.write(json.dumps(item, separators=(',', ':')))
+            merged.write('\n')
+
+        for run in self.runs:
+            run.close()
+        self.runs = [merged]
+
+    def __iter__(self):
+        """ Iterate over all (key, value) pairs in sorted order. """
+        self.buffer.sort(key=itemgetter(0))
+        in_memory = ((key, json.loads(line)[1]) for key, line in self.buffer)
+
+        if not self.runs:
+            return in_memory
+
+        # The in-memory buffer holds the most recently added items, so it is
+        # merged last to keep the sort stable
+        return heapq.merge(*(read_run(run) for run in self.runs), in_memory, key=itemgetter(0))
+
+    def close(self):
+        """ Remove the run files. """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+        self.buffer_size = 0
+
+
+def read_run(run):
+    """ Generate the (key, value) pairs from a run file. """
+    run.seek(0)
+    for line in run:
+        key, value = json.loads(line)
+        yield key, value
+
+
+def group_by_key(items):
+    """
+    Group consecutive sorted (key, value) pairs by key.
+
+    :param items: iterable of (key, value) pairs, sorted by key
+    :return: generator of (key, [values])
+    """
+    key = None
+    values = []
+    for item_key, value in items:
+        if values and item_key != key:
+            yield key, values
+            values = []
+        key = item_key
+        values.append(value)
+
+    if values:
+        yield key, values
+
+
+def merge_join(left, right):
+    """
+    Full outer join of two iterables of (key, value) pairs, each sorted by
+    key with unique keys.
+
+    :param left: iterable of (key, value) pairs
+    :param right: iterable of (key, value) pairs
+    :return: generator of (key, left value, right value); the value from a
+             side without the key is None
+    """
+    missing = object()
+    left = iter(left)
+    right = iter(right)
+    left_key, left_value = next(left, (missing, None))
+    right_key, right_value = next(right, (missing, None))
+
+    while left_key is not missing or right_key is not missing:
+        if right_key is missing or (left_key is not missing and left_key < right_key):
+            yield left_key, left_value, None
+            left_key, left_value = next(left, (missing, None))
+        elif left_key is missing or right_key < left_key:
+            yield right_key, None, right_value
+            right_key, right_value = next(right, (missing, None))
+        else:
+            yield left_key, left_value, right_value
+            left_key, left_value = next(left, (missing, None))
+            right_key, right_value = next(right, (missing, None))
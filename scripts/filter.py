@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import logging
-import random
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser, Namespace
+from contextlib import ExitStack
 from tempfile import TemporaryFile
 from xml.etree import ElementTree
 import dbm
 
 import requests
 
+from catalog import connect
+from compressed import FileType, open_file
+from extsort import ExternalSorter, group_by_key
+
 # Filter Fedora objects in json info format
 #
 # Input - json info file with flat list of all objects
@@ -17,9 +22,38 @@ import requests
 # Output - json info file which is filtered for matching UMDM objects and
 #          their hasPart UMAM objects listed under the 'hasPart' key in the
 #          UMDM object
+#
+# Multiple outputs can be produced from a single pass through the input file
+# by providing a JSON spec file (--spec) listing named filters, for example:
+#
+#   [
+#     {"name": "worlds-fair", "outfile": "export/worlds-fair.json",
+#      "collection": "umd:2", "status": "Complete,Pending"},
+#     {"name": "films", "outfile": "export/films.json",
+#      "collection": ["umd:1158"], "type": ["UMD_VIDEO"]}
+#   ]
+#
+# Each filter accepts the same keys as the command line filter options
+# (collection, status, type, random, seed) and the output projection (fields);
+# list values may be given as comma-separated strings. Missing keys use the
+# command line defaults.
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+# Command line options which are also accepted in the --spec file entries
+FILTER_OPTIONS = ('collection', 'status', 'type', 'random', 'seed', 'fields')
+
+# Filter options which take a comma-separated list
+LIST_OPTIONS = ('collection', 'status', 'type', 'fields')
+
+# Keys consumed by the export (MigratorFedora2Export) and conversion
+# (archelon.py, archelon_sample.py) steps, selected by --fields=export
+EXPORT_FIELDS = [
+    'pid', 'foxml', 'title', 'handle',
+    'ds.doInfo.type', 'ds.doInfo.status', 'ds.rels-mets.rels.isMemberOfCollection',
+    'hasPart.pid', 'hasPart.foxml',
+]
+
 
 class DelimitedList:
     def __init__(self, delimiter=','):
@@ -35,13 +69,28 @@ def process_args():
     # Setup command line arguments
     parser = ArgumentParser()
 
-    parser.add_argument("-i", "--infile", required=True,
+    inputs = parser.add_mutually_exclusive_group(required=True)
+
+    inputs.add_argument("-i", "--infile",
                         type=FileType(mode='r', encoding='UTF-8'),
                         help="JSON input file")
 
-    parser.add_argument("-o", "--outfile", required=True,
-                        type=FileType(mode='w', encoding='UTF-8'),
-                        help="JSON output file")
+    inputs.add_argument("-g", "--catalog",
+                        type=str,
+                        help="sqlite catalog built from the JSON input file by catalog.py")
+
+    outputs = parser.add_mutually_exclusive_group(required=True)
+
+    outputs.add_argument("-o", "--outfile",
+                         type=FileType(mode='w', encoding='UTF-8'),
+                         help="JSON output file")
+
+    outputs.add_argument("-p", "--spec",
+                         type=FileType(mode='r', encoding='UTF-8'),
+                         help=(
+                             "JSON spec file listing named filters and their "
+                             "output files, all evaluated in a single pass"
+                         ))
 
     parser.add_argument("-c", "--collection",
                         type=DelimitedList(),
@@ -65,16 +114,112 @@ def process_args():
                         type=int,
                         default=0,
                         help=(
-                            "Pseudo-randomly select records at a rate of 1 out of RANDOM"
-                            "(default: every record)"
+                            "Pseudo-randomly select records at a rate of 1 out of RANDOM, "
+                            "based on a hash of the pid (default: every record)"
                         ))
 
+    parser.add_argument("-e", "--seed",
+                        type=str,
+                        default='0',
+                        help="Seed for the --random selection (default: 0)")
+
     parser.add_argument("-a", "--handles",
                         type=str,
                         help="Cache of (pid, handle) pairs")
 
+    parser.add_argument("-f", "--fields",
+                        type=DelimitedList(),
+                        default=[],
+                        help=(
+                            "Comma-separated list of dotted key paths to include "
+                            "in the output, such as pid,ds.doInfo.status,hasPart.pid; "
+                            "'export' selects the keys used by the export and "
+                            "conversion steps (default: all keys)"
+                        ))
+
+    parser.add_argument("-m", "--memory-budget",
+                        type=int,
+                        help=(
+                            "Join UMDM and UMAM objects using sorted temporary "
+                            "files, keeping at most MEMORY_BUDGET megabytes of "
+                            "records in memory (default: join in memory)"
+                        ))
+
     # Process command line arguments
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    # Defaults for the filter options, used to fill in the spec file entries
+    args.filter_defaults = {
+        key: parser.get_default(key) for key in FILTER_OPTIONS
+    }
+
+    return args
+
+
+class Output:
+    """ A named set of filters and the file the matching objects are written to. """
+
+    def __init__(self, name, outfile, options):
+        self.name = name
+        self.outfile = outfile
+        self.options = options
+        self.filters = setup_filters(options)
+        self.projection = setup_projection(options.fields)
+
+        # matching UMDM objects, in input order
+        self.umdm = []
+        self.count = 0
+
+    def matches(self, obj):
+        return all(check(obj) for check in self.filters)
+
+    def write(self, obj):
+        if self.projection:
+            obj = project(obj, self.projection)
+        self.outfile.write(json.dumps(obj, separators=(',', ':')))
+        self.outfile.write("\n")
+
+
+def setup_outputs(args, stack: ExitStack):
+    """
+    Create the list of outputs to write, either the single --outfile using the
+    command line filters, or one output per entry in the --spec file.
+
+    :param args: Command-line arguments to this script
+    :param stack: ExitStack which closes the output files
+    :return: List of Output
+    """
+    if not args.spec:
+        stack.enter_context(args.outfile)
+        return [Output(args.outfile.name, args.outfile, args)]
+
+    outputs = []
+    with args.spec:
+        spec = json.load(args.spec)
+
+    for i, entry in enumerate(spec):
+        name = entry.get('name', str(i))
+        if 'outfile' not in entry:
+            raise ValueError(f'Missing "outfile" for filter "{name}" in {args.spec.name}')
+
+        logging.info(f'Output "{name}": {entry["outfile"]}')
+
+        options = Namespace(**args.filter_defaults)
+        for key in FILTER_OPTIONS:
+            if key in entry:
+                value = entry[key]
+                if isinstance(value, str) and key in LIST_OPTIONS:
+                    value = DelimitedList()(value)
+                elif key == 'random':
+                    value = int(value)
+                elif key == 'seed':
+                    value = str(value)
+                setattr(options, key, value)
+
+        outfile = stack.enter_context(open_file(entry['outfile'], mode='w', encoding='UTF-8'))
+        outputs.append(Output(name, outfile, options))
+
+    return outputs
 
 
 def is_umdm(obj):
@@ -89,7 +234,8 @@ def setup_filters(args):
     """
     Create a list of filter functions to run.
 
-    :param args: Command-line arguments to this script
+    :param args: Command-line arguments to this script, or the options for
+                 one entry of the --spec file
     :return: List of functions
     """
     filters = []
@@ -123,19 +269,89 @@ def setup_filters(args):
         filters.append(filter_type)
 
     if args.random:
-        logging.info(f"Filter Random: 1 out of {args.random}")
-
-        random.seed(0)
+        logging.info(f"Filter Random: 1 out of {args.random} (seed {args.seed})")
 
         def filter_random(obj):
-            return random.randrange(args.random) == 0
+            return sample_bucket(obj['pid'], args.seed, args.random) == 0
 
         filters.append(filter_random)
 
-
     return filters
 
 
+def sample_bucket(pid, seed, rate):
+    """
+    Assign a pid to one of RATE buckets using a stable hash of the pid, keyed
+    by the seed. Selecting bucket 0 samples 1 out of RATE pids; the selection
+    does not depend on the order of the records, so the same pid is selected
+    across re-exports and when the input is split into shards.
+
+    :param pid: object pid
+    :param seed: sampling seed
+    :param rate: number of buckets
+    :return: bucket number from 0 to rate - 1
+    """
+    key = str(seed).encode('utf-8')
+    if len(key) > hashlib.blake2b.MAX_KEY_SIZE:
+        # longer seeds cannot be used as a key directly
+        key = hashlib.blake2b(key).digest()
+    digest = hashlib.blake2b(pid.encode('utf-8'), digest_size=8, key=key).digest()
+    return int.from_bytes(digest, 'big') % rate
+
+
+def setup_projection(fields):
+    """
+    Build a projection tree from a list of dotted key paths.::
+
+        setup_projection(['pid', 'ds.doInfo', 'hasPart.pid'])
+            # => {'pid': None, 'ds': {'doInfo': None}, 'hasPart': {'pid': None}}
+
+    A value of None selects the complete value of that key. The name 'export'
+    expands to EXPORT_FIELDS.
+
+    :param fields: list of dotted key paths
+    :return: projection tree, or an empty dict to select everything
+    """
+    fields = [
+        path for field in fields for path in (EXPORT_FIELDS if field == 'export' else [field])
+    ]
+
+    tree = {}
+    for field in fields:
+        *parents, last = field.split('.')
+        node = tree
+        for key in parents:
+            if key in node and node[key] is None:
+                # the complete value of a parent key is already selected
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[last] = None
+
+    if tree:
+        logging.info(f"Output Fields: {fields}")
+
+    return tree
+
+
+def project(obj, tree):
+    """
+    Select the keys of obj given by a projection tree from setup_projection(),
+    keeping the original key order. Lists are projected item by item.
+
+    :param obj: object to project
+    :param tree: projection tree
+    :return: projected copy of obj
+    """
+    if tree is None:
+        return obj
+    if isinstance(obj, list):
+        return [project(item, tree) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    return {key: project(value, tree[key]) for key, value in obj.items() if key in tree}
+
+
 def getitem_chain(obj, *keys, default=None):
     """
     Inspired by the "dig" method in Ruby hashes.::
@@ -212,84 +428,275 @@ def get_handle(args, pid):
     return handle
 
 
-def main(args):
+def catalog_condition(options):
     """
-    Main input/output filter.
+    Build the SQL condition on the catalog objects table which selects the
+    candidate UMDM objects for one set of filter options. The random filter
+    is not included; all filters are still applied to the selected records.
+
+    :param options: Command-line arguments, or the options of a --spec entry
+    :return: tuple of the condition and its parameters
+    """
+    conditions = ['has_doinfo = 1']
+    params = []
+
+    def placeholders(values):
+        params.extend(values)
+        return ', '.join('?' * len(values))
+
+    if options.status:
+        conditions.append(f'do_status IN ({placeholders(options.status)})')
+
+    if options.type:
+        conditions.append(f'do_type IN ({placeholders(options.type)})')
+
+    if options.collection:
+        conditions.append(
+            'id IN (SELECT object_id FROM relationships'
+            " WHERE relationship = 'isMemberOfCollection'"
+            f' AND target_pid IN ({placeholders(options.collection)}))'
+        )
+
+    return ' AND '.join(conditions), params
+
+
+def catalog_records(args, outputs):
+    """
+    Generate the JSON records from the --catalog which can match any of the
+    outputs, in input order: the candidate UMDM objects and the UMAM objects
+    they have as parts. Replaces a full scan of the JSON input file.
+    """
+    conn = connect(args.catalog)
+    try:
+        where = []
+        params = []
+        for output in outputs:
+            condition, condition_params = catalog_condition(output.options)
+            where.append(f'({condition})')
+            params.extend(condition_params)
+
+        conn.execute(
+            'CREATE TEMP TABLE candidates AS SELECT id FROM objects WHERE ' + ' OR '.join(where),
+            params
+        )
+        conn.execute(
+            'CREATE TEMP TABLE selected AS'
+            ' SELECT id FROM candidates'
+            ' UNION'
+            ' SELECT o.id FROM relationships r'
+            ' JOIN objects o ON o.pid = r.target_pid AND o.has_aminfo = 1'
+            " WHERE r.relationship = 'hasPart' AND r.object_id IN (SELECT id FROM candidates)"
+        )
+
+        query = 'SELECT record FROM objects WHERE id IN (SELECT id FROM selected) ORDER BY id'
+        for record, in conn.execute(query):
+            yield record + '\n'
+    finally:
+        conn.close()
+
+
+def add_umdm_details(args, obj):
+    """ Add the title and handle to a matching UMDM object. """
+
+    # Add the title
+    obj['title'] = getitem_chain(obj, 'ds', 'umdm', 'umdm_title', default='<unknown>')
 
+    # Add the handle
+    obj['handle'] = get_handle(args, obj['pid'])
+
+
+def join_in_memory(args, outputs):
+    """
     Makes two passes through the input file:
 
-    1. Collect all UMDM objects which match the filters
+    1. Collect all UMDM objects which match the filters of any output
     2. Collect all UMAM for the matching UMDM
 
-    Then writes to the output file.
+    Then writes to the output files. All of the matching objects are held in
+    memory until they are written.
     """
 
-    # Open optional handles cache file
-    if args.handles:
-        args.handles = dbm.open(args.handles, 'c')
-        logging.info(f"Using handle cache file with {len(args.handles)} entries")
+    # mapping from UMAM pid => UMDM
+    umdm_for_umam_pid = {}
+    umdm_count = 0
+    parts_count = 0
 
-    try:
-        # matching UMDM objects
-        umdm = []
-        # mapping from UMAM pid => UMDM
-        umdm_for_umam_pid = {}
-        parts_count = 0
+    with TemporaryFile(mode='w+') as umam_list:
+        # Collect all UMDM matching the filters
+        logging.info("Finding UMDM")
+        for line in args.infile:
+            obj = json.loads(line)
+
+            # copy any UMAM objects to the temp file
+            if is_umam(obj):
+                umam_list.write(line)
+
+            if not is_umdm(obj):
+                continue
+
+            matching = [output for output in outputs if output.matches(obj)]
+            if matching:
+                # Map the UMAM pids to their parent UMDM
+                umam_pids = getitem_chain(obj, 'ds', 'rels-mets', 'rels', 'hasPart', default=[])
+                umdm_for_umam_pid.update({pid: obj for pid in umam_pids})
 
-        with TemporaryFile(mode='w+') as umam_list:
-            # Collect all UMDM matching the filters
-            filters = setup_filters(args)
-            logging.info("Finding UMDM")
-            for line in args.infile:
-                obj = json.loads(line)
+                add_umdm_details(args, obj)
 
-                # copy any UMAM objects to the temp file
-                if is_umam(obj):
-                    umam_list.write(line)
+                # Save the UMDM object, shared by all matching outputs
+                for output in matching:
+                    output.umdm.append(obj)
+                umdm_count += 1
 
-                if is_umdm(obj) and all(check(obj) for check in filters):
-                    # Map the UMAM pids to their parent UMDM
-                    umam_pids = getitem_chain(obj, 'ds', 'rels-mets', 'rels', 'hasPart', default=[])
-                    umdm_for_umam_pid.update({pid: obj for pid in umam_pids})
+        logging.info(f"  found {umdm_count}")
+        for output in outputs:
+            logging.info(f"    {output.name}: {len(output.umdm)}")
 
-                    # Add the title
-                    obj['title'] = getitem_chain(obj, 'ds', 'umdm', 'umdm_title', default='<unknown>')
+        # Collect all UMAM for the matching UMDM
+        logging.info("Finding UMAM")
 
-                    # Add the handle
-                    obj['handle'] = get_handle(args, obj['pid'])
+        # rewind the temp file listing of UMAM objects
+        umam_list.seek(0)
+        for line in umam_list:
+            obj = json.loads(line)
+            pid = obj['pid']
 
-                    # Save the UMDM object
-                    umdm.append(obj)
+            if pid in umdm_for_umam_pid:
+                umdm_object = umdm_for_umam_pid[pid]
 
-            logging.info(f"  found {len(umdm)}")
+                if 'hasPart' not in umdm_object:
+                    umdm_object['hasPart'] = []
 
-            # Collect all UMAM for the matching UMDM
-            logging.info("Finding UMAM")
+                # Add the UMAM to its parent UMDM
+                umdm_object['hasPart'].append(obj)
 
-            # rewind the temp file listing of UMAM objects
-            umam_list.seek(0)
-            for line in umam_list:
-                obj = json.loads(line)
-                pid = obj['pid']
+                parts_count += 1
 
-                if pid in umdm_for_umam_pid:
-                    umdm_object = umdm_for_umam_pid[pid]
+    logging.info(f"  found {parts_count}")
 
-                    if 'hasPart' not in umdm_object:
-                        umdm_object['hasPart'] = []
+    # Write out the results
+    for output in outputs:
+        logging.info(f"Writing output JSON to {output.outfile.name}")
+        for obj in output.umdm:
+            output.write(obj)
 
-                    # Add the UMAM to its parent UMDM
-                    umdm_object['hasPart'].append(obj)
 
-                    parts_count += 1
+def join_external(args, outputs):
+    """
+    Produces the same output as join_in_memory(), but keeps the matching
+    objects in sorted temporary files instead of memory:
+
+    1. In one pass through the input file, write the matching UMDM objects
+       to a temporary file in input order, and sort the (UMAM pid, UMDM
+       sequence number) pairs and the UMAM objects by UMAM pid
+    2. Merge join the pairs with the UMAM objects, and sort the result by
+       UMDM sequence number and UMAM input order
+    3. Merge the UMDM objects with their UMAM objects and write them to the
+       output files
+
+    At most --memory-budget megabytes of records are buffered by each sort,
+    plus the UMAM objects of a single UMDM object.
+    """
+    budget = args.memory_budget * 1024 * 1024
+
+    with TemporaryFile(mode='w+') as umdm_list, \
+            ExternalSorter(budget) as parents, \
+            ExternalSorter(budget) as umams, \
+            ExternalSorter(budget) as parts:
+
+        # Collect all UMDM matching the filters, and all UMAM
+        logging.info("Finding UMDM")
+        umam_seq = 0
+        umdm_seq = 0
+        for line in args.infile:
+            obj = json.loads(line)
+
+            if is_umam(obj):
+                umams.add([obj['pid'], umam_seq], line.rstrip('\n'))
+                umam_seq += 1
+
+            if not is_umdm(obj):
+                continue
+
+            matching = [i for i, output in enumerate(outputs) if output.matches(obj)]
+            if matching:
+                # Map the UMAM pids to their parent UMDM; for a UMAM pid with
+                # more than one parent, the last parent wins
+                umam_pids = getitem_chain(obj, 'ds', 'rels-mets', 'rels', 'hasPart', default=[])
+                for pid in umam_pids:
+                    parents.add(pid, umdm_seq)
+
+                add_umdm_details(args, obj)
+
+                umdm_list.write(json.dumps([umdm_seq, matching, obj]))
+                umdm_list.write("\n")
+                umdm_seq += 1
+
+                for i in matching:
+                    outputs[i].count += 1
+
+        logging.info(f"  found {umdm_seq}")
+        for output in outputs:
+            logging.info(f"    {output.name}: {output.count}")
+
+        # Join the UMAM with their parent UMDM
+        logging.info("Finding UMAM")
+        umam_groups = group_by_key((key[0], (key[1], line)) for key, line in umams)
+        parent_groups = group_by_key(parents)
+        parent = next(parent_groups, None)
+        for pid, umam_lines in umam_groups:
+            while parent is not None and parent[0] < pid:
+                parent = next(parent_groups, None)
+
+            if parent is not None and parent[0] == pid:
+                umdm_parent = parent[1][-1]
+                for seq, umam_line in umam_lines:
+                    parts.add([umdm_parent, seq], umam_line)
+
+        logging.info(f"  found {len(parts)}")
+
+        # Merge the UMAM under their parent UMDM and write out the results
+        logging.info("Writing output JSON to " + ", ".join(output.outfile.name for output in outputs))
+        part_groups = group_by_key((key[0], line) for key, line in parts)
+        part = next(part_groups, None)
+        umdm_list.seek(0)
+        for line in umdm_list:
+            seq, matching, obj = json.loads(line)
+
+            if part is not None and part[0] == seq:
+                obj['hasPart'] = [json.loads(umam_line) for umam_line in part[1]]
+                part = next(part_groups, None)
+
+            for i in matching:
+                outputs[i].write(obj)
+
+
+def main(args):
+    """
+    Main input/output filter.
+
+    Collects the UMDM objects which match the filters of each output and
+    their UMAM objects, then writes to the output files. The scan of the
+    input file, the UMAM join, the title and the handle lookup are shared by
+    all of the outputs.
+    """
+
+    # Open optional handles cache file
+    if args.handles:
+        args.handles = dbm.open(args.handles, 'c')
+        logging.info(f"Using handle cache file with {len(args.handles)} entries")
+
+    try:
+        with ExitStack() as stack:
+            outputs = setup_outputs(args, stack)
 
-        logging.info(f"  found {parts_count}")
+            if args.catalog:
+                logging.info(f"Using catalog {args.catalog}")
+                args.infile = catalog_records(args, outputs)
 
-        # Write out the results
-        logging.info("Writing output JSON")
-        for obj in umdm:
-            args.outfile.write(json.dumps(obj))
-            args.outfile.write("\n")
+            if args.memory_budget:
+                join_external(args, outputs)
+            else:
+                join_in_memory(args, outputs)
 
     finally:
         if args.handles:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import sys
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader, DictWriter
+
+from compressed import FileType
+from inventory import CHECKSUM_FIELDS, digest_file, map_bounded
+from journal import Journal
+from ratelimit import TokenBucket
+
+# Verify the restored binaries listed in an inventory CSV file, checking the
+# size and a digest of each file against the inventory, before the files are
+# linked into the Archelon or Avalon batch.
+#
+# Input - inventory.csv (see inventory.py) and the restore directory its paths
+#         are relative to
+#
+# Output - CSV report of the missing and mismatched files, and a journal of
+#          the verified files, so that an interrupted run can be resumed
+#          (rerun with the same --journal); files with problems are not
+#          journaled, so a rerun checks them again and the report lists the
+#          problems found by the last run
+#
+# Reads can be throttled (--max-rate) to avoid saturating shared storage.
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+REPORT_FIELDS = ['PATH', 'PROBLEM', 'EXPECTED_BYTES', 'ACTUAL_BYTES', 'EXPECTED_DIGEST', 'ACTUAL_DIGEST']
+
+# Default number of files verified concurrently
+WORKERS = 4
+
+# Number of files between progress messages
+PROGRESS_INTERVAL = 1000
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(
+        description='Verify the size and digest of the restored files listed in an inventory CSV file.'
+    )
+
+    parser.add_argument("-i", "--infile", required=True,
+                        type=FileType(mode='r', encoding='UTF-8', newline=''),
+                        help="CSV inventory file")
+
+    parser.add_argument("-r", "--restore-dir", required=True,
+                        type=str,
+                        help="Directory the inventory paths are relative to")
+
+    parser.add_argument("-o", "--outfile", required=True,
+                        type=FileType(mode='w', encoding='UTF-8', newline=''),
+                        help="CSV report of the missing and mismatched files")
+
+    parser.add_argument("-j", "--journal", required=True,
+                        type=str,
+                        help="Journal of the verified files; an existing journal resumes the run")
+
+    parser.add_argument("-c", "--checksum",
+                        choices=CHECKSUM_FIELDS,
+                        default='SHA256',
+                        help="Inventory digest column to verify (default: SHA256)")
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=WORKERS,
+                        help=f"Number of files verified concurrently (default: {WORKERS})")
+
+    parser.add_argument("-m", "--max-rate",
+                        type=float,
+                        help="Maximum read rate across all workers, in megabytes per second (default: unlimited)")
+
+    # Process command line arguments
+    return parser.parse_args()
+
+
+def verify(root, row, checksum, throttle=None) -> dict:
+    """
+    Verify one inventory row against the restored file.
+
+    :param root: restore directory
+    :param row: inventory row
+    :param checksum: inventory digest column, such as 'SHA256'
+    :param throttle: TokenBucket limiting the bytes read per second
+    :return: dictionary of the report fields; PROBLEM is '' for a verified
+             file, otherwise 'missing', 'size' (including an inventory BYTES
+             value which is not a number) or 'digest'
+    """
+    path = os.path.join(root, row['PATH'])
+    result = {
+        'PATH': row['PATH'],
+        'PROBLEM': '',
+        'EXPECTED_BYTES': row['BYTES'],
+        'ACTUAL_BYTES': '',
+        'EXPECTED_DIGEST': row[checksum],
+        'ACTUAL_DIGEST': '',
+    }
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        result['PROBLEM'] = 'missing'
+        return result
+
+    result['ACTUAL_BYTES'] = str(size)
+    try:
+        expected_size = int(row['BYTES'])
+    except ValueError:
+        expected_size = None
+    if row['BYTES'] and expected_size != size:
+        # the digest cannot match either, so skip reading the file
+        result['PROBLEM'] = 'size'
+        return result
+
+    if row[checksum]:
+        algorithm = checksum.lower()
+        try:
+            result['ACTUAL_DIGEST'] = digest_file(path, (algorithm,), throttle)[algorithm]
+        except OSError:
+            result['PROBLEM'] = 'missing'
+            return result
+
+        if result['ACTUAL_DIGEST'] != row[checksum].lower():
+            result['PROBLEM'] = 'digest'
+
+    return result
+
+
+def main(args: Namespace) -> int:
+    throttle = TokenBucket(args.max_rate * 1024 * 1024) if args.max_rate else None
+
+    with Journal(args.journal, fsync=False) as journal:
+        resumed = len(journal)
+        if resumed:
+            logging.info(f'Resuming with {resumed} files verified in journal {args.journal}')
+
+        with args.infile:
+            rows = (row for row in DictReader(args.infile) if row['PATH'] not in journal)
+
+            count = 0
+            problems = []
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                def check(row):
+                    return verify(args.restore_dir, row, args.checksum, throttle)
+
+                for result in map_bounded(executor, check, rows, args.workers * 4):
+                    if result['PROBLEM']:
+                        logging.warning(f"Problem with {result['PATH']}: {result['PROBLEM']}")
+                        problems.append(result)
+                    else:
+                        journal.record(result['PATH'], **result)
+                    count += 1
+                    if count % PROGRESS_INTERVAL == 0:
+                        logging.info(f'  verified {count} files')
+
+    with args.outfile:
+        writer = DictWriter(args.outfile, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(problems)
+
+    logging.info(f'Verified {count} files ({resumed} previously); {len(problems)} problems '
+                 f'written to {args.outfile.name}')
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(process_args()))
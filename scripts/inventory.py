@@ -1,48 +1,407 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import logging
+import os
 import re
-from argparse import ArgumentParser, FileType
-from collections import defaultdict
-from csv import DictReader
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from csv import DictReader, DictWriter
+from datetime import datetime
+
+from compressed import FileType, open_file
+from extsort import ExternalSorter, group_by_key
 
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-parser = ArgumentParser(
-    description=(
-        'Read an inventory CSV file, and build an index dictionary JSON file '
-        "mapping the UMDM PID to a dictionary mapping that object's UMAM PIDs "
-        'to the relative path to the corresponding binary.'
+INVENTORY_FIELDS = [
+    'PATH', 'DIRECTORY', 'FILENAME', 'EXTENSION', 'BYTES', 'MTIME', 'MODDATE', 'MD5', 'SHA1', 'SHA256'
+]
+PIDS_PATTERN = re.compile(r'umd_(\d+)/umd_(\d+)')
+
+CHECKSUM_FIELDS = ['MD5', 'SHA1', 'SHA256']
+
+# Columns of the duplicates report; one row per copy of a duplicated binary
+DUPLICATES_FIELDS = ['CHECKSUM', 'BYTES', 'COPIES', 'BYTES_WASTED', 'UMDM', 'UMAM', 'PATH']
+
+# Default memory budget for grouping rows by checksum, in megabytes
+MEMORY_BUDGET = 256
+
+# Default number of threads crawling and hashing a restore directory
+WORKERS = 8
+
+# Size of the reads used to hash a file, in bytes
+READ_SIZE = 8 * 1024 * 1024
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(
+        description=(
+            'Read an inventory CSV file, and build an index dictionary JSON file '
+            "mapping the UMDM PID to a dictionary mapping that object's UMAM PIDs "
+            'to the relative path to the corresponding binary. Optionally report '
+            'the binaries which are stored more than once.'
+        )
     )
-)
 
-parser.add_argument("-i", "--infile", required=True,
-                    type=FileType(mode='r', encoding='UTF-8'),
-                    help="CSV inventory file")
+    source = parser.add_mutually_exclusive_group(required=True)
 
-parser.add_argument("-o", "--outfile", required=True,
-                    type=FileType(mode='a', encoding='UTF-8'),
-                    help="JSON output file")
+    source.add_argument("-i", "--infile",
+                        type=FileType(mode='r', encoding='UTF-8', newline=''),
+                        help="CSV inventory file")
 
-args = parser.parse_args()
+    source.add_argument("-r", "--restore-dir",
+                        type=str,
+                        help="Directory of restored files to generate the CSV inventory file from")
 
-INVENTORY_FIELDS = [
-    'PATH', 'DIRECTORY', 'FILENAME', 'EXTENSION', 'BYTES', 'MTIME', 'MODDATE', 'MD5', 'SHA1', 'SHA256'
-]
-PIDS_PATTERN = re.compile(r'umd_(\d+)/umd_(\d+)')
+    parser.add_argument("-v", "--inventory",
+                        type=str,
+                        help="CSV inventory file to write, with --restore-dir")
+
+    parser.add_argument("-p", "--previous",
+                        type=str,
+                        help=(
+                            "Previous CSV inventory file of --restore-dir; its digests are "
+                            "reused for files with unchanged size and mtime, and only the "
+                            "UMDM objects with new, modified or deleted files are appended "
+                            "to the --outfile index"
+                        ))
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=WORKERS,
+                        help=f"Number of threads crawling and hashing --restore-dir (default: {WORKERS})")
+
+    parser.add_argument("-o", "--outfile",
+                        type=FileType(mode='a', encoding='UTF-8'),
+                        help="JSON output file")
+
+    parser.add_argument("-d", "--duplicates",
+                        type=FileType(mode='w', encoding='UTF-8', newline=''),
+                        help="CSV report of the binaries with identical checksums")
+
+    parser.add_argument("-c", "--checksum",
+                        choices=CHECKSUM_FIELDS,
+                        default='SHA256',
+                        help="Inventory checksum column used to find duplicates (default: SHA256)")
+
+    parser.add_argument("-m", "--memory-budget",
+                        type=int,
+                        default=MEMORY_BUDGET,
+                        help=(
+                            "Group the inventory rows by checksum using sorted "
+                            "temporary files, keeping at most MEMORY_BUDGET "
+                            f"megabytes of rows in memory (default: {MEMORY_BUDGET})"
+                        ))
+
+    # Process command line arguments
+    args = parser.parse_args()
+
+    if args.restore_dir and not args.inventory:
+        parser.error('--restore-dir requires --inventory')
+
+    if args.previous and not args.restore_dir:
+        parser.error('--previous requires --restore-dir')
+
+    if args.outfile is None and args.duplicates is None and not args.restore_dir:
+        parser.error('at least one of --outfile or --duplicates is required')
+
+    return args
+
+
+def digest_file(path, algorithms=('md5', 'sha1', 'sha256'), throttle=None) -> dict:
+    """
+    Compute several digests of a file in a single sequential read.
+
+    :param path: file path
+    :param algorithms: hashlib algorithm names
+    :param throttle: TokenBucket limiting the bytes read per second
+    :return: dictionary of algorithm => hex digest
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+
+    with open(path, mode='rb', buffering=0) as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                break
+            if throttle is not None:
+                throttle.take(size)
+            for digest in hashes:
+                digest.update(view[:size])
+
+    return {algorithm: digest.hexdigest() for algorithm, digest in zip(algorithms, hashes)}
+
+
+def scan_dir(path) -> tuple:
+    """
+    List the regular files, as (path, stat), and the subdirectories of a
+    directory. Unreadable or vanished entries are logged and skipped.
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError as e:
+                    logging.warning(f'Skipping {entry.path}: {e}')
+    except OSError as e:
+        logging.warning(f'Skipping directory {path}: {e}')
+    return files, dirs
+
+
+def crawl(root, executor):
+    """
+    Find the regular files under a directory, scanning the subdirectories
+    concurrently.
+
+    :param root: directory path
+    :param executor: ThreadPoolExecutor
+    :return: generator of (path, stat)
+    """
+    pending = {executor.submit(scan_dir, root)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            files, dirs = future.result()
+            yield from files
+            pending.update(executor.submit(scan_dir, path) for path in dirs)
+
+
+def map_bounded(executor, function, items, window):
+    """ Like executor.map(), but with at most window items submitted at once. """
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(function, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
 
-index = defaultdict(dict)
 
-reader = DictReader(args.infile)
+def load_previous(path) -> dict:
+    """ Load a previous inventory as a dictionary of path => (BYTES, MTIME, MD5, SHA1, SHA256). """
+    previous = {}
+    with open_file(path, newline='') as infile:
+        for line in DictReader(infile):
+            previous[line['PATH']] = (line['BYTES'], line['MTIME'], line['MD5'], line['SHA1'], line['SHA256'])
 
-for line in reader:
+    logging.info(f'Loaded {len(previous)} files from previous inventory {path}')
+    return previous
+
+
+def inventory_row(relative_path, stat, digests) -> dict:
+    """ Build the inventory row for a restored file. """
+    directory, filename = os.path.split(relative_path)
+    mtime = int(stat.st_mtime)
+
+    return {
+        'PATH': relative_path,
+        'DIRECTORY': directory,
+        'FILENAME': filename,
+        'EXTENSION': os.path.splitext(filename)[1].lstrip('.'),
+        'BYTES': stat.st_size,
+        'MTIME': mtime,
+        'MODDATE': datetime.fromtimestamp(mtime).isoformat(),
+        'MD5': digests['md5'],
+        'SHA1': digests['sha1'],
+        'SHA256': digests['sha256'],
+    }
+
+
+def generate(root, outfile, workers, previous=None) -> list:
+    """
+    Write the CSV inventory of a restore directory. Each file is read once to
+    compute all of its digests; paths are relative to the restore directory.
+
+    :param root: restore directory
+    :param outfile: CSV file
+    :param workers: number of threads crawling and hashing
+    :param previous: previous inventory, from load_previous(); the digests
+                     of files with unchanged size and mtime are reused, and
+                     the files found are removed, leaving the deleted files
+    :return: list of the paths of the new or modified files
+    """
+    writer = DictWriter(outfile, fieldnames=INVENTORY_FIELDS)
+    writer.writeheader()
+
+    def hash_entry(entry):
+        path, stat = entry
+        relative_path = os.path.relpath(path, root)
+
+        if previous is not None:
+            old = previous.get(relative_path)
+            if old is not None and old[:2] == (str(stat.st_size), str(int(stat.st_mtime))):
+                previous.pop(relative_path, None)
+                digests = dict(zip(('md5', 'sha1', 'sha256'), old[2:]))
+                return inventory_row(relative_path, stat, digests), False
+
+        try:
+            digests = digest_file(path)
+        except OSError as e:
+            # left out of the inventory; a file in the previous inventory is
+            # reported as deleted
+            logging.warning(f'Skipping unreadable file {relative_path}: {e}')
+            return None, False
+
+        if previous is not None:
+            previous.pop(relative_path, None)
+        return inventory_row(relative_path, stat, digests), True
+
+    count = 0
+    changed = []
+    errors = 0
+    # separate pools, so that hashing cannot starve the crawl
+    with ThreadPoolExecutor(max_workers=workers) as crawler, ThreadPoolExecutor(max_workers=workers) as hasher:
+        for row, hashed in map_bounded(hasher, hash_entry, crawl(root, crawler), workers * 4):
+            if row is None:
+                errors += 1
+                continue
+            writer.writerow(row)
+            if hashed:
+                changed.append(row['PATH'])
+            count += 1
+            if count % 10000 == 0:
+                logging.info(f'  inventoried {count} files')
+
+    logging.info(f'Inventoried {count} files, hashed {len(changed)}')
+    if errors:
+        logging.warning(f'Skipped {errors} unreadable files')
+    return changed
+
+
+def parse_pids(line: dict) -> tuple:
+    """ Return the (UMDM, UMAM) pids for an inventory row, or None. """
     match = PIDS_PATTERN.search(line['DIRECTORY'])
     if match:
-        umdm_pid, umam_pid = (f'umd:{pid}' for pid in match.groups())
-        index[umdm_pid].update({umam_pid: line['FILENAME']})
-        logging.info(f'Added {umam_pid} to {umdm_pid}')
+        return tuple(f'umd:{pid}' for pid in match.groups())
+    return None
+
+
+def find_duplicates(sorter: ExternalSorter):
+    """
+    Group the sorted inventory rows by checksum.
+
+    :param sorter: ExternalSorter of checksum => [bytes, umdm, umam, path]
+    :return: generator of (checksum, [[bytes, umdm, umam, path]]) for each
+             checksum with more than one file; empty files, which all share
+             a checksum but waste no storage, are not reported
+    """
+    for checksum, copies in group_by_key(sorter):
+        if len(copies) > 1 and copies[0][0] > 0:
+            yield checksum, copies
+
+
+def write_duplicates(sorter: ExternalSorter, outfile) -> None:
+    """ Write the duplicates report, and log the storage wasted by the duplicates. """
+    writer = DictWriter(outfile, fieldnames=DUPLICATES_FIELDS)
+    writer.writeheader()
+
+    sets = 0
+    copies_total = 0
+    wasted_total = 0
+    for checksum, copies in find_duplicates(sorter):
+        size = copies[0][0]
+        wasted = size * (len(copies) - 1)
+
+        sets += 1
+        copies_total += len(copies)
+        wasted_total += wasted
+
+        for _, umdm_pid, umam_pid, path in copies:
+            writer.writerow({
+                'CHECKSUM': checksum,
+                'BYTES': size,
+                'COPIES': len(copies),
+                'BYTES_WASTED': wasted,
+                'UMDM': umdm_pid or '',
+                'UMAM': umam_pid or '',
+                'PATH': path,
+            })
+
+    logging.info(f'Found {sets} duplicated binaries with {copies_total} copies, '
+                 f'wasting {wasted_total} bytes')
+
+
+def main(args: Namespace) -> None:
+    index = defaultdict(dict)
+    # UMDM objects to write to the index, or None for all of them
+    umdm_pids = None
+
+    if args.restore_dir:
+        previous = load_previous(args.previous) if args.previous else None
+
+        logging.info(f'Writing inventory of {args.restore_dir} to {args.inventory}')
+        with open_file(args.inventory, mode='w', newline='') as outfile:
+            changed = generate(args.restore_dir, outfile, args.workers, previous)
+
+        if previous is not None:
+            for path in sorted(previous):
+                logging.info(f'Deleted {path}')
+            logging.info(f'{len(changed)} new or modified files, {len(previous)} deleted files')
+
+            umdm_pids = set()
+            for path in changed + list(previous):
+                pids = parse_pids({'DIRECTORY': os.path.dirname(path)})
+                if pids:
+                    umdm_pids.add(pids[0])
+
+            # UMDM objects whose files were all deleted are written as empty
+            for umdm_pid in umdm_pids:
+                index[umdm_pid] = {}
+
+        args.infile = open_file(args.inventory, newline='')
+
+    sorter = ExternalSorter(args.memory_budget * 1024 * 1024) if args.duplicates else None
+    missing = 0
+
+    reader = DictReader(args.infile)
+
+    for line in reader:
+        pids = parse_pids(line)
+
+        if args.outfile and pids and (umdm_pids is None or pids[0] in umdm_pids):
+            umdm_pid, umam_pid = pids
+            index[umdm_pid].update({umam_pid: line['FILENAME']})
+            logging.info(f'Added {umam_pid} to {umdm_pid}')
+
+        if sorter is not None:
+            checksum = line[args.checksum]
+            if not checksum:
+                missing += 1
+                continue
+            umdm_pid, umam_pid = pids or (None, None)
+            path = line.get('PATH') or os.path.join(line['DIRECTORY'], line['FILENAME'])
+            sorter.add(checksum, [int(line['BYTES'] or 0), umdm_pid, umam_pid, path])
+
+    if args.outfile:
+        if umdm_pids is None:
+            logging.info(f'Writing index to {args.outfile.name}')
+        else:
+            logging.info(f'Appending {len(index)} changed UMDM objects to index {args.outfile.name}')
+        args.outfile.write(json.dumps(index) + '\n')
+
+    if sorter is not None:
+        if missing:
+            logging.warning(f'Skipped {missing} rows without a {args.checksum} checksum')
+
+        logging.info(f'Writing duplicates report to {args.duplicates.name}')
+        with sorter, args.duplicates:
+            write_duplicates(sorter, args.duplicates)
+
 
-logging.info(f'Writing index to {args.outfile.name}')
-args.outfile.write(json.dumps(index) + '\n')
+if __name__ == '__main__':
+    main(process_args())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import logging
+from argparse import ArgumentParser, Namespace
+from csv import DictReader, DictWriter
+
+from compressed import FileType
+from extsort import ExternalSorter, group_by_key, merge_join
+from inventory import CHECKSUM_FIELDS, MEMORY_BUDGET
+
+# Compare two inventory CSV files (see inventory.py) from successive runs of
+# the file restoration process, before regenerating index.json.
+#
+# Both inventories are sorted by path using sorted temporary files and
+# merge-joined, finding the modified files and the paths only in one of the
+# inventories. Those are then sorted by checksum and merge-joined again, so
+# that a file which only changed path is reported as moved instead of as
+# removed and added. Neither inventory is held in memory.
+#
+# Input - old and new inventory.csv files
+#
+# Output - CSV file of changes, one row per file:
+#
+#   modified - same PATH, different checksum (or size, without checksums)
+#   moved - OLD_PATH in the old inventory, PATH in the new, same checksum
+#   removed - OLD_PATH only in the old inventory
+#   added - PATH only in the new inventory
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+CHANGE_FIELDS = ['CHANGE', 'PATH', 'OLD_PATH', 'BYTES', 'OLD_BYTES', 'CHECKSUM', 'OLD_CHECKSUM']
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(
+        description='List the files added, removed, moved and modified between two inventory CSV files.'
+    )
+
+    parser.add_argument("old",
+                        type=FileType(mode='r', encoding='UTF-8', newline=''),
+                        help="Old CSV inventory file")
+
+    parser.add_argument("new",
+                        type=FileType(mode='r', encoding='UTF-8', newline=''),
+                        help="New CSV inventory file")
+
+    parser.add_argument("-o", "--outfile",
+                        type=FileType(mode='w', encoding='UTF-8', newline=''),
+                        default='-',
+                        help="CSV file of changes (default: stdout)")
+
+    parser.add_argument("-c", "--checksum",
+                        choices=CHECKSUM_FIELDS,
+                        default='SHA256',
+                        help="Inventory checksum column used to compare files (default: SHA256)")
+
+    parser.add_argument("-m", "--memory-budget",
+                        type=int,
+                        default=MEMORY_BUDGET,
+                        help=(
+                            "Keep at most MEMORY_BUDGET megabytes of rows in memory "
+                            f"for each sort (default: {MEMORY_BUDGET})"
+                        ))
+
+    # Process command line arguments
+    return parser.parse_args()
+
+
+def sort_by_path(infile, checksum, sorter: ExternalSorter) -> ExternalSorter:
+    """
+    Add the rows of an inventory to a sorter, as path => [bytes, checksum].
+    Checksums are lowercased, as hex digests from other tools may be uppercase.
+    """
+    for row in DictReader(infile):
+        sorter.add(row['PATH'], [row['BYTES'], row[checksum].lower()])
+    return sorter
+
+
+def unique(items):
+    """ Keep the last value of each key in sorted (key, value) pairs. """
+    for key, values in group_by_key(items):
+        yield key, values[-1]
+
+
+def change(kind, path=None, new=None, old_path=None, old=None) -> dict:
+    """ Build a change row from the [bytes, checksum] of the old and new files. """
+    return {
+        'CHANGE': kind,
+        'PATH': path or '',
+        'OLD_PATH': old_path or '',
+        'BYTES': new[0] if new else '',
+        'OLD_BYTES': old[0] if old else '',
+        'CHECKSUM': new[1] if new else '',
+        'OLD_CHECKSUM': old[1] if old else '',
+    }
+
+
+def is_modified(old, new) -> bool:
+    """ Compare the [bytes, checksum] of a file in two inventories. """
+    if old[1] and new[1]:
+        return old[1] != new[1]
+    return old[0] != new[0]
+
+
+def diff(old_paths, new_paths, removed: ExternalSorter, added: ExternalSorter):
+    """
+    Merge-join two inventories by path.
+
+    :param old_paths: sorted (path, [bytes, checksum]) of the old inventory
+    :param new_paths: sorted (path, [bytes, checksum]) of the new inventory
+    :param removed: sorter for the paths only in the old inventory, by checksum
+    :param added: sorter for the paths only in the new inventory, by checksum
+    :return: generator of 'modified' change rows; files without a checksum
+             cannot be matched as moved, and are reported as removed or
+             added directly
+    """
+    for path, old, new in merge_join(unique(old_paths), unique(new_paths)):
+        if old is None:
+            if new[1]:
+                added.add(new[1], [path, new[0]])
+            else:
+                yield change('added', path=path, new=new)
+        elif new is None:
+            if old[1]:
+                removed.add(old[1], [path, old[0]])
+            else:
+                yield change('removed', old_path=path, old=old)
+        elif is_modified(old, new):
+            yield change('modified', path=path, new=new, old_path=path, old=old)
+
+
+def find_moves(removed: ExternalSorter, added: ExternalSorter):
+    """
+    Merge-join the removed and added files by checksum, pairing copies of
+    the same content in path order.
+
+    :return: generator of 'moved', 'removed' and 'added' change rows
+    """
+    for checksum, old_files, new_files in merge_join(group_by_key(removed), group_by_key(added)):
+        old_files = old_files or []
+        new_files = new_files or []
+
+        for (old_path, old_bytes), (path, new_bytes) in zip(old_files, new_files):
+            yield change('moved', path=path, new=[new_bytes, checksum], old_path=old_path, old=[old_bytes, checksum])
+
+        for old_path, old_bytes in old_files[len(new_files):]:
+            yield change('removed', old_path=old_path, old=[old_bytes, checksum])
+
+        for path, new_bytes in new_files[len(old_files):]:
+            yield change('added', path=path, new=[new_bytes, checksum])
+
+
+def main(args: Namespace) -> None:
+    budget = args.memory_budget * 1024 * 1024
+    counts = {'modified': 0, 'moved': 0, 'removed': 0, 'added': 0}
+
+    with ExternalSorter(budget) as old_paths, ExternalSorter(budget) as new_paths, \
+            ExternalSorter(budget) as removed, ExternalSorter(budget) as added:
+
+        logging.info(f'Sorting {args.old.name}')
+        with args.old:
+            sort_by_path(args.old, args.checksum, old_paths)
+
+        logging.info(f'Sorting {args.new.name}')
+        with args.new:
+            sort_by_path(args.new, args.checksum, new_paths)
+
+        writer = DictWriter(args.outfile, fieldnames=CHANGE_FIELDS)
+        writer.writeheader()
+
+        logging.info('Comparing paths')
+        for row in diff(old_paths, new_paths, removed, added):
+            writer.writerow(row)
+            counts[row['CHANGE']] += 1
+
+        logging.info('Comparing checksums of removed and added files')
+        for row in find_moves(removed, added):
+            writer.writerow(row)
+            counts[row['CHANGE']] += 1
+
+    args.outfile.flush()
+    logging.info(', '.join(f'{count} {kind}' for kind, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main(process_args())
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+
+# Append-only journal of completed work items, for resuming long-running
+# scripts after a failure. Each line is a JSON object with a "key" and any
+# details recorded with it, such as the size of a file when it was processed.
+#
+# The journal is read when it is opened; a partially written last line, left
+# by an interrupted run, is ignored. Entries are flushed as they are recorded,
+# and also synced to disk unless fsync=False, for journals of cheap,
+# repeatable work where losing the last entries in a system crash is harmless.
+
+
+class Journal:
+    """
+    Record of completed work items, shared by the worker threads of a run.::
+
+        with Journal('moves.journal') as journal:
+            for item in items:
+                if item in journal:
+                    continue
+                ...
+                journal.record(item, size=size)
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = str(path)
+        self.fsync = fsync
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        line = '\n'
+        if os.path.exists(self.path):
+            with open(self.path, encoding='UTF-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['key']] = entry
+
+        self.file = open(self.path, mode='a', encoding='UTF-8')
+        if not line.endswith('\n'):
+            # terminate the partial line, so the next entry starts on its own line
+            self.file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ Return the journal entry for a key, or None. """
+        return self.entries.get(key)
+
+    def record(self, key, **details):
+        """ Append a completed item to the journal, and flush it to disk. """
+        entry = dict(key=key, **details)
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.entries[key] = entry
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
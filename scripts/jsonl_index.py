@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import sys
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+from compressed import compression, open_file
+
+# Sidecar index mapping pid => (offset, length) of its records in a JSON lines
+# file, such as info.json or filter.json, for extracting records without
+# scanning or decoding the file.
+#
+# The index is stored next to the source file as FILE.idx (a sqlite file),
+# together with the size and modification time of the source file. It is
+# rebuilt automatically when the source file changes. Compressed source files
+# cannot be indexed.
+#
+# Usage:
+#
+#   # Build (or refresh) the index for export/info.json, and copy the records
+#   # for the pids listed in pids.txt to sample.json
+#   scripts/jsonl_index.py --infile=export/info.json --pids=pids.txt --outfile=sample.json
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# The pid of each record; info.json and filter.json records start with the pid
+PID_PATTERN = re.compile(rb'"pid"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Number of index entries inserted per batch
+BATCH_SIZE = 50000
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(
+        description='Build a pid index for a JSON lines file, and extract records by pid.'
+    )
+
+    parser.add_argument("-i", "--infile", required=True,
+                        type=str,
+                        help="JSON lines file to index")
+
+    parser.add_argument("-p", "--pids",
+                        type=str,
+                        help="File listing the pids to extract, one per line ('-' for stdin)")
+
+    parser.add_argument("-o", "--outfile",
+                        type=str,
+                        default='-',
+                        help="File to write the extracted records to (default: stdout)")
+
+    parser.add_argument("-f", "--force",
+                        default=False, action='store_true',
+                        help="Rebuild the index even if it is up to date")
+
+    # Process command line arguments
+    return parser.parse_args()
+
+
+def index_path(source_path) -> Path:
+    """ Path of the sidecar index for a source file. """
+    source_path = Path(source_path)
+    return source_path.with_name(source_path.name + '.idx')
+
+
+def source_signature(source_path) -> tuple:
+    """ Size and modification time of the source file, used to detect changes. """
+    stat = os.stat(source_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build(source_path) -> Path:
+    """
+    Build the sidecar index for a source file in one pass.
+
+    :param source_path: JSON lines file
+    :return: path of the index
+    """
+    if compression(source_path) is not None:
+        raise ValueError(f'Cannot index compressed file {source_path}')
+
+    path = index_path(source_path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    logging.info(f'Building index {path}')
+    signature = source_signature(source_path)
+
+    conn = sqlite3.connect(str(tmp_path))
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE source (size INTEGER, mtime_ns INTEGER)')
+        conn.execute('CREATE TABLE spans (pid TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+        conn.execute('INSERT INTO source VALUES (?, ?)', signature)
+
+        spans = []
+        count = 0
+        offset = 0
+        with open(source_path, mode='rb') as source:
+            for line in source:
+                match = PID_PATTERN.search(line)
+                if match:
+                    pid = match.group(1).decode('utf-8')
+                    spans.append((pid, offset, len(line)))
+                    count += 1
+                else:
+                    logging.warning(f'No pid found in line at offset {offset}')
+
+                offset += len(line)
+
+                if len(spans) >= BATCH_SIZE:
+                    conn.executemany('INSERT INTO spans VALUES (?, ?, ?)', spans)
+                    spans = []
+
+        conn.executemany('INSERT INTO spans VALUES (?, ?, ?)', spans)
+        conn.execute('CREATE INDEX spans_pid ON spans (pid)')
+        conn.commit()
+    finally:
+        conn.close()
+
+    if source_signature(source_path) != signature:
+        tmp_path.unlink()
+        raise RuntimeError(f'{source_path} changed while it was being indexed')
+
+    os.replace(tmp_path, path)
+    logging.info(f'  indexed {count} records')
+
+    return path
+
+
+def is_current(source_path) -> bool:
+    """ Check whether the sidecar index exists and matches the source file. """
+    path = index_path(source_path)
+    if not path.is_file():
+        return False
+
+    conn = sqlite3.connect(str(path))
+    try:
+        row = conn.execute('SELECT size, mtime_ns FROM source').fetchone()
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+    return row == source_signature(source_path)
+
+
+class JsonlIndex:
+    """
+    Lookup of the records for a pid in an indexed JSON lines file. The
+    records are returned as the raw bytes of their lines, sliced from a
+    memory map of the source file.::
+
+        with JsonlIndex('export/info.json') as index:
+            for line in index.get('umd:1234'):
+                ...
+    """
+
+    def __init__(self, source_path, rebuild=False):
+        self.source_path = Path(source_path)
+
+        if rebuild or not is_current(self.source_path):
+            build(self.source_path)
+
+        self.conn = sqlite3.connect(str(index_path(self.source_path)))
+        self.source = open(self.source_path, mode='rb')
+        if os.fstat(self.source.fileno()).st_size > 0:
+            self.map = mmap.mmap(self.source.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.source.close()
+        self.conn.close()
+
+    def spans(self, pid) -> list:
+        """ List the (offset, length) of each record for a pid, in file order. """
+        return self.conn.execute(
+            'SELECT offset, length FROM spans WHERE pid = ? ORDER BY offset', (pid,)
+        ).fetchall()
+
+    def get(self, pid) -> list:
+        """ List the lines (as bytes) of each record for a pid, in file order. """
+        return [self.map[offset:offset + length] for offset, length in self.spans(pid)]
+
+    def extract(self, pids, outfile) -> int:
+        """
+        Copy the records for a set of pids to a binary file, in file order.
+
+        :param pids: iterable of pids
+        :param outfile: binary file object
+        :return: number of records copied
+        """
+        spans = sorted(span for pid in set(pids) for span in self.spans(pid))
+        for offset, length in spans:
+            outfile.write(self.map[offset:offset + length])
+        return len(spans)
+
+
+def main(args: Namespace) -> None:
+    with JsonlIndex(args.infile, rebuild=args.force) as index:
+        if not args.pids:
+            return
+
+        with open_file(args.pids) as pids_file:
+            pids = [line.strip() for line in pids_file if line.strip()]
+
+        if args.outfile == '-':
+            count = index.extract(pids, sys.stdout.buffer)
+        else:
+            with open(args.outfile, mode='wb') as outfile:
+                count = index.extract(pids, outfile)
+
+        logging.info(f'Extracted {count} records for {len(pids)} pids')
+
+
+if __name__ == '__main__':
+    main(process_args())
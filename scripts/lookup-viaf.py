@@ -1,15 +1,47 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 from csv import DictReader, reader, writer
+from functools import partial
 import json
 import re
+import sqlite3
+import threading
+import time
 
 from pathlib import Path
+from xml.etree import ElementTree
 import requests
 
+from compressed import open_file
+from ratelimit import TokenBucket
+
 # Lookup names in VIAF and record the matching URIs.
-# Process is restartable; it will read from the output CSV
-# file first to determine which names it has already processed.
+# Process is restartable; the VIAF responses and the names written to the
+# output CSV file are kept in a sqlite cache (--cache).
+#
+# Names are looked up by their normalized form, so name variants which
+# normalize to the same query are searched once, and answered from the cache
+# afterwards. An output CSV file written before the cache existed is imported
+# into the cache on the first run.
+#
+# Lookups run concurrently (--workers), each thread keeping a persistent
+# connection to VIAF, and are limited to --rate requests per second across
+# all threads. Failed requests are retried with exponential backoff. Names
+# which could not be looked up, including those for which VIAF returned an
+# error, are not cached, and are searched again on restart. Rows are written
+# to the output CSV file in manifest order.
+#
+# Offline mode matches the names against a local VIAF clusters XML dump
+# instead of the VIAF API, with the same output. The dump is indexed once:
+#
+#   lookup-viaf.py --build-offline=viaf-clusters.xml.gz --offline=export/viaf-offline.db
+#   lookup-viaf.py --offline=export/viaf-offline.db
+#
+# The index holds the main and alternate headings of the personal name
+# clusters, keyed by their normalized form; a name matches the clusters with
+# the same normalized heading, ordered by their number of source records.
 
 def normalize(s):
     ''' Normalize to a searchable form. '''
@@ -20,6 +52,7 @@ def normalize(s):
 
 manifest_file_name = "export/batch_manifest.csv"
 csv_file_name = "export/lookup-viaf.csv"
+cache_file_name = "export/lookup-viaf.db"
 
 viaf_base_url = "https://viaf.org/viaf"
 viaf_search_params = {
@@ -30,18 +63,140 @@ viaf_search_params = {
     'httpAccept': 'application/json',
 }
 
-already_searched = set()
+# Default number of concurrent lookups
+WORKERS = 4
+
+# Default maximum number of VIAF requests per second
+RATE = 5.0
+
+# Default number of retries of a failed request
+RETRIES = 5
+
+# Delay before the first retry, in seconds; doubled for each further retry
+BACKOFF = 1.0
+
+# Request timeout, in seconds
+TIMEOUT = 30
+
+# HTTP statuses which are retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Number of rows written between flushes of the output CSV file
+FLUSH_INTERVAL = 50
+
+# Number of headings inserted per batch when building the offline index
+OFFLINE_BATCH_SIZE = 100000
+
+CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS lookups (
+        query TEXT PRIMARY KEY,
+        response TEXT,
+        count TEXT,
+        ids TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS written (
+        creator TEXT PRIMARY KEY
+    );
+
+    CREATE TABLE IF NOT EXISTS state (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser(description='Lookup creator names in VIAF and record the matching URIs.')
+
+    parser.add_argument("-i", "--manifest",
+                        type=str,
+                        default=manifest_file_name,
+                        help=f"batch_manifest.csv file with the creators to lookup (default: {manifest_file_name})")
+
+    parser.add_argument("-o", "--outfile",
+                        type=str,
+                        default=csv_file_name,
+                        help=f"CSV output file, appended to (default: {csv_file_name})")
+
+    parser.add_argument("-c", "--cache",
+                        type=str,
+                        default=cache_file_name,
+                        help=f"sqlite cache of the VIAF lookups (default: {cache_file_name})")
+
+    parser.add_argument("-u", "--base-url",
+                        type=str,
+                        default=viaf_base_url,
+                        help=f"VIAF base URL (default: {viaf_base_url})")
+
+    parser.add_argument("-f", "--offline",
+                        type=str,
+                        help="Offline index of a VIAF clusters dump, used instead of the VIAF API")
+
+    parser.add_argument("-b", "--build-offline",
+                        type=str,
+                        metavar="DUMP",
+                        help="Build the --offline index from a VIAF clusters XML dump (may be compressed), and exit")
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=WORKERS,
+                        help=f"Number of concurrent lookups (default: {WORKERS})")
 
-# Read the CSV as input
-with open(csv_file_name, "r") as in_file:
-    csv_reader = reader(in_file)
-    for row in csv_reader:
-        # Record this creator as already searched
-        already_searched.add(row[0])
+    parser.add_argument("-r", "--rate",
+                        type=float,
+                        default=RATE,
+                        help=f"Maximum number of requests per second (default: {RATE})")
 
-# Open the CSV as output for write with append
-with open(csv_file_name, "a") as out_file:
-    csv_writer = writer(out_file)
+    parser.add_argument("-t", "--retries",
+                        type=int,
+                        default=RETRIES,
+                        help=f"Number of retries of a failed request (default: {RETRIES})")
+
+    # Process command line arguments
+    args = parser.parse_args()
+
+    if args.build_offline and not args.offline:
+        parser.error('--build-offline requires --offline')
+
+    return args
+
+
+def open_cache(cache_file_name, csv_file_name) -> sqlite3.Connection:
+    """
+    Open (or create) the lookup cache. On first use, the creators and
+    results in an existing output CSV file are imported.
+    """
+    conn = sqlite3.connect(cache_file_name)
+    conn.executescript(CACHE_SCHEMA)
+
+    imported = conn.execute("SELECT value FROM state WHERE name = 'imported'").fetchone()
+    if imported is None and Path(csv_file_name).is_file():
+        print(f'Importing previous lookups from {csv_file_name}')
+        with open(csv_file_name, "r") as in_file:
+            csv_reader = reader(in_file)
+            for row in csv_reader:
+                # Record this creator as already searched
+                conn.execute('INSERT OR IGNORE INTO written VALUES (?)', (row[0],))
+                creator_norm = normalize(row[0])
+                # rows without a number of records were VIAF errors; their names are not cached
+                if creator_norm and len(row) > 1:
+                    ids = [uri.rsplit('/', 1)[-1] for uri in row[2:]]
+                    conn.execute('INSERT OR IGNORE INTO lookups VALUES (?, NULL, ?, ?)',
+                                 (creator_norm, row[1], json.dumps(ids)))
+
+    conn.execute("INSERT OR REPLACE INTO state VALUES ('imported', '1')")
+    conn.commit()
+    return conn
+
+
+def pending_creators(manifest_file_name, conn) -> list:
+    """ List the (creator, normalized creator) not yet written, in manifest order. """
+    pending = []
+    seen = set()
 
     # Read each row in the manifest file
     with open(manifest_file_name, "r") as manifest_file:
@@ -51,34 +206,315 @@ with open(csv_file_name, "a") as out_file:
             for creator in creators.split('|'):
 
                 # Check if we've already searched this creator
-                if creator not in already_searched:
+                if creator in seen:
+                    continue
+                seen.add(creator)
+                if conn.execute('SELECT 1 FROM written WHERE creator = ?', (creator,)).fetchone():
+                    continue
+
+                # Normalize the creator for the VIAF search
+                creator_norm = normalize(creator)
+                if creator_norm:
+                    pending.append((creator, creator_norm))
+
+    return pending
+
+
+def parse_response(text) -> tuple:
+    """ Get the number of records and the VIAF ids from a search response. """
+    result = json.loads(text)['searchRetrieveResponse']
+    ids = []
+    if 'records' in result:
+        for record in result['records']:
+            ids.append(record['record']['recordData']['viafID']['#text'])
+    return result['numberOfRecords'], ids
+
+
+def cached_result(conn, creator_norm):
+    """ Return the cached (count, ids) for a normalized name, or None. """
+    # error responses cached by earlier versions are searched again
+    row = conn.execute('SELECT count, ids FROM lookups WHERE query = ? AND count IS NOT NULL',
+                       (creator_norm,)).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+
+def output_row(creator, count, ids) -> list:
+    """ Output row of the creator, the number of records and the VIAF URIs. """
+    out_row = [creator]
+    if count is not None:
+        out_row.append(count)
+        out_row.extend(f'{viaf_base_url}/{id}' for id in ids)
+    return out_row
+
+
+class ViafClient:
+    """ VIAF search shared by the lookup threads, with a keep-alive session per thread. """
+
+    def __init__(self, base_url, rate=None, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.bucket = TokenBucket(rate) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def search(self, creator_norm):
+        """
+        Search VIAF for a normalized name, retrying connection errors and
+        transient HTTP errors.
+
+        :return: the response, or None if every attempt failed
+        """
+        params = dict(viaf_search_params, query=f'local.personalNames all "{creator_norm}"')
+
+        for attempt in range(self.retries + 1):
+            if self.bucket is not None:
+                self.bucket.take()
+
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session().get(f'{self.base_url}/search', params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = f'HTTP {response.status_code}'
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+
+            if attempt < self.retries:
+                print(f'VIAF lookup of "{creator_norm}" failed ({error}); retrying in {delay:.0f}s')
+                time.sleep(delay)
+
+        print(f'VIAF lookup of "{creator_norm}" failed ({error}); giving up')
+        return None
+
+    def lookup(self, creator_norm):
+        """
+        Search VIAF for a normalized name.
+
+        :return: (normalized name, response text, number of records, VIAF
+                 ids), or None if VIAF could not be reached or returned an
+                 error, so that the name is searched again on restart
+        """
+        # Search in VIAF
+        print(f'VIAF lookup: {creator_norm}')
+
+        response = self.search(creator_norm)
+        if response is None:
+            return None
+
+        if not response.ok:
+            print(f'VIAF lookup of "{creator_norm}" failed (HTTP {response.status_code})')
+            return None
+
+        count, ids = parse_response(response.text)
+        return creator_norm, response.text, count, ids
+
+
+def heading_key(heading) -> str:
+    """
+    Key of a name heading in the offline index: the normalized name, case
+    folded and without spaces, since normalize() removes the spaces of a
+    name but replaces punctuation with spaces.
+    """
+    return ''.join(normalize(heading).casefold().split())
+
+
+def local_name(element) -> str:
+    """ Tag name of an XML element, without its namespace. """
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def parse_cluster(line) -> tuple:
+    """
+    Parse a line of a VIAF clusters XML dump: the VIAF id, a tab, and the
+    cluster XML.
+
+    The headings are the main headings (ns:mainHeadings/ns:data/ns:text) and
+    the name ($a) of the main and alternate (4XX) heading fields.
+
+    :return: (VIAF id, number of source records, set of personal name
+             heading keys); (None, 0, set()) for other clusters
+    """
+    viaf_id, _, xml = line.rstrip('\n').partition('\t')
+    if not xml:
+        viaf_id, xml = None, line
+
+    cluster = ElementTree.fromstring(xml)
+    name_type = None
+    sources = 0
+    headings = set()
+    for child in cluster:
+        name = local_name(child)
+        if name == 'nameType':
+            name_type = child.text
+        elif name == 'viafID' and viaf_id is None:
+            viaf_id = child.text
+        elif name == 'sources':
+            sources = len(child)
+        elif name in ('mainHeadings', 'mainHeadingEl', 'x400s'):
+            for element in child.iter():
+                element_name = local_name(element)
+                if (element_name == 'text' or (element_name == 'subfield' and element.get('code') == 'a')) \
+                        and element.text:
+                    headings.add(heading_key(element.text))
+
+    if name_type != 'Personal':
+        return None, 0, set()
+
+    headings.discard('')
+    return viaf_id, sources, headings
+
+
+def build_offline(dump_file_name, index_file_name) -> None:
+    """
+    Build the offline index from a VIAF clusters XML dump: a sqlite table of
+    (heading key, VIAF id, number of source records) for the main and
+    alternate headings of each personal name cluster.
+    """
+    index_path = Path(index_file_name)
+    if index_path.exists():
+        print(f'Replacing existing offline index {index_path}')
+        index_path.unlink()
+
+    conn = sqlite3.connect(index_file_name)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE headings (heading TEXT NOT NULL, viaf_id TEXT NOT NULL, sources INTEGER NOT NULL)')
+
+    rows = []
+    clusters = 0
+    with open_file(dump_file_name) as dump_file:
+        for line in dump_file:
+            try:
+                viaf_id, sources, headings = parse_cluster(line)
+            except ElementTree.ParseError as e:
+                print(f'Skipping cluster: {e}')
+                continue
+
+            if viaf_id is None:
+                continue
+            clusters += 1
+            rows.extend((heading, viaf_id, sources) for heading in headings)
+
+            if len(rows) >= OFFLINE_BATCH_SIZE:
+                conn.executemany('INSERT INTO headings VALUES (?, ?, ?)', rows)
+                rows = []
+                print(f'  indexed {clusters} clusters')
+
+    conn.executemany('INSERT INTO headings VALUES (?, ?, ?)', rows)
+    print('Creating index')
+    conn.execute('CREATE INDEX headings_heading ON headings (heading, sources DESC, viaf_id)')
+    conn.commit()
+    conn.close()
+
+    print(f'Indexed {clusters} personal name clusters in {index_file_name}')
+
+
+class OfflineIndex:
+    """ Match names against an offline index built by build_offline(). """
+
+    def __init__(self, index_file_name):
+        if not Path(index_file_name).is_file():
+            raise FileNotFoundError(f'No offline index found at {index_file_name}')
+        self.conn = sqlite3.connect(index_file_name)
+
+    def search(self, creator_norm) -> tuple:
+        """
+        Match a normalized name, like a VIAF search ordered by holdings; the
+        clusters with the most source records come first.
+
+        :return: (number of records, VIAF ids of the first matches)
+        """
+        key = heading_key(creator_norm)
+        count, = self.conn.execute('SELECT COUNT(*) FROM headings WHERE heading = ?', (key,)).fetchone()
+        ids = [
+            viaf_id for viaf_id, in self.conn.execute(
+                'SELECT viaf_id FROM headings WHERE heading = ? ORDER BY sources DESC, viaf_id LIMIT ?',
+                (key, int(viaf_search_params['maximumRecords']))
+            )
+        ]
+        return str(count), ids
+
+    def close(self):
+        self.conn.close()
+
+
+def fetch(conn, pending, args: Namespace) -> None:
+    """ Search VIAF for each normalized name missing from the cache, once. """
+    queries = []
+    seen = set()
+    for _, creator_norm in pending:
+        if creator_norm not in seen and cached_result(conn, creator_norm) is None:
+            queries.append(creator_norm)
+        seen.add(creator_norm)
+    print(f'{len(pending)} creators to write; {len(queries)} names to lookup')
+
+    client = ViafClient(args.base_url, args.rate, args.retries)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for count, result in enumerate(executor.map(client.lookup, queries), start=1):
+            if result is not None:
+                creator_norm, text, records, ids = result
+                conn.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)',
+                             (creator_norm, text, records, json.dumps(ids)))
+
+            if count % FLUSH_INTERVAL == 0:
+                conn.commit()
+    conn.commit()
 
-                    # Normalize the creator for the VIAF search
-                    creator_norm = normalize(creator)
-                    if creator_norm:
 
-                        out_row = [creator]
+def main(args: Namespace) -> None:
+    if args.build_offline:
+        build_offline(args.build_offline, args.offline)
+        return
 
-                        # Search in VIAF
-                        print(f'VIAF lookup: {creator}')
+    conn = open_cache(args.cache, args.outfile)
+    pending = pending_creators(args.manifest, conn)
 
-                        viaf_search_params['query'] = f'local.personalNames all "{creator_norm}"'
+    if args.offline:
+        print(f'{len(pending)} creators to match in {args.offline}')
+        offline = OfflineIndex(args.offline)
+        results = offline.search
+    else:
+        offline = None
+        fetch(conn, pending, args)
+        results = partial(cached_result, conn)
 
-                        response = requests.get(f'{viaf_base_url}/search', params=viaf_search_params)
-                        if response.ok:
+    # Open the CSV as output for write with append
+    with open(args.outfile, "a") as out_file:
+        csv_writer = writer(out_file)
 
-                            result = json.loads(response.text)['searchRetrieveResponse']
-                            out_row.append(result['numberOfRecords'])
+        for count, (creator, creator_norm) in enumerate(pending, start=1):
+            result = results(creator_norm)
+            if result is None:
+                # VIAF could not be reached or returned an error; searched again on restart
+                continue
 
-                            if 'records' in result:
-                                for record in result['records']:
-                                    id = record['record']['recordData']['viafID']['#text']
-                                    out_row.append(f'{viaf_base_url}/{id}')
+            csv_writer.writerow(output_row(creator, *result))
+            conn.execute('INSERT OR IGNORE INTO written VALUES (?)', (creator,))
 
-                        csv_writer.writerow(out_row)
+            # Flush before recording the creators as written, so that a
+            # restart may repeat a row but never loses one
+            if count % FLUSH_INTERVAL == 0:
+                out_file.flush()
+                conn.commit()
 
-                        # Clear the buffer by flushing, to ensure we don't lose any entries
-                        out_file.flush()
+    conn.commit()
+    conn.close()
+    if offline is not None:
+        offline.close()
 
-                        already_searched.add(creator)
 
+if __name__ == '__main__':
+    main(process_args())
@@ -0,0 +1,40 @@
+import threading
+import time
+
+# Token bucket rate limiting shared by the worker threads of a script, for
+# throttling reads from shared storage or requests to a remote service.
+
+
+class TokenBucket:
+    """
+    Limit the rate of some quantity, such as bytes read or requests sent,
+    across threads. Tokens accumulate at rate per second, up to burst.
+    A caller taking more tokens than are available is put to sleep until
+    the deficit has been refilled, so large requests are allowed but paid
+    for.::
+
+        bucket = TokenBucket(rate=50 * 1024 * 1024)
+        ...
+        bucket.take(len(chunk))
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f'Rate must be positive: {rate}')
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        """ Take tokens, sleeping until the bucket has refilled enough to cover them. """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
@@ -1,117 +1,798 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import math
+import os
 import sys
+from argparse import ArgumentParser, Namespace
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from catalog import connect
+from compressed import compression, open_file
 
 # Some basic stats about the Fedora 2 FOXML objects in streaming
-# JSON format
+# JSON format, read from the (optionally compressed) file given as the
+# first argument, from stdin, or from a sqlite catalog built by catalog.py
+#
+# The stats for a large file can be collected by a pool of processes (--jobs),
+# or per shard on separate hosts and combined afterwards:
+#
+#   host1$ scripts/stats.py --save-summary=shard1.json info-1.json
+#   host2$ scripts/stats.py --save-summary=shard2.json info-2.json
+#   scripts/stats.py --merge shard1.json shard2.json
+#
+# For a file which grows by appending records, --state keeps the counters
+# with the offset of the lines already counted, so the next run only counts
+# the new lines:
+#
+#   scripts/stats.py --state=export/info-stats.json export/info.json
 
-# Setup the counters
-count = defaultdict(int)
+DO_TYPES = ['none', 'umdm', 'umam']
 
-count['collection'] = defaultdict(int)
+# Multiplier to order (object id, relationship sequence) pairs by a single number
+POSITION = 1000000
 
-count['rels'] = defaultdict(int)
+# Number of file ranges scanned by each process with --jobs
+CHUNKS_PER_JOB = 4
 
-for doType in ['none', 'umdm', 'umam']:
-    count[doType] = defaultdict(int)
-    count[doType]['type'] = defaultdict(int)
-    count[doType]['status'] = defaultdict(int)
+# Groupings of the datastream sizes, reported with --sizes
+SIZE_GROUPS = ['collection', 'mimeType', 'contentModel']
 
-# Map collection pid to title
-collections = {}
+# Quantiles of the datastream sizes, reported with --sizes
+SIZE_QUANTILES = [0.5, 0.9, 0.99]
 
-# Collect stats from each object
-for line in sys.stdin:
-    count['total'] += 1
+# Relative accuracy of the size quantiles
+SIZE_ACCURACY = 0.01
 
-    try:
-        record = json.loads(line)
+# Bytes before the checkpointed offset which are checksummed to detect a
+# rewritten input file
+CHECKSUM_WINDOW = 1024 * 1024
+
+
+def process_args() -> Namespace:
+    """ Process command line arguments. """
+
+    # Setup command line arguments
+    parser = ArgumentParser()
+
+    parser.add_argument("infile", nargs='?', default='-',
+                        type=str,
+                        help="JSON input file (default: stdin)")
+
+    parser.add_argument("-g", "--catalog",
+                        type=str,
+                        help="sqlite catalog built by catalog.py, used instead of the JSON input")
+
+    parser.add_argument("-z", "--sizes",
+                        default=False, action='store_true',
+                        help=(
+                            "Also report datastream size totals and quantiles by the object's "
+                            "collection (a UMAM part's parent's) and content model, and by mimeType"
+                        ))
+
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes scanning an uncompressed input file (default: 1)")
+
+    parser.add_argument("-s", "--save-summary",
+                        type=str,
+                        help=(
+                            "Write the counters to a JSON summary file, for merging with --merge; "
+                            "the datastream sizes are only included with --sizes"
+                        ))
+
+    parser.add_argument("-t", "--state",
+                        type=str,
+                        help=(
+                            "Checkpoint file for an uncompressed input file which grows by "
+                            "appending; only lines added since the last run are counted"
+                        ))
+
+    parser.add_argument("-m", "--merge",
+                        type=str,
+                        nargs='+',
+                        help="Merge JSON summary files of consecutive shards, instead of reading input")
+
+    # Process command line arguments
+    return parser.parse_args()
+
+
+class Summary:
+    """
+    Counters for the stats, which can be serialized and merged. Merging the
+    summaries of consecutive parts of the input, in order, gives the same
+    result as counting the whole input in one pass.
+
+    Datastream sizes are only collected when sizes is True, as they are
+    only reported with --sizes and are the most expensive counters. The
+    sizes of a UMAM object, which has no collection of its own, count for
+    the collections of the UMDM object which has it as a part; the sizes of
+    a part seen before its parent, and the collections of a parent's parts
+    not yet seen, are kept until the other is found.
+    """
+
+    def __init__(self, sizes=False):
+        self.collect_sizes = sizes
 
+        # Setup the counters
+        self.count = defaultdict(int)
+
+        self.count['collection'] = defaultdict(int)
+
+        self.count['rels'] = defaultdict(int)
+
+        for doType in DO_TYPES:
+            self.count[doType] = defaultdict(int)
+            self.count[doType]['type'] = defaultdict(int)
+            self.count[doType]['status'] = defaultdict(int)
+
+        # Map collection pid to title
+        self.collections = {}
+
+        # Datastream size sketches, by group and group value
+        self.sizes = {group: {} for group in SIZE_GROUPS}
+
+        # Map part pid to the collections of its parent, for parts not yet seen
+        self.part_collections = {}
+
+        # Map pid to the datastream sizes of a UMAM object without collections
+        # whose parent has not been seen yet
+        self.pending_sizes = {}
+
+    def add_size(self, group, key, size):
+        """ Add a datastream size to the sketch for a group value. """
+        sketches = self.sizes[group]
+        if key not in sketches:
+            sketches[key] = SizeSketch()
+        sketches[key].add(size)
+
+    def add_collection_sizes(self, collections, sizes):
+        """ Add datastream sizes to the sketches of each collection. """
+        for collection in collections:
+            for size in sizes:
+                self.add_size('collection', collection, size)
+
+    def add_parts(self, parts, collections):
+        """ Count the sizes of a parent's parts for the parent's collections. """
+        for part in parts:
+            if part in self.pending_sizes:
+                self.add_collection_sizes(collections, self.pending_sizes.pop(part))
+            else:
+                # the first parent of a part wins
+                self.part_collections.setdefault(part, collections)
+
+    def add_sizes(self, record):
+        """
+        Add the datastream sizes of an object, grouped by the object's
+        collections (or those of its parent) and content model and by the
+        datastream mimeType.
+        """
+        ds = record.get('ds', {})
+        rels = ds.get('rels-mets', {}).get('rels', {})
+        collections = rels.get('isMemberOfCollection')
+        content_model = record.get('contentModel', '<none>')
         pid = record['pid']
-        is_collection = False
 
-        if 'ds' in record:
-            ds = record['ds']
+        sizes = []
+        for datastream in ds.values():
+            size = datastream.get('size')
+            if size is None:
+                continue
+
+            sizes.append(size)
+            self.add_size('mimeType', datastream.get('mimeType', '<none>'), size)
+            self.add_size('contentModel', content_model, size)
+
+        # a UMAM object counts for the collections of its parent
+        parent_collections = self.part_collections.pop(pid, None)
+        if collections or 'amInfo' not in ds:
+            self.add_collection_sizes(collections or ['<none>'], sizes)
+        elif parent_collections is not None:
+            self.add_collection_sizes(parent_collections, sizes)
+        elif sizes:
+            self.pending_sizes[pid] = sizes
+
+        if rels.get('hasPart'):
+            self.add_parts(rels['hasPart'], rels.get('isMemberOfCollection') or ['<none>'])
+
+    def collection_sizes(self):
+        """
+        Datastream size sketches by collection, with the sizes of the objects
+        whose parent was never seen counted as <none>.
+        """
+        sketches = dict(self.sizes['collection'])
+        if self.pending_sizes:
+            none = SizeSketch()
+            if '<none>' in sketches:
+                none.merge(sketches['<none>'])
+            for sizes in self.pending_sizes.values():
+                for size in sizes:
+                    none.add(size)
+            sketches['<none>'] = none
+        return sketches
+
+    def add(self, line):
+        """ Collect stats from one object. """
+        count = self.count
+        collections = self.collections
+
+        count['total'] += 1
+
+        try:
+            record = json.loads(line)
+
+            pid = record['pid']
+            is_collection = False
+
+            if 'ds' in record:
+                ds = record['ds']
+
+                if not ('doInfo' in ds or 'amInfo' in ds):
+                    count['none']['total'] += 1
+
+                if 'doInfo' in ds:
+                    do = ds['doInfo']
+                    count['umdm']['total'] += 1
+
+                    if 'type' in do:
+                        count['umdm']['type'][do['type']] += 1
+
+                        if do['type'] == "UMD_COLLECTION":
+                            is_collection = True
+
+                    if 'status' in do:
+                        count['umdm']['status'][do['status']] += 1
+
+                if 'amInfo' in ds:
+                    do = ds['amInfo']
+                    count['umam']['total'] += 1
+
+                    if 'type' in do:
+                        count['umam']['type'][do['type']] += 1
+
+                    if 'status' in do:
+                        count['umam']['status'][do['status']] += 1
+
+                if 'rels-mets' in ds:
+                    rels = ds['rels-mets']['rels']
+
+                    for rel, values in rels.items():
+                        for p in values:
+                            if rel == 'isMemberOfCollection':
+                                count['collection'][p] += 1
+
+                            count['rels'][rel] += 1
+
+                if 'umdm' in ds:
+                    umdm = ds['umdm']
+
+                    if is_collection:
+                        if pid not in count['collection']:
+                            count['collection'][pid] = 0
+
+                        if 'umdm_title' in umdm:
+                            collections[pid] = umdm['umdm_title']
+                        else:
+                            collections[pid] = "<missing title>"
+
+                if self.collect_sizes:
+                    self.add_sizes(record)
+
+        except Exception as e:
+            print(f'{type(e)}: {e}')
+            print(line)
+
+    def merge(self, other):
+        """ Add the counts of a summary of the input following this one. """
+        self.count['total'] += other.count['total']
+
+        for doType in DO_TYPES:
+            self.count[doType]['total'] += other.count[doType]['total']
+            for key in ['type', 'status']:
+                merge_counts(self.count[doType][key], other.count[doType][key])
+
+        merge_counts(self.count['rels'], other.count['rels'])
+        merge_counts(self.count['collection'], other.count['collection'])
+
+        # the last title seen for a collection wins
+        self.collections.update(other.collections)
+
+        for group in SIZE_GROUPS:
+            for key, sketch in other.sizes[group].items():
+                if key not in self.sizes[group]:
+                    self.sizes[group][key] = SizeSketch()
+                self.sizes[group][key].merge(sketch)
+
+        # join the parts and parents found on either side
+        joined = set()
+        for pid in list(self.pending_sizes):
+            if pid in other.part_collections:
+                self.add_collection_sizes(other.part_collections[pid], self.pending_sizes.pop(pid))
+                joined.add(pid)
+        for pid, sizes in other.pending_sizes.items():
+            if pid in self.part_collections:
+                self.add_collection_sizes(self.part_collections.pop(pid), sizes)
+            else:
+                self.pending_sizes[pid] = sizes
+        for pid, collections in other.part_collections.items():
+            if pid not in joined:
+                self.part_collections.setdefault(pid, collections)
+
+        return self
+
+    def to_dict(self):
+        """ Serializable form of the summary. """
+        return {
+            'count': json.loads(json.dumps(self.count)),
+            'collections': self.collections,
+            'sizes': {
+                group: {key: sketch.to_dict() for key, sketch in sketches.items()}
+                for group, sketches in self.sizes.items()
+            },
+            'parts': self.part_collections,
+            'pending': self.pending_sizes,
+        }
+
+    @classmethod
+    def from_dict(cls, data, sizes=False):
+        """ Summary from its serializable form. """
+        summary = cls(sizes)
+        summary.count['total'] = data['count'].get('total', 0)
+
+        for doType in DO_TYPES:
+            counts = data['count'].get(doType, {})
+            summary.count[doType]['total'] = counts.get('total', 0)
+            for key in ['type', 'status']:
+                summary.count[doType][key].update(counts.get(key, {}))
+
+        summary.count['rels'].update(data['count'].get('rels', {}))
+        summary.count['collection'].update(data['count'].get('collection', {}))
+        summary.collections.update(data['collections'])
+
+        for group, sketches in data.get('sizes', {}).items():
+            for key, sketch in sketches.items():
+                summary.sizes[group][key] = SizeSketch.from_dict(sketch)
+        summary.part_collections.update(data.get('parts', {}))
+        summary.pending_sizes.update(data.get('pending', {}))
+
+        return summary
+
+    def report(self):
+        """ Print the result. """
+        count = self.count
+        collections = self.collections
 
-            if not ('doInfo' in ds or 'amInfo' in ds):
-                count['none']['total'] += 1
+        print(f"Total Ojects: {count['total']}")
 
-            if 'doInfo' in ds:
-                do = ds['doInfo']
-                count['umdm']['total'] += 1
+        for doType in DO_TYPES:
+            print()
+            print(doType)
+            print(f"  total: {count[doType]['total']}")
+            print(f"  type:")
+            for type in count[doType]['type']:
+                print(f"    {type}: {count[doType]['type'][type]}")
+            print(f"  status:")
+            for type in count[doType]['status']:
+                print(f"    {type}: {count[doType]['status'][type]}")
 
-                if 'type' in do:
-                    count['umdm']['type'][do['type']] += 1
+        print()
+        print("relationships")
+        for rel, c in count['rels'].items():
+            print(f"  {rel}: {c}")
 
-                    if do['type'] == "UMD_COLLECTION":
-                        is_collection = True
+        print()
+        print("isMemberOfCollection")
+        for pid, c in count['collection'].items():
+            if pid in collections:
+                title = collections[pid]
+            else:
+                title = "<missing collection>"
 
-                if 'status' in do:
-                    count['umdm']['status'][do['status']] += 1
+            print(f"  {pid} - {title}: {c}")
 
-            if 'amInfo' in ds:
-                do = ds['amInfo']
-                count['umam']['total'] += 1
+    def report_sizes(self):
+        """ Print the datastream size totals and quantiles. """
+        print()
+        print("datastream sizes (bytes)")
+        for group in SIZE_GROUPS:
+            print(f"  {group}:")
+            sketches = self.collection_sizes() if group == 'collection' else self.sizes[group]
+            for key, sketch in sorted(sketches.items(), key=lambda item: -item[1].total):
+                if group == 'collection' and key in self.collections:
+                    key = f"{key} - {self.collections[key]}"
 
-                if 'type' in do:
-                    count['umam']['type'][do['type']] += 1
+                quantiles = ", ".join(
+                    f"p{round(q * 100)}: {sketch.quantile(q)}" for q in SIZE_QUANTILES
+                )
+                print(f"    {key}: count: {sketch.count}, total: {sketch.total}, {quantiles}, max: {sketch.max}")
 
-                if 'status' in do:
-                    count['umam']['status'][do['status']] += 1
 
-            if 'rels-mets' in ds:
-                rels = ds['rels-mets']['rels']
+class SizeSketch:
+    """
+    Bounded-memory summary of a set of sizes: exact count, total and maximum,
+    and quantiles within SIZE_ACCURACY relative error. Sizes are counted in
+    logarithmic buckets, so memory grows with the range of the sizes, not
+    with their number. Sketches can be serialized and merged.
+    """
 
-                for rel, values in rels.items():
-                    for p in values:
-                        if rel == 'isMemberOfCollection':
-                            count['collection'][p] += 1
+    gamma = (1 + SIZE_ACCURACY) / (1 - SIZE_ACCURACY)
+    log_gamma = math.log(gamma)
 
-                        count['rels'][rel] += 1
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.zeros = 0
+        self.buckets = defaultdict(int)
 
-            if 'umdm' in ds:
-                umdm = ds['umdm']
+    def add(self, size):
+        """ Add a size; negative (unknown) sizes are counted as zero. """
+        self.count += 1
+        if size <= 0:
+            self.zeros += 1
+            return
 
-                if is_collection:
-                    if pid not in count['collection']:
-                        count['collection'][pid] = 0
+        self.total += size
+        self.max = max(self.max, size)
+        self.buckets[math.ceil(math.log(size) / self.log_gamma)] += 1
 
-                    if 'umdm_title' in umdm:
-                        collections[pid] = umdm['umdm_title']
-                    else:
-                        collections[pid] = "<missing title>"
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.zeros += other.zeros
+        merge_counts(self.buckets, other.buckets)
 
-    except Exception as e:
-        print(f'{type(e)}: {e}')
-        print(line)
+    def quantile(self, q):
+        """ Estimate the size at quantile q (0 to 1). """
+        if self.count == 0:
+            return 0
 
-# Print the result
-print(f"Total Ojects: {count['total']}")
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
 
-for doType in ['none', 'umdm', 'umam']:
-    print()
-    print(doType)
-    print(f"  total: {count[doType]['total']}")
-    print(f"  type:")
-    for type in count[doType]['type']:
-        print(f"    {type}: {count[doType]['type'][type]}")
-    print(f"  status:")
-    for type in count[doType]['status']:
-        print(f"    {type}: {count[doType]['status'][type]}")
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # midpoint of the bucket, capped by the largest size seen
+                return min(round(2 * self.gamma ** index / (self.gamma + 1)), self.max)
 
-print()
-print("relationships")
-for rel, c in count['rels'].items():
-    print(f"  {rel}: {c}")
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'zeros': self.zeros,
+            'buckets': sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.count = data['count']
+        sketch.total = data['total']
+        sketch.max = data['max']
+        sketch.zeros = data['zeros']
+        sketch.buckets.update((index, c) for index, c in data['buckets'])
+        return sketch
+
+
+def merge_counts(counts, other):
+    """ Add the counts in other to counts; new keys are added in the order of other. """
+    for key, c in other.items():
+        counts[key] += c
+
+
+def scan(infile, sizes=False):
+    """
+    Collect stats from each object in the JSON input.
+
+    :param sizes: also collect the datastream sizes
+    :return: Summary
+    """
+    summary = Summary(sizes)
+
+    for line in infile:
+        summary.add(line)
+
+    return summary
+
+
+def chunk_ranges(path, chunks):
+    """
+    Split a file into byte ranges which start and end on line boundaries.
+
+    :param path: file path
+    :param chunks: number of ranges
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, mode='rb') as infile:
+        for i in range(1, chunks):
+            infile.seek(max(size * i // chunks, boundaries[-1]))
+            if infile.tell() > 0:
+                infile.seek(infile.tell() - 1)
+                # finish the line the offset falls in
+                infile.readline()
+            boundaries.append(min(infile.tell(), size))
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def scan_range(path, start, end, sizes=False):
+    """ Collect stats from the lines in a byte range of a file. """
+    summary = Summary(sizes)
+
+    with open(path, mode='rb') as infile:
+        infile.seek(start)
+        position = start
+        while position < end:
+            line = infile.readline()
+            if not line:
+                break
+            position += len(line)
+            summary.add(line.decode('utf-8'))
+
+    return summary.to_dict()
+
+
+def scan_parallel(path, jobs, sizes=False):
+    """
+    Collect stats from an (uncompressed) file using a pool of processes, each
+    scanning a range of lines, then merge the results in file order.
+
+    :return: Summary
+    """
+    ranges = chunk_ranges(path, jobs * CHUNKS_PER_JOB)
+
+    summary = Summary(sizes)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(scan_range, path, start, end, sizes) for start, end in ranges]
+        for future in futures:
+            summary.merge(Summary.from_dict(future.result()))
+
+    return summary
+
+
+def query_catalog(catalog_path, sizes=False):
+    """
+    Collect the same stats as scan() using indexed queries on a catalog.
+    Counts are listed in the order they are first seen in the JSON input.
+
+    :param sizes: also collect the datastream sizes
+    :return: Summary
+    """
+    summary = Summary(sizes)
+    count = summary.count
+    collections = summary.collections
+
+    conn = connect(catalog_path)
+    try:
+        def counts(query):
+            return conn.execute(query).fetchall()
+
+        count['total'] = counts('SELECT COUNT(*) FROM objects')[0][0]
+        count['none']['total'] = counts(
+            'SELECT COUNT(*) FROM objects WHERE has_ds = 1 AND has_doinfo = 0 AND has_aminfo = 0'
+        )[0][0]
+
+        for doType, prefix, flag in [('umdm', 'do', 'has_doinfo'), ('umam', 'am', 'has_aminfo')]:
+            count[doType]['total'] = counts(f'SELECT COUNT(*) FROM objects WHERE {flag} = 1')[0][0]
+
+            for key in ['type', 'status']:
+                column = f'{prefix}_{key}'
+                for value, c in counts(
+                        f'SELECT {column}, COUNT(*) FROM objects'
+                        f' WHERE {flag} = 1 AND {column} IS NOT NULL'
+                        f' GROUP BY {column} ORDER BY MIN(id)'):
+                    count[doType][key][value] = c
+
+        for rel, c in counts(
+                'SELECT relationship, COUNT(*) FROM relationships'
+                f' GROUP BY relationship ORDER BY MIN(object_id * {POSITION} + seq)'):
+            count['rels'][rel] = c
+
+        # Collections are listed when first referenced, or when the collection
+        # object itself is seen
+        first_seen = {}
+        for pid, c, position in counts(
+                f'SELECT target_pid, COUNT(*), MIN(object_id * {POSITION} + seq) FROM relationships'
+                " WHERE relationship = 'isMemberOfCollection' GROUP BY target_pid"):
+            first_seen[pid] = (position, c)
+
+        for pid, object_id, title in counts(
+                'SELECT pid, id, umdm_title FROM objects'
+                " WHERE has_doinfo = 1 AND do_type = 'UMD_COLLECTION' AND has_umdm = 1"
+                ' ORDER BY id'):
+            position = object_id * POSITION + POSITION - 1
+            if pid not in first_seen or position < first_seen[pid][0]:
+                first_seen[pid] = (position, first_seen.get(pid, (0, 0))[1])
+            collections[pid] = title if title is not None else "<missing title>"
+
+        for pid, (_, c) in sorted(first_seen.items(), key=lambda item: item[1][0]):
+            count['collection'][pid] = c
+
+        # Datastream sizes
+        if sizes:
+            # a UMAM object without collections counts for the collections of
+            # its first parent; the sizes of one without a parent are pending
+            for pid, owner_id, collection, size in conn.execute(
+                    'WITH owners AS ('
+                    '  SELECT d.rowid AS ds_id, d.size, o.pid,'
+                    '   CASE WHEN o.has_aminfo = 1 AND NOT EXISTS ('
+                    '    SELECT 1 FROM relationships m'
+                    "    WHERE m.object_id = o.id AND m.relationship = 'isMemberOfCollection')"
+                    '   THEN (SELECT h.object_id FROM relationships h'
+                    "    WHERE h.relationship = 'hasPart' AND h.target_pid = o.pid"
+                    '    ORDER BY h.object_id, h.seq LIMIT 1)'
+                    '   ELSE o.id END AS owner_id'
+                    '  FROM datastreams d JOIN objects o ON o.id = d.object_id'
+                    '  WHERE d.size IS NOT NULL)'
+                    " SELECT w.pid, w.owner_id, COALESCE(r.target_pid, '<none>'), w.size FROM owners w"
+                    ' LEFT JOIN relationships r'
+                    "  ON r.object_id = w.owner_id AND r.relationship = 'isMemberOfCollection'"
+                    ' ORDER BY w.ds_id'):
+                if owner_id is None:
+                    summary.pending_sizes.setdefault(pid, []).append(size)
+                else:
+                    summary.add_size('collection', collection, size)
+
+            size_queries = {
+                'mimeType':
+                    "SELECT COALESCE(mime_type, '<none>'), size FROM datastreams WHERE size IS NOT NULL",
+                'contentModel':
+                    "SELECT COALESCE(o.content_model, '<none>'), d.size FROM datastreams d"
+                    ' JOIN objects o ON o.id = d.object_id'
+                    ' WHERE d.size IS NOT NULL',
+            }
+            for group, query in size_queries.items():
+                for key, size in conn.execute(query):
+                    summary.add_size(group, key, size)
+
+    finally:
+        conn.close()
+
+    return summary
+
+
+def load_state(state_path):
+    """ Load the checkpoint state, or None if there is none. """
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, mode='r', encoding='UTF-8') as state_file:
+        return json.load(state_file)
+
+
+def save_state(state_path, summary, offset, checksum, stat):
+    """ Save the checkpoint state, replacing the previous state atomically. """
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, mode='w', encoding='UTF-8') as state_file:
+        json.dump({
+            'offset': offset,
+            'checksum': checksum,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'device': stat.st_dev,
+            'inode': stat.st_ino,
+            'sizes': summary.collect_sizes,
+            'summary': summary.to_dict(),
+        }, state_file)
+    os.replace(tmp_path, state_path)
+
+
+def checksum_window(infile, offset):
+    """
+    Checksum the CHECKSUM_WINDOW bytes of a file before offset.
+
+    :return: hex digest, or None if the file has fewer than offset bytes
+    """
+    start = max(0, offset - CHECKSUM_WINDOW)
+    infile.seek(start)
+    block = infile.read(offset - start)
+    if len(block) < offset - start:
+        return None
+    return hashlib.blake2b(block).hexdigest()
+
+
+def is_unchanged(infile, state) -> bool:
+    """
+    Check whether the part of a file counted in the last run is unchanged: the
+    file is the same inode, and either its size and mtime are those recorded,
+    or the checksum of the window before the offset still matches. The cost
+    does not grow with the size of the file.
+    """
+    stat = os.fstat(infile.fileno())
+    if (state.get('device'), state.get('inode')) != (stat.st_dev, stat.st_ino):
+        return False
+    if (state['size'], state['mtime']) == (stat.st_size, stat.st_mtime_ns):
+        return True
+    return stat.st_size >= state['offset'] and checksum_window(infile, state['offset']) == state['checksum']
+
+
+def scan_incremental(path, state_path, sizes=False):
+    """
+    Collect stats from the lines added to a file since the last run, starting
+    from the checkpointed counters. If the already counted part of the file
+    has changed, or the sizes were not collected the same way, all lines are
+    counted again. An incomplete last line is left for the next run.
+
+    :param sizes: also collect the datastream sizes
+    :return: Summary
+    """
+    state = load_state(state_path)
+    if state is not None and state.get('sizes', True) != sizes:
+        print(f'Datastream sizes were {"not " if sizes else ""}collected in the last run; '
+              'counting all lines', file=sys.stderr)
+        state = None
+
+    summary = Summary(sizes)
+    offset = 0
+
+    with open(path, mode='rb') as infile:
+        if state is not None:
+            if is_unchanged(infile, state):
+                summary = Summary.from_dict(state['summary'], sizes)
+                offset = state['offset']
+                print(f'Resuming from offset {offset} of {path}', file=sys.stderr)
+            else:
+                print(f'{path} was rewritten since the last run; counting all lines', file=sys.stderr)
+        infile.seek(offset)
+
+        for line in infile:
+            if not line.endswith(b'\n'):
+                break
+
+            offset += len(line)
+            summary.add(line.decode('utf-8'))
+
+        checksum = checksum_window(infile, offset)
+        stat = os.fstat(infile.fileno())
+
+    save_state(state_path, summary, offset, checksum, stat)
+
+    return summary
+
+
+def main(args: Namespace) -> None:
+    if args.catalog:
+        summary = query_catalog(args.catalog, args.sizes)
+
+    elif args.merge:
+        # Merge the summaries of consecutive shards, in the order given
+        summary = Summary()
+        for summary_path in args.merge:
+            with open_file(summary_path) as summary_file:
+                summary.merge(Summary.from_dict(json.load(summary_file)))
+
+    elif args.state:
+        if args.infile == '-' or compression(args.infile) is not None:
+            raise ValueError('--state requires an uncompressed input file')
+        summary = scan_incremental(args.infile, args.state, args.sizes)
+
+    elif args.jobs > 1 and args.infile != '-' and compression(args.infile) is None:
+        summary = scan_parallel(args.infile, args.jobs, args.sizes)
 
-print()
-print("isMemberOfCollection")
-for pid, c in count['collection'].items():
-    if pid in collections:
-        title = collections[pid]
     else:
-        title = "<missing collection>"
+        summary = scan(open_file(args.infile), args.sizes)
+
+    if args.save_summary:
+        with open_file(args.save_summary, mode='w') as summary_file:
+            json.dump(summary.to_dict(), summary_file)
+
+    summary.report()
+
+    if args.sizes:
+        summary.report_sizes()
+
 
-    print(f"  {pid} - {title}: {c}")
\ No newline at end of file
+if __name__ == '__main__':
+    main(process_args())
@@ -1,11 +1,46 @@
 #!/usr/bin/env python3
 
 '''Unit tests for Python scripts'''
+import csv
+import dbm
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
 import unittest
 
+from argparse import Namespace
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
 from xml.dom.minidom import parseString
 from avalon import BibRefToTextConverter, CsvColumnCounts, Object, ObjectToCsvConverter, XmlUtils
+import catalog
+import csv_rsync
+import duplicates
+import filter
+import fixity
+import inventory
+import inventory_diff
+import stats
+from compressed import compression, find_file, open_file
+from edit_distance import levenshtein, levenshtein_many
+from extsort import ExternalSorter, group_by_key, merge_join
+from jsonl_index import JsonlIndex, index_path
+from journal import Journal
+from ratelimit import TokenBucket
+
+# lookup-viaf.py is not importable by name
+_spec = importlib.util.spec_from_file_location('lookup_viaf', Path(__file__).with_name('lookup-viaf.py'))
+lookup_viaf = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(lookup_viaf)
 
 
 class TestObject(unittest.TestCase):
@@ -183,5 +218,1061 @@ class TestBibRefToTextConverter(unittest.TestCase):
         self.assertEqual('Test Title, Accession 2011-166, Accession ABC-123', BibRefToTextConverter.as_text(bib_ref))
 
 
+class TestExternalSorter(unittest.TestCase):
+    def test_sort_with_spills_is_stable(self):
+        items = [(f'umd:{i % 7}', i) for i in range(100)]
+
+        with ExternalSorter(memory_budget=50) as sorter:
+            for key, value in items:
+                sorter.add(key, value)
+            self.assertGreater(len(sorter.runs), 1)
+            self.assertEqual(sorted(items, key=lambda item: item[0]), list(sorter))
+
+    def test_tuple_keys(self):
+        with ExternalSorter(memory_budget=20) as sorter:
+            sorter.add(('umd:2', 1), 'b')
+            sorter.add(('umd:1', 2), 'a')
+            sorter.add(('umd:2', 0), 'c')
+            self.assertEqual(['a', 'c', 'b'], [value for _, value in sorter])
+
+    def test_group_by_key(self):
+        items = [('a', 1), ('a', 2), ('b', 3)]
+        self.assertEqual([('a', [1, 2]), ('b', [3])], list(group_by_key(items)))
+        self.assertEqual([], list(group_by_key([])))
+
+    def test_merge_join(self):
+        left = [('a', 1), ('c', 3)]
+        right = [('b', 20), ('c', 30), ('d', 40)]
+        self.assertEqual(
+            [('a', 1, None), ('b', None, 20), ('c', 3, 30), ('d', None, 40)],
+            list(merge_join(left, right))
+        )
+        self.assertEqual([('a', 1, None)], list(merge_join([('a', 1)], [])))
+
+
+class TestCompressed(unittest.TestCase):
+    def test_compression_from_extension(self):
+        self.assertEqual('gzip', compression('export/info.json.gz'))
+        self.assertEqual('zstd', compression('export/info.json.zst'))
+        self.assertIsNone(compression('export/info.json'))
+
+    def test_gzip_round_trip_with_append(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'info.json.gz')
+            with open_file(path, mode='w') as outfile:
+                outfile.writelines(f'{{"pid": "umd:{i}"}}\n' for i in range(1000))
+            with open_file(path, mode='a') as outfile:
+                outfile.write('{"pid": "umd:1000"}\n')
+
+            with open_file(path) as infile:
+                lines = list(infile)
+
+            self.assertEqual(1001, len(lines))
+            self.assertEqual('{"pid": "umd:1000"}\n', lines[-1])
+
+    def test_find_file(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'export.csv')
+            self.assertEqual(path, find_file(path))
+
+            Path(tmpdir, 'export.csv.zst').touch()
+            self.assertEqual(Path(tmpdir, 'export.csv.zst'), find_file(path))
+
+            path.touch()
+            self.assertEqual(path, find_file(path))
+
+
+INFO_RECORDS = [
+    {'pid': 'umd:1', 'foxml': 'objects/umd_1',
+     'ds': {'doInfo': {'type': 'UMD_COLLECTION', 'status': 'Complete', 'size': 10},
+            'umdm': {'umdm_title': 'Collection 1', 'size': 20}}},
+    {'pid': 'umd:2', 'foxml': 'objects/umd_2', 'contentModel': 'UMD_IMAGE',
+     'ds': {'doInfo': {'type': 'UMD_IMAGE', 'status': 'Complete', 'size': 10},
+            'rels-mets': {'rels': {'isMemberOfCollection': ['umd:3', 'umd:1'], 'hasPart': ['umd:4']}},
+            'umdm': {'umdm_title': 'Image 2'}}},
+    {'pid': 'umd:4', 'foxml': 'objects/umd_4',
+     'ds': {'amInfo': {'type': 'IMAGE', 'status': 'Private'},
+            'image': {'size': 1000, 'mimeType': 'image/tiff'}}},
+    {'pid': 'umd:5', 'foxml': 'objects/umd_5', 'ds': {'DC': {'size': 5}}},
+]
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.catalog_path = Path(self.tmpdir.name, 'info.db')
+        self.lines = [json.dumps(record) + '\n' for record in INFO_RECORDS]
+
+        conn = sqlite3.connect(str(self.catalog_path))
+        catalog.build(self.lines, conn)
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_build(self):
+        conn = catalog.connect(self.catalog_path)
+        self.assertEqual(
+            [('umd:2', 0, 'isMemberOfCollection', 'umd:3'),
+             ('umd:2', 1, 'isMemberOfCollection', 'umd:1'),
+             ('umd:2', 2, 'hasPart', 'umd:4')],
+            conn.execute(
+                'SELECT pid, seq, relationship, target_pid FROM relationships'
+                ' JOIN objects ON objects.id = object_id ORDER BY object_id, seq'
+            ).fetchall()
+        )
+        self.assertEqual(1000, conn.execute("SELECT size FROM datastreams WHERE dsid = 'image'").fetchone()[0])
+        conn.close()
+
+    def test_build_skips_bad_records(self):
+        lines = [self.lines[0], '{"pid": "umd:9", "ds": null}\n', 'not json\n'] + self.lines[1:]
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual(len(self.lines), catalog.build(lines, conn))
+        self.assertEqual(
+            [record['pid'] for record in INFO_RECORDS],
+            [pid for pid, in conn.execute('SELECT pid FROM objects ORDER BY id')]
+        )
+        conn.close()
+
+    def test_stats_from_catalog_match_scan(self):
+        for sizes in (False, True):
+            self.assertEqual(stats.scan(self.lines, sizes).to_dict(),
+                             stats.query_catalog(self.catalog_path, sizes).to_dict())
+
+
+class TestFilter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.infile_path = Path(self.tmpdir.name, 'info.json')
+        self.infile_path.write_text(''.join(json.dumps(record) + '\n' for record in INFO_RECORDS))
+
+        # cached handles, so that no lookups are made
+        self.handles_path = str(Path(self.tmpdir.name, 'handles'))
+        with dbm.open(self.handles_path, 'c') as handles:
+            for record in INFO_RECORDS:
+                handles[record['pid']] = f"hdl:1903.1/{record['pid'][4:]}"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_spec(self, spec, memory_budget=None):
+        """ Run filter.py with a --spec file, returning the pids written to each output file. """
+        spec_path = Path(self.tmpdir.name, 'spec.json')
+        for entry in spec:
+            entry['outfile'] = str(Path(self.tmpdir.name, entry['outfile']))
+        spec_path.write_text(json.dumps(spec))
+
+        with open(self.infile_path) as infile, open(spec_path) as spec_file:
+            args = Namespace(infile=infile, catalog=None, outfile=None, spec=spec_file,
+                             handles=self.handles_path, memory_budget=memory_budget,
+                             filter_defaults={'collection': [], 'status': ['Complete', 'Private'], 'type': [],
+                                              'random': 0, 'seed': '0', 'fields': []})
+            filter.main(args)
+
+        outputs = {}
+        for entry in spec:
+            with open(entry['outfile']) as outfile:
+                outputs[entry['name']] = [json.loads(line) for line in outfile]
+        return outputs
+
+    def test_spec_outputs_have_own_selection(self):
+        spec = [
+            {'name': 'all', 'outfile': 'all.json'},
+            {'name': 'images', 'outfile': 'images.json', 'type': 'UMD_IMAGE'},
+            {'name': 'collection', 'outfile': 'collection.json', 'collection': ['umd:3']},
+            {'name': 'none', 'outfile': 'none.json', 'status': 'Pending'},
+        ]
+        for memory_budget in (None, 1):
+            outputs = self.run_spec([dict(entry) for entry in spec], memory_budget)
+
+            self.assertEqual(['umd:1', 'umd:2'], [obj['pid'] for obj in outputs['all']])
+            self.assertEqual(['umd:2'], [obj['pid'] for obj in outputs['images']])
+            self.assertEqual(['umd:4'], [part['pid'] for part in outputs['images'][0]['hasPart']])
+            self.assertEqual('hdl:1903.1/2', outputs['images'][0]['handle'])
+            self.assertEqual(['umd:2'], [obj['pid'] for obj in outputs['collection']])
+            self.assertEqual([], outputs['none'])
+
+    def test_spec_random_sample(self):
+        # string and number values, as accepted on the command line
+        spec = [{'name': 'sample', 'outfile': 'sample.json', 'random': '2', 'seed': 7}]
+        outputs = self.run_spec(spec)
+        expected = [pid for pid in ('umd:1', 'umd:2') if filter.sample_bucket(pid, '7', 2) == 0]
+        self.assertEqual(expected, [obj['pid'] for obj in outputs['sample']])
+
+    def test_sample_bucket(self):
+        pids = [f'umd:{i}' for i in range(10000)]
+        buckets = [filter.sample_bucket(pid, 'seed', 10) for pid in pids]
+
+        self.assertEqual(buckets, [filter.sample_bucket(pid, 'seed', 10) for pid in pids])
+        self.assertNotEqual(buckets, [filter.sample_bucket(pid, 'other', 10) for pid in pids])
+        self.assertTrue(900 < buckets.count(0) < 1100)
+
+        # seeds longer than the maximum blake2b key size
+        self.assertIn(filter.sample_bucket('umd:1', 'x' * 100, 10), range(10))
+
+    def test_projection(self):
+        obj = {'pid': 'umd:2', 'foxml': 'objects/umd_2',
+               'ds': {'doInfo': {'type': 'UMD_IMAGE', 'status': 'Complete'}, 'umdm': {'umdm_title': 'Image 2'}},
+               'hasPart': [{'pid': 'umd:4', 'ds': {}}, {'pid': 'umd:6'}]}
+        tree = filter.setup_projection(['ds.doInfo.type', 'hasPart.pid'])
+        self.assertEqual(
+            {'ds': {'doInfo': {'type': 'UMD_IMAGE'}}, 'hasPart': [{'pid': 'umd:4'}, {'pid': 'umd:6'}]},
+            filter.project(obj, tree)
+        )
+        # a parent key selects its complete value
+        self.assertEqual({'ds': None}, filter.setup_projection(['ds', 'ds.doInfo.type']))
+        self.assertEqual({}, filter.setup_projection([]))
+
+    def test_spec_export_fields(self):
+        outputs = self.run_spec([{'name': 'images', 'outfile': 'images.json', 'type': 'UMD_IMAGE',
+                                  'fields': 'export'}])
+        self.assertEqual(
+            [{'pid': 'umd:2', 'foxml': 'objects/umd_2',
+              'ds': {'doInfo': {'type': 'UMD_IMAGE', 'status': 'Complete'},
+                     'rels-mets': {'rels': {'isMemberOfCollection': ['umd:3', 'umd:1']}}},
+              'title': 'Image 2', 'handle': 'hdl:1903.1/2',
+              'hasPart': [{'pid': 'umd:4', 'foxml': 'objects/umd_4'}]}],
+            outputs['images']
+        )
+
+
+class TestStatsSummary(unittest.TestCase):
+    def setUp(self):
+        self.lines = [json.dumps(record) + '\n' for record in INFO_RECORDS]
+
+    def test_merge_of_parts_matches_single_scan(self):
+        expected = stats.scan(self.lines, sizes=True).to_dict()
+
+        for split in range(len(self.lines) + 1):
+            first = stats.scan(self.lines[:split], sizes=True)
+            second = stats.Summary.from_dict(
+                json.loads(json.dumps(stats.scan(self.lines[split:], sizes=True).to_dict()))
+            )
+            merged = first.merge(second).to_dict()
+
+            self.assertEqual(expected, merged)
+            # keys are listed in the order they were first seen
+            self.assertEqual(list(expected['count']['collection']), list(merged['count']['collection']))
+
+    def test_size_sketch_quantiles(self):
+        sketch = stats.SizeSketch()
+        sizes = list(range(1, 10001))
+        for size in sizes:
+            sketch.add(size)
+
+        self.assertEqual(10000, sketch.count)
+        self.assertEqual(sum(sizes), sketch.total)
+        self.assertEqual(10000, sketch.max)
+        for q in stats.SIZE_QUANTILES:
+            exact = sizes[int(q * (len(sizes) - 1))]
+            self.assertAlmostEqual(exact, sketch.quantile(q), delta=exact * stats.SIZE_ACCURACY * 2)
+
+    def test_sizes_are_grouped(self):
+        summary = stats.scan(self.lines, sizes=True)
+
+        self.assertEqual(1000, summary.sizes['mimeType']['image/tiff'].total)
+        # the image of the UMAM part umd:4 counts for the collections of its UMDM umd:2
+        self.assertEqual(1010, summary.sizes['collection']['umd:3'].total)
+        self.assertEqual(1010, summary.sizes['collection']['umd:1'].total)
+        self.assertEqual(35, summary.sizes['collection']['<none>'].total)
+        self.assertEqual(10, summary.sizes['contentModel']['UMD_IMAGE'].total)
+
+        # sizes are only collected when they are reported
+        self.assertEqual({group: {} for group in stats.SIZE_GROUPS}, stats.scan(self.lines).sizes)
+
+    def test_part_sizes_count_for_parent_collections(self):
+        orphan = {'pid': 'umd:6', 'ds': {'amInfo': {'type': 'IMAGE'}, 'image': {'size': 7}}}
+        # the part before its parent, and a part without a parent
+        records = [INFO_RECORDS[2], orphan] + INFO_RECORDS[:2] + INFO_RECORDS[3:]
+        lines = [json.dumps(record) + '\n' for record in records]
+
+        summary = stats.scan(lines, sizes=True)
+        self.assertEqual(1010, summary.sizes['collection']['umd:3'].total)
+        self.assertEqual({'umd:6': [7]}, summary.pending_sizes)
+        self.assertEqual(42, summary.collection_sizes()['<none>'].total)
+
+        expected = summary.to_dict()
+        for split in range(len(lines) + 1):
+            first = stats.scan(lines[:split], sizes=True)
+            second = stats.Summary.from_dict(json.loads(json.dumps(stats.scan(lines[split:], sizes=True).to_dict())))
+            self.assertEqual(expected, first.merge(second).to_dict())
+
+        with TemporaryDirectory() as tmpdir:
+            catalog_path = Path(tmpdir, 'info.db')
+            conn = sqlite3.connect(str(catalog_path))
+            catalog.build(lines, conn)
+            conn.close()
+            self.assertEqual(expected, stats.query_catalog(catalog_path, sizes=True).to_dict())
+
+    def test_incremental_scan_counts_only_new_lines(self):
+        with TemporaryDirectory() as tmpdir:
+            info_path = Path(tmpdir, 'info.json')
+            state_path = str(Path(tmpdir, 'state.json'))
+
+            info_path.write_text(''.join(self.lines[:2]))
+            stats.scan_incremental(str(info_path), state_path)
+
+            with info_path.open(mode='a') as info_file:
+                info_file.write(''.join(self.lines[2:]))
+            summary = stats.scan_incremental(str(info_path), state_path)
+
+            self.assertEqual(stats.scan(self.lines).to_dict(), summary.to_dict())
+            self.assertEqual(info_path.stat().st_size, stats.load_state(state_path)['offset'])
+
+            # a rewritten file is counted again from the start
+            info_path.write_text(''.join(self.lines[1:]))
+            summary = stats.scan_incremental(str(info_path), state_path)
+            self.assertEqual(stats.scan(self.lines[1:]).to_dict(), summary.to_dict())
+
+            # as is a file scanned without sizes, when sizes are wanted
+            summary = stats.scan_incremental(str(info_path), state_path, sizes=True)
+            self.assertEqual(stats.scan(self.lines[1:], sizes=True).to_dict(), summary.to_dict())
+
+            # an in-place change before the offset, keeping the size and inode,
+            # is found by the checksum window
+            with info_path.open(mode='r+b') as info_file:
+                info_file.seek(-len(self.lines[-1]), os.SEEK_END)
+                info_file.write(self.lines[0].encode('utf-8')[:len(self.lines[-1])])
+            os.utime(info_path, ns=(0, 0))
+            with info_path.open() as info_file:
+                lines = [line for line in info_file if line.endswith('\n')]
+            summary = stats.scan_incremental(str(info_path), state_path, sizes=True)
+            self.assertEqual(stats.scan(lines, sizes=True).to_dict(), summary.to_dict())
+
+    def test_parallel_scan_matches_single_scan(self):
+        with TemporaryDirectory() as tmpdir:
+            info_path = Path(tmpdir, 'info.json')
+            info_path.write_text(''.join(self.lines * 25))
+
+            with open_file(info_path) as infile:
+                expected = stats.scan(infile).to_dict()
+
+            self.assertEqual(expected, stats.scan_parallel(str(info_path), 2).to_dict())
+
+
+class TestJsonlIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.info_path = Path(self.tmpdir.name, 'info.json')
+        with self.info_path.open(mode='w') as info_file:
+            for record in INFO_RECORDS + [{'pid': 'umd:2', 'foxml': 'objects/umd_2_dup'}]:
+                info_file.write(json.dumps(record) + '\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_all_records_for_pid(self):
+        with JsonlIndex(self.info_path) as index:
+            lines = index.get('umd:2')
+
+        self.assertTrue(index_path(self.info_path).is_file())
+        self.assertEqual(['objects/umd_2', 'objects/umd_2_dup'], [json.loads(line)['foxml'] for line in lines])
+
+    def test_extract_in_file_order(self):
+        output = io.BytesIO()
+        with JsonlIndex(self.info_path) as index:
+            self.assertEqual(2, index.extract(['umd:4', 'umd:1', 'umd:404'], output))
+
+        self.assertEqual(['umd:1', 'umd:4'], [json.loads(line)['pid'] for line in output.getvalue().splitlines()])
+
+    def test_rebuild_when_source_changes(self):
+        with JsonlIndex(self.info_path) as index:
+            self.assertEqual([], index.get('umd:6'))
+
+        with self.info_path.open(mode='a') as info_file:
+            info_file.write(json.dumps({'pid': 'umd:6'}) + '\n')
+
+        with JsonlIndex(self.info_path) as index:
+            self.assertEqual(1, len(index.get('umd:6')))
+
+
+class TestCsvRsync(unittest.TestCase):
+    def test_make_batches_groups_by_directory(self):
+        rows = [('a/1', 'x/1'), ('a/2', 'x/2'), ('b/1', 'y/1'), ('a/3', 'x/renamed'), ('a/4', 'x/4')]
+        batches = csv_rsync.make_batches(rows, '/src', '/dst', 2)
+
+        self.assertEqual(
+            [
+                ('/src/a', '/dst/x', [('1', '1'), ('2', '2')]),
+                ('/src/b', '/dst/y', [('1', '1')]),
+                ('/src/a', '/dst/x', [('3', 'renamed')]),
+                ('/src/a', '/dst/x', [('4', '4')]),
+            ],
+            [(batch.source_dir, batch.dest_dir, batch.files) for batch in batches]
+        )
+
+    def test_directory_rows_are_transferred_individually(self):
+        with TemporaryDirectory() as tmpdir:
+            for name in ('1', '2', 'd/3'):
+                Path(tmpdir, 'src', name).parent.mkdir(parents=True, exist_ok=True)
+                Path(tmpdir, 'src', name).write_bytes(b'x')
+
+            rows = [('1', 'z/1'), ('d', 'z/d'), ('2', 'z/2')]
+            batches = csv_rsync.make_batches(rows, str(Path(tmpdir, 'src')), str(Path(tmpdir, 'dst')), 10)
+            self.assertEqual([[('1', '1'), ('2', '2')], [('d', 'd')]], [batch.files for batch in batches])
+
+            commands = []
+
+            def run(command, **kwargs):
+                commands.append(command)
+                return subprocess.CompletedProcess(command, 0, stdout='')
+
+            with mock.patch('csv_rsync.subprocess.run', run):
+                for batch in batches:
+                    csv_rsync.rsync(batch)
+
+            self.assertEqual(['rsync', '-a', '-r', '--files-from=-'], commands[0][:4])
+            self.assertEqual(['rsync', '-a', str(Path(tmpdir, 'src', 'd')), str(Path(tmpdir, 'dst', 'z', 'd'))],
+                             commands[1])
+
+    def test_rsync_creates_remote_directory(self):
+        commands = []
+
+        def run(command, **kwargs):
+            commands.append(command)
+            return subprocess.CompletedProcess(command, 0, stdout='')
+
+        batch = csv_rsync.Batch('/src/a', 'host:/dst/new dir')
+        batch.files.append(('1', '1'))
+        daemon = csv_rsync.Batch('/src/a', 'host::module/x')
+        daemon.files.append(('1', '1'))
+        with mock.patch('csv_rsync.subprocess.run', run), mock.patch('csv_rsync.os.makedirs') as makedirs:
+            csv_rsync.rsync(batch)
+            csv_rsync.rsync(daemon)
+        makedirs.assert_not_called()
+
+        self.assertEqual(['rsync', '-a', "--rsync-path=mkdir -p '/dst/new dir' && rsync",
+                          '/src/a/1', 'host:/dst/new dir/1'], commands[0])
+        self.assertEqual(['rsync', '-a', '/src/a/1', 'host::module/x/1'], commands[1])
+
+    def test_failed_batch_is_retried_by_row(self):
+        with TemporaryDirectory() as tmpdir:
+            for name in ('1', '2', '3'):
+                Path(tmpdir, name).write_bytes(b'x')
+            batch = csv_rsync.Batch(tmpdir, str(Path(tmpdir, 'dst')))
+            batch.files = [('1', '1'), ('2', '2'), ('3', '3')]
+
+            def run(command, **kwargs):
+                # a partial transfer, in which file 2 fails
+                returncode = 23 if '--files-from=-' in command or command[-2].endswith('2') else 0
+                return subprocess.CompletedProcess(command, returncode, stdout='')
+
+            with mock.patch('csv_rsync.subprocess.run', run):
+                _, completed, error = csv_rsync.transfer(batch)
+
+            self.assertEqual(['1', '3'], [source_name for source_name, _, _, _ in completed])
+            self.assertIn('status 23', error)
+
+    def test_remote_rows_are_completed(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            input_file = tmpdir / 'rows.csv'
+            input_file.write_text('source,destination\na/1,x/1\na/2,x/2\n')
+            journal_path = str(tmpdir / 'journal.jsonl')
+            args = Namespace(input_file=str(input_file), source_dir_prefix='host:/src', dest_dir_prefix=str(tmpdir),
+                             batch_size=10, workers=1, backend='rsync', hardlink=False, order='csv',
+                             journal=journal_path)
+            commands = []
+
+            def run(command, **kwargs):
+                # rsync succeeds, without creating the destination files
+                commands.append(command)
+                return subprocess.CompletedProcess(command, 0, stdout='')
+
+            output = io.StringIO()
+            with mock.patch('csv_rsync.subprocess.run', run), redirect_stdout(output):
+                csv_rsync.main(args)
+            self.assertIn('Synced 2 files', output.getvalue())
+            self.assertIn('0 files failed', output.getvalue())
+
+            with Journal(journal_path) as journal:
+                self.assertEqual(2, len(journal))
+                entry = journal.get(csv_rsync.row_key(Path('host:/src/a/1'), tmpdir / 'x' / '1'))
+                self.assertEqual((None, None), (entry['size'], entry['mtime']))
+
+            # a rerun skips the journaled rows
+            with mock.patch('csv_rsync.subprocess.run', run), redirect_stdout(io.StringIO()):
+                csv_rsync.main(args)
+            self.assertEqual(1, len(commands))
+
+    def test_native_copy_skips_current_files(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir, 'source.tif')
+            dest = Path(tmpdir, 'dest.tif')
+            source.write_bytes(b'image' * 1000)
+
+            self.assertIn(csv_rsync.copy_file(str(source), str(dest)), ('copied', 'reflinked'))
+            self.assertEqual(source.read_bytes(), dest.read_bytes())
+            self.assertEqual(int(source.stat().st_mtime), int(dest.stat().st_mtime))
+            self.assertEqual('skipped', csv_rsync.copy_file(str(source), str(dest)))
+
+            os.utime(str(dest), (0, 0))
+            self.assertEqual('linked', csv_rsync.copy_file(str(source), str(dest), hardlink=True))
+            self.assertEqual(source.stat().st_ino, dest.stat().st_ino)
+            self.assertEqual(['dest.tif', 'source.tif'], sorted(os.listdir(tmpdir)))
+
+    def test_native_copy_of_directory_row(self):
+        with TemporaryDirectory() as tmpdir:
+            for name in ('d1/sub/1', 'd1/sub/deeper/2'):
+                Path(tmpdir, 'src', name).parent.mkdir(parents=True, exist_ok=True)
+                Path(tmpdir, 'src', name).write_bytes(name.encode('utf-8'))
+            Path(tmpdir, 'src', 'd1/sub/link').symlink_to('1')
+
+            batches = csv_rsync.make_batches([('d1/sub', 'd1/sub')], str(Path(tmpdir, 'src')),
+                                             str(Path(tmpdir, 'dst')), 10)
+            for _ in range(2):
+                # the second copy finds the files current
+                _, completed, error = csv_rsync.transfer(batches[0], backend='native')
+                self.assertIsNone(error)
+                self.assertEqual([('sub', 'sub')], [(source, dest) for source, dest, _, _ in completed])
+
+            self.assertEqual(b'd1/sub/deeper/2', Path(tmpdir, 'dst', 'd1/sub/deeper/2').read_bytes())
+            self.assertEqual('1', os.readlink(Path(tmpdir, 'dst', 'd1/sub/link')))
+
+    def test_progress_status(self):
+        progress = csv_rsync.Progress(10, interval=3600)
+        progress.start -= 2
+        progress.add(4, 4 * 1024 * 1024, failed=1)
+
+        self.assertRegex(progress.status(), r'^5/10 files, 2\.0 files/s, 2\.0 MB/s, ETA 0:00:0[23]$')
+        self.assertEqual('1:01:01', csv_rsync.format_duration(3661))
+
+    def test_order_by_locality_groups_source_directories(self):
+        with TemporaryDirectory() as tmpdir:
+            for name in ('a/1', 'a/2', 'b/1'):
+                Path(tmpdir, name).parent.mkdir(exist_ok=True)
+                Path(tmpdir, name).write_bytes(b'x' * 8192)
+
+            rows = [('a/1', 'x/1'), ('b/1', 'y/1'), ('a/2', 'x/2'), ('c/missing', 'z/missing')]
+            ordered = csv_rsync.order_by_locality(rows, tmpdir, 2)
+
+            self.assertEqual(sorted(rows), sorted(ordered))
+            directories = [source.split('/')[0] for source, _ in ordered]
+            self.assertEqual(directories, sorted(directories, key=directories.index))
+            self.assertEqual(('c/missing', 'z/missing'), ordered[-1])
+
+    def test_is_remote(self):
+        self.assertTrue(csv_rsync.is_remote('host:/data'))
+        self.assertFalse(csv_rsync.is_remote('/data/a:b'))
+
+
+class TestDuplicates(unittest.TestCase):
+    def test_bloom_filter_has_no_false_negatives(self):
+        seen = duplicates.BloomFilter(100)
+        pids = [f'umd:{i}' for i in range(100)]
+        self.assertFalse(any(seen.add(pid) for pid in pids[:1]))
+        for pid in pids:
+            seen.add(pid)
+        self.assertTrue(all(seen.add(pid) for pid in pids))
+
+    def test_find_duplicates_verifies_candidates(self):
+        with TemporaryDirectory() as tmpdir:
+            info_path = Path(tmpdir, 'info.json')
+            records = INFO_RECORDS + [{'pid': 'umd:4', 'foxml': 'objects/umd_4_dup',
+                                       'ds': {'image': {'location': 'http://fcrepo.lib.umd.edu/4'}}}]
+            info_path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+            # a tiny filter has many false positives, which are removed by the exact pass
+            # (the first umd:4 record has no image location)
+            expected = {'umd:4': [('umam', 'objects/umd_4_dup', 'http://fcrepo.lib.umd.edu/4')]}
+            self.assertEqual(expected, duplicates.find_duplicates(str(info_path), 1))
+            self.assertEqual(expected, duplicates.find_duplicates(str(info_path), 1000))
+
+    def test_execute_move_is_journaled_and_skipped_on_rerun(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir, 'umd:3')
+            destination = Path(tmpdir, 'umd_3')
+            source.write_text('fcrepo copy')
+            destination.write_text('local')
+            journal_path = Path(tmpdir, 'moves.journal')
+
+            with Journal(journal_path) as journal:
+                self.assertEqual('moved', duplicates.execute_move(str(source), str(destination), journal))
+
+            self.assertFalse(source.exists())
+            self.assertEqual('fcrepo copy', destination.read_text())
+
+            with Journal(journal_path) as journal:
+                self.assertEqual('skipped', duplicates.execute_move(str(source), str(destination), journal))
+                destination.unlink()
+                self.assertEqual('failed', duplicates.execute_move(str(source), str(destination), journal))
+
+    def test_execute_move_finishes_interrupted_move(self):
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir, 'umd:3')
+            destination = Path(tmpdir, 'umd_3')
+            destination.write_text('fcrepo copy')
+            journal_path = Path(tmpdir, 'moves.journal')
+
+            # interrupted after the file was moved, before the move was journaled as done
+            with Journal(journal_path) as journal:
+                journal.record(str(source), destination=str(destination), size=11, done=False)
+                self.assertFalse(duplicates.is_completed(journal, str(source)))
+
+            with Journal(journal_path) as journal:
+                self.assertEqual('skipped', duplicates.execute_move(str(source), str(destination), journal))
+                self.assertTrue(duplicates.is_completed(journal, str(source)))
+
+
+class TestJournal(unittest.TestCase):
+    def test_reopen_ignores_partial_last_line(self):
+        with TemporaryDirectory() as tmpdir:
+            journal_path = Path(tmpdir, 'journal')
+            with Journal(journal_path) as journal:
+                journal.record('a', size=1)
+                journal.record('b', size=2)
+
+            with journal_path.open(mode='a') as journal_file:
+                journal_file.write('{"key":"c","si')
+
+            with Journal(journal_path) as journal:
+                self.assertEqual(2, len(journal))
+                self.assertIn('b', journal)
+                self.assertNotIn('c', journal)
+                self.assertEqual({'key': 'a', 'size': 1}, journal.get('a'))
+                journal.record('c', size=3)
+
+            with Journal(journal_path) as journal:
+                self.assertEqual(3, len(journal))
+
+
+class TestFixity(unittest.TestCase):
+    def test_verify_reports_problems(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'a.tif').write_bytes(b'image')
+            digest = hashlib.sha256(b'image').hexdigest()
+
+            def problem(path, size, sha256):
+                row = {'PATH': path, 'BYTES': size, 'SHA256': sha256}
+                return fixity.verify(tmpdir, row, 'SHA256')['PROBLEM']
+
+            self.assertEqual('', problem('a.tif', '5', digest))
+            self.assertEqual('size', problem('a.tif', '6', digest))
+            self.assertEqual('digest', problem('a.tif', '5', '0' * 64))
+            self.assertEqual('missing', problem('b.tif', '5', digest))
+            self.assertEqual('size', problem('a.tif', 'five', digest))
+
+    def test_problems_are_checked_again_on_resume(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'a.tif').write_bytes(b'image')
+            inventory_path = Path(tmpdir, 'inventory.csv')
+            with inventory_path.open(mode='w', newline='') as inventory_file:
+                writer = csv.DictWriter(inventory_file, fieldnames=['PATH', 'BYTES', 'SHA256'])
+                writer.writeheader()
+                for name in ('a.tif', 'b.tif'):
+                    writer.writerow({'PATH': name, 'BYTES': '5', 'SHA256': hashlib.sha256(b'image').hexdigest()})
+
+            def run():
+                report_path = Path(tmpdir, 'report.csv')
+                args = Namespace(infile=inventory_path.open(newline=''), restore_dir=tmpdir,
+                                 outfile=report_path.open(mode='w', newline=''),
+                                 journal=str(Path(tmpdir, 'fixity.journal')),
+                                 checksum='SHA256', workers=2, max_rate=None)
+                status = fixity.main(args)
+                with report_path.open(newline='') as report_file:
+                    return status, [(row['PATH'], row['PROBLEM']) for row in csv.DictReader(report_file)]
+
+            self.assertEqual((1, [('b.tif', 'missing')]), run())
+
+            # the missing file is checked again once it has been restored
+            Path(tmpdir, 'b.tif').write_bytes(b'image')
+            self.assertEqual((0, []), run())
+            with Journal(Path(tmpdir, 'fixity.journal')) as journal:
+                self.assertEqual(2, len(journal))
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_take_beyond_burst_waits(self):
+        bucket = TokenBucket(rate=100, burst=10)
+        start = time.monotonic()
+        bucket.take(10)
+        bucket.take(5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+
+class TestInventoryDiff(unittest.TestCase):
+    def test_diff_finds_moves(self):
+        old = [('a', ['1', 'x1']), ('b', ['2', 'x2']), ('c', ['3', 'x3']), ('d', ['4', 'x4'])]
+        new = [('a', ['1', 'x1']), ('b', ['2', 'y2']), ('c2', ['3', 'x3']), ('e', ['5', 'x5'])]
+
+        with ExternalSorter(memory_budget=0) as removed, ExternalSorter(memory_budget=0) as added:
+            changes = list(inventory_diff.diff(old, new, removed, added))
+            changes.extend(inventory_diff.find_moves(removed, added))
+
+        self.assertEqual(
+            [('modified', 'b', 'b'), ('moved', 'c2', 'c'), ('removed', '', 'd'), ('added', 'e', '')],
+            [(row['CHANGE'], row['PATH'], row['OLD_PATH']) for row in changes]
+        )
+
+    def test_checksums_compared_case_insensitively(self):
+        old = io.StringIO('PATH,BYTES,SHA256\na,1,AB12\nb,2,CD34\n')
+        new = io.StringIO('PATH,BYTES,SHA256\na,1,ab12\nb2,2,cd34\n')
+
+        with ExternalSorter(memory_budget=0) as old_paths, ExternalSorter(memory_budget=0) as new_paths, \
+                ExternalSorter(memory_budget=0) as removed, ExternalSorter(memory_budget=0) as added:
+            inventory_diff.sort_by_path(old, 'SHA256', old_paths)
+            inventory_diff.sort_by_path(new, 'SHA256', new_paths)
+            changes = list(inventory_diff.diff(old_paths, new_paths, removed, added))
+            changes.extend(inventory_diff.find_moves(removed, added))
+
+        self.assertEqual([('moved', 'b2', 'b')], [(row['CHANGE'], row['PATH'], row['OLD_PATH']) for row in changes])
+
+
+class TestEditDistance(unittest.TestCase):
+    @staticmethod
+    def reference(s, t):
+        row = list(range(len(t) + 1))
+        for i, a in enumerate(s, 1):
+            previous, row[0] = row[0], i
+            for j, b in enumerate(t, 1):
+                previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (a != b))
+        return row[-1]
+
+    def test_matches_reference(self):
+        words = ['', 'a', 'kitten', 'sitting', 'tanakatarou', 'tanakatarō', 'タナカ タロウ', '田中太郎',
+                 'yamamoto', 'yamamotoisoroku', 'x' * 70, 'x' * 65 + 'y' * 10]
+        for s in words:
+            for t in words:
+                self.assertEqual(self.reference(s, t), levenshtein(s, t), (s, t))
+
+    def test_max_distance(self):
+        self.assertEqual(3, levenshtein('kitten', 'sitting', max_distance=3))
+        self.assertEqual(3, levenshtein('kitten', 'sitting', max_distance=2))
+        self.assertEqual(2, levenshtein('a', 'abcdef', max_distance=1))
+
+    def test_many(self):
+        pairs = [('tanaka', 'tanaka'), ('tanaka', 'tanka'), ('tanaka', 'tenaka'), ('suzuki', 'tanaka')]
+        self.assertEqual([0, 1, 1, 5], levenshtein_many(pairs))
+        self.assertEqual([0, 1, 1, 3], levenshtein_many(pairs, max_distance=2))
+
+
+class TestInventory(unittest.TestCase):
+    def test_find_duplicates_groups_by_checksum(self):
+        with ExternalSorter(memory_budget=0) as sorter:
+            sorter.add('b' * 64, [200, 'umd:1', 'umd:11', 'umd_1/umd_11/b.tif'])
+            sorter.add('a' * 64, [100, 'umd:1', 'umd:10', 'umd_1/umd_10/a.tif'])
+            sorter.add('c' * 64, [5, None, None, 'other/c.tif'])
+            sorter.add('a' * 64, [100, 'umd:2', 'umd:20', 'umd_2/umd_20/a.tif'])
+            sorter.add('e' * 64, [0, 'umd:1', 'umd:12', 'umd_1/umd_12/empty.txt'])
+            sorter.add('e' * 64, [0, 'umd:2', 'umd:21', 'umd_2/umd_21/empty.txt'])
+
+            self.assertEqual(
+                [('a' * 64, ['umd:10', 'umd:20'])],
+                [(checksum, [copy[2] for copy in copies]) for checksum, copies in inventory.find_duplicates(sorter)]
+            )
+
+    def test_generate_inventory_of_restore_dir(self):
+        with TemporaryDirectory() as tmpdir:
+            binary_dir = Path(tmpdir, 'umd_1', 'umd_10')
+            binary_dir.mkdir(parents=True)
+            Path(binary_dir, 'a.tif').write_bytes(b'image')
+            Path(tmpdir, 'empty').mkdir()
+
+            outfile = io.StringIO(newline='')
+            self.assertEqual(['umd_1/umd_10/a.tif'], inventory.generate(tmpdir, outfile, 2))
+
+            outfile.seek(0)
+            rows = list(csv.DictReader(outfile))
+            self.assertEqual(1, len(rows))
+            self.assertEqual('umd_1/umd_10/a.tif', rows[0]['PATH'])
+            self.assertEqual('5', rows[0]['BYTES'])
+            self.assertEqual(hashlib.sha1(b'image').hexdigest(), rows[0]['SHA1'])
+            self.assertEqual(('umd:1', 'umd:10'), inventory.parse_pids(rows[0]))
+
+    def test_generate_reuses_unchanged_digests(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'same.tif').write_bytes(b'same')
+            Path(tmpdir, 'new.tif').write_bytes(b'new')
+            mtime = str(int(Path(tmpdir, 'same.tif').stat().st_mtime))
+            previous = {
+                'same.tif': ('4', mtime, 'md5', 'sha1', 'sha256'),
+                'gone.tif': ('1', mtime, 'md5', 'sha1', 'sha256'),
+            }
+
+            outfile = io.StringIO(newline='')
+            self.assertEqual(['new.tif'], inventory.generate(tmpdir, outfile, 2, previous))
+            self.assertEqual(['gone.tif'], list(previous))
+
+            outfile.seek(0)
+            rows = {row['PATH']: row for row in csv.DictReader(outfile)}
+            self.assertEqual('sha256', rows['same.tif']['SHA256'])
+            self.assertEqual(hashlib.sha256(b'new').hexdigest(), rows['new.tif']['SHA256'])
+
+    def test_generate_skips_unreadable_files(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'a.tif').write_bytes(b'a')
+            Path(tmpdir, 'b.tif').write_bytes(b'b')
+            previous = {'b.tif': ('2', '0', 'md5', 'sha1', 'sha256')}
+
+            def digest_file(path):
+                if path.endswith('b.tif'):
+                    raise PermissionError(13, 'Permission denied', path)
+                return {'md5': 'md5', 'sha1': 'sha1', 'sha256': 'sha256'}
+
+            outfile = io.StringIO(newline='')
+            with mock.patch('inventory.digest_file', digest_file):
+                self.assertEqual(['a.tif'], inventory.generate(tmpdir, outfile, 2, previous))
+
+            # the unreadable file is left out, and reported as deleted
+            outfile.seek(0)
+            self.assertEqual(['a.tif'], [row['PATH'] for row in csv.DictReader(outfile)])
+            self.assertEqual(['b.tif'], list(previous))
+
+            # as is a directory which vanished during the crawl
+            self.assertEqual(([], []), inventory.scan_dir(str(Path(tmpdir, 'vanished'))))
+
+    def test_parse_pids(self):
+        self.assertEqual(('umd:1', 'umd:10'), inventory.parse_pids({'DIRECTORY': 'restore/umd_1/umd_10'}))
+        self.assertIsNone(inventory.parse_pids({'DIRECTORY': 'restore/other'}))
+
+
+def viaf_response(*ids) -> str:
+    """ VIAF search response body for a list of VIAF ids. """
+    records = [{'record': {'recordData': {'viafID': {'#text': viaf_id}}}} for viaf_id in ids]
+    return json.dumps({'searchRetrieveResponse': {'numberOfRecords': str(len(ids)), 'records': records}})
+
+
+def viaf_cluster(viaf_id, name_type, sources, main_heading, *alternates) -> str:
+    """ Line of a VIAF clusters XML dump. """
+    ns = 'xmlns:ns1="http://viaf.org/viaf/terms#"'
+    sources = ''.join(f'<ns1:source nsid="{i}">LC|n{i}</ns1:source>' for i in range(sources))
+    alternates = ''.join(
+        f'<ns1:x400><ns1:datafield tag="400"><ns1:subfield code="a">{name}</ns1:subfield>'
+        f'<ns1:subfield code="d">1900-</ns1:subfield></ns1:datafield></ns1:x400>'
+        for name in alternates
+    )
+    return (f'{viaf_id}\t<ns1:VIAFCluster {ns}><ns1:viafID>{viaf_id}</ns1:viafID>'
+            f'<ns1:nameType>{name_type}</ns1:nameType><ns1:sources>{sources}</ns1:sources>'
+            f'<ns1:mainHeadings><ns1:data><ns1:text>{main_heading}</ns1:text></ns1:data></ns1:mainHeadings>'
+            f'<ns1:x400s>{alternates}</ns1:x400s></ns1:VIAFCluster>\n')
+
+
+VIAF_CLUSTERS = [
+    # the dates of an alternate heading ($d) are not part of the name
+    viaf_cluster('101', 'Personal', 2, '田中太郎', 'Tanaka, Taro', 'タナカ, タロウ'),
+    viaf_cluster('102', 'Personal', 5, 'Tanaka, Taro', 'Tanaka, T.'),
+    viaf_cluster('103', 'Personal', 1, 'Suzuki, Hanako', '鈴木花子'),
+    # not a personal name
+    viaf_cluster('201', 'Corporate', 9, 'Tanaka, Taro'),
+]
+
+
+class StandInViaf:
+    """
+    Local stand-in for the VIAF search API. Responds with the scripted
+    (status, headers, body) responses in turn, then with the default
+    response, and records the queries it receives.
+    """
+
+    def __init__(self, default=(200, {}, viaf_response('1'))):
+        self.responses = []
+        self.default = default
+        self.queries = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = dict(part.split('=', 1) for part in self.path.split('?', 1)[1].split('&'))
+                stand_in.queries.append(query['query'])
+                status, headers, body = stand_in.responses.pop(0) if stand_in.responses else stand_in.default
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body.encode('utf-8'))))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/viaf'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestLookupViaf(unittest.TestCase):
+    def test_lookup(self):
+        with StandInViaf(default=(200, {}, viaf_response('10', '20'))) as viaf:
+            client = lookup_viaf.ViafClient(viaf.base_url)
+            self.assertEqual(('Smith', viaf_response('10', '20'), '2', ['10', '20']), client.lookup('Smith'))
+            self.assertEqual(['local.personalNames+all+%22Smith%22'], viaf.queries)
+
+    def test_rate_limit_paces_requests(self):
+        with StandInViaf() as viaf:
+            client = lookup_viaf.ViafClient(viaf.base_url, rate=20)
+            start = time.monotonic()
+            for i in range(25):
+                client.search(f'name{i}')
+            # the first 20 requests are the burst, the next 5 wait for tokens
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_retry_with_backoff(self):
+        with StandInViaf() as viaf:
+            viaf.responses = [(429, {}, ''), (503, {}, ''), (500, {}, '')]
+            client = lookup_viaf.ViafClient(viaf.base_url, retries=3, backoff=0.01)
+            self.assertEqual(200, client.search('Smith').status_code)
+            self.assertEqual(4, len(viaf.queries))
+
+            viaf.responses = [(503, {}, '')] * 2
+            client = lookup_viaf.ViafClient(viaf.base_url, retries=1, backoff=0.01)
+            self.assertIsNone(client.search('Smith'))
+
+    def test_retry_after_is_honoured(self):
+        with StandInViaf() as viaf:
+            viaf.responses = [(429, {'Retry-After': '1'}, '')]
+            client = lookup_viaf.ViafClient(viaf.base_url, retries=1, backoff=0.01)
+            start = time.monotonic()
+            self.assertEqual(200, client.search('Smith').status_code)
+            self.assertGreaterEqual(time.monotonic() - start, 1)
+
+    def test_error_responses_are_not_cached(self):
+        with StandInViaf(default=(400, {}, 'Bad query')) as viaf:
+            client = lookup_viaf.ViafClient(viaf.base_url, retries=0)
+            self.assertIsNone(client.lookup('Smith'))
+
+    def lookup_args(self, tmpdir, base_url, **kwargs) -> Namespace:
+        """ Arguments of lookup_viaf.main() with the files in tmpdir. """
+        return Namespace(**dict(dict(
+            manifest=str(tmpdir / 'batch_manifest.csv'),
+            outfile=str(tmpdir / 'lookup-viaf.csv'),
+            cache=str(tmpdir / 'lookup-viaf.db'),
+            offline=None,
+            build_offline=None,
+            base_url=base_url,
+            workers=2,
+            rate=None,
+            retries=0,
+        ), **kwargs))
+
+    def test_cache_imports_csv_once(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            csv_file = tmpdir / 'lookup-viaf.csv'
+            # a VIAF error is written as a row without a number of records
+            csv_file.write_text('"Smith, John",2,https://viaf.org/viaf/10,https://viaf.org/viaf/20\n'
+                                'Doe\n'
+                                '"Tanaka, Taro",0\n')
+
+            conn = lookup_viaf.open_cache(str(tmpdir / 'lookup-viaf.db'), str(csv_file))
+            written = {creator for creator, in conn.execute('SELECT creator FROM written')}
+            self.assertEqual({'Smith, John', 'Doe', 'Tanaka, Taro'}, written)
+            self.assertEqual(('2', ['10', '20']), lookup_viaf.cached_result(conn, lookup_viaf.normalize('Smith, John')))
+            self.assertEqual(('0', []), lookup_viaf.cached_result(conn, lookup_viaf.normalize('Tanaka, Taro')))
+            # VIAF errors are not cached
+            self.assertIsNone(lookup_viaf.cached_result(conn, lookup_viaf.normalize('Doe')))
+            self.assertEqual(('1',), conn.execute("SELECT value FROM state WHERE name = 'imported'").fetchone())
+            conn.close()
+
+            # rows appended to the CSV file afterwards are not imported again
+            with open(csv_file, 'a') as out_file:
+                out_file.write('Roe,1,https://viaf.org/viaf/30\n')
+            conn = lookup_viaf.open_cache(str(tmpdir / 'lookup-viaf.db'), str(csv_file))
+            self.assertIsNone(conn.execute("SELECT 1 FROM written WHERE creator = 'Roe'").fetchone())
+            self.assertIsNone(lookup_viaf.cached_result(conn, 'Roe'))
+            conn.close()
+
+    def test_fetch_searches_normalized_names_once(self):
+        with TemporaryDirectory() as tmpdir, StandInViaf() as viaf:
+            tmpdir = Path(tmpdir)
+            conn = lookup_viaf.open_cache(str(tmpdir / 'lookup-viaf.db'), str(tmpdir / 'lookup-viaf.csv'))
+            conn.execute("INSERT INTO lookups VALUES ('Roe', NULL, '1', '[\"30\"]')")
+            # the same name, with different spacing and a date, and a cached name
+            pending = [(creator, lookup_viaf.normalize(creator))
+                       for creator in ['Smith, John', 'Smith,  John (1900-)', 'Roe', 'Doe']]
+            self.assertEqual(pending[0][1], pending[1][1])
+
+            lookup_viaf.fetch(conn, pending, self.lookup_args(tmpdir, viaf.base_url))
+            self.assertEqual(2, len(viaf.queries))
+            self.assertEqual(('1', ['1']), lookup_viaf.cached_result(conn, pending[0][1]))
+            self.assertEqual(('1', ['30']), lookup_viaf.cached_result(conn, 'Roe'))
+            conn.close()
+
+    def test_main_resumes(self):
+        with TemporaryDirectory() as tmpdir, StandInViaf() as viaf:
+            tmpdir = Path(tmpdir)
+            # a single worker, so that the scripted responses are in manifest order
+            args = self.lookup_args(tmpdir, viaf.base_url, workers=1)
+            Path(args.manifest).write_text('Identifier,Creator\n'
+                                           '1,Smith|Doe\n'
+                                           '2,Doe|Roe\n')
+            # Roe is not found, and is searched again on restart
+            viaf.responses = [(200, {}, viaf_response('1')), (200, {}, viaf_response('2')), (400, {}, '')]
+            lookup_viaf.main(args)
+
+            with open(args.outfile) as in_file:
+                rows = list(csv.reader(in_file))
+            self.assertEqual(['Smith', 'Doe'], [row[0] for row in rows])
+            self.assertEqual(3, len(viaf.queries))
+
+            lookup_viaf.main(args)
+            with open(args.outfile) as in_file:
+                rows = list(csv.reader(in_file))
+            self.assertEqual(['Smith', 'Doe', 'Roe'], [row[0] for row in rows])
+            self.assertEqual(['Roe', '1', 'https://viaf.org/viaf/1'], rows[2])
+            self.assertEqual(4, len(viaf.queries))
+
+            conn = sqlite3.connect(args.cache)
+            written = [creator for creator, in conn.execute('SELECT creator FROM written ORDER BY creator')]
+            conn.close()
+            self.assertEqual(['Doe', 'Roe', 'Smith'], written)
+
+            # nothing is searched or written once every creator is
+            lookup_viaf.main(args)
+            with open(args.outfile) as in_file:
+                self.assertEqual(3, len(list(csv.reader(in_file))))
+            self.assertEqual(4, len(viaf.queries))
+
+    def test_parse_cluster(self):
+        viaf_id, sources, headings = lookup_viaf.parse_cluster(VIAF_CLUSTERS[0])
+        self.assertEqual(('101', 2), (viaf_id, sources))
+        self.assertEqual({lookup_viaf.heading_key(name) for name in ['田中太郎', 'Tanaka, Taro', 'タナカ, タロウ']},
+                         headings)
+        self.assertEqual((None, 0, set()), lookup_viaf.parse_cluster(VIAF_CLUSTERS[3]))
+
+    def test_offline_index(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            dump_file = tmpdir / 'viaf-clusters.xml'
+            dump_file.write_text(''.join(VIAF_CLUSTERS) + '101\t<ns1:VIAFCluster>\n', encoding='utf-8')
+            index_file = str(tmpdir / 'viaf-offline.db')
+            lookup_viaf.build_offline(str(dump_file), index_file)
+
+            index = lookup_viaf.OfflineIndex(index_file)
+            # ordered by number of sources; the corporate cluster is not indexed
+            self.assertEqual(('2', ['102', '101']), index.search(lookup_viaf.normalize('Tanaka, Taro')))
+            self.assertEqual(('1', ['102']), index.search(lookup_viaf.normalize('tanaka, t.')))
+            self.assertEqual(('1', ['101']), index.search(lookup_viaf.normalize('田中 太郎')))
+            self.assertEqual(('1', ['101']), index.search(lookup_viaf.normalize('タナカ・タロウ')))
+            self.assertEqual(('1', ['103']), index.search(lookup_viaf.normalize('鈴木花子')))
+            self.assertEqual(('0', []), index.search(lookup_viaf.normalize('Yamada, Jiro')))
+            index.close()
+
+    def test_main_offline(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            dump_file = tmpdir / 'viaf-clusters.xml'
+            dump_file.write_text(''.join(VIAF_CLUSTERS), encoding='utf-8')
+            args = self.lookup_args(tmpdir, 'http://127.0.0.1:9/viaf', offline=str(tmpdir / 'viaf-offline.db'))
+            lookup_viaf.main(Namespace(**dict(vars(args), build_offline=str(dump_file))))
+
+            Path(args.manifest).write_text('Identifier,Creator\n'
+                                           '1,"Tanaka, Taro|Yamada, Jiro"\n', encoding='utf-8')
+            lookup_viaf.main(args)
+            with open(args.outfile) as in_file:
+                rows = list(csv.reader(in_file))
+            self.assertEqual([
+                ['Tanaka, Taro', '2', 'https://viaf.org/viaf/102', 'https://viaf.org/viaf/101'],
+                ['Yamada, Jiro', '0'],
+            ], rows)
+
+
 if __name__ == '__main__':
     unittest.main()